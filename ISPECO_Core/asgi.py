@@ -18,6 +18,7 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ISPECO_Core.settings")
 asgi_app = get_asgi_application()
 
 from live_streaming.routing import websocket_urlpatterns
+from live_streaming.tasks import lifespan
 
 application = ProtocolTypeRouter(
     {
@@ -25,5 +26,6 @@ application = ProtocolTypeRouter(
         "websocket": AllowedHostsOriginValidator(
             AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
         ),
+        "lifespan": lifespan,
     }
 )
@@ -168,6 +168,141 @@ TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
 PAYPAL_CLIENT_ID = os.getenv("PAYPAL_CLIENT_ID")
 PAYPAL_SECRET = os.getenv("PAYPAL_SECRET")
 
+# Live streaming settings
+STREAM_MIN_FPS = float(os.getenv("STREAM_MIN_FPS", "1"))
+STREAM_MAX_FPS = float(os.getenv("STREAM_MAX_FPS", "30"))
+STREAM_INITIAL_FPS = float(os.getenv("STREAM_INITIAL_FPS", "10"))
+# Frames a viewer may have unacknowledged before its frame rate is cut, and
+# how long to wait for an acknowledgement before giving up on them
+STREAM_ACK_WINDOW = int(os.getenv("STREAM_ACK_WINDOW", "2"))
+STREAM_ACK_TIMEOUT = float(os.getenv("STREAM_ACK_TIMEOUT", "5"))
+# MJPEG clients cannot acknowledge frames and the server cannot tell when a
+# part has reached them, so their parts are capped in rate and in bytes
+STREAM_MJPEG_FPS = float(os.getenv("STREAM_MJPEG_FPS", "5"))
+STREAM_MJPEG_MAX_KBPS = float(os.getenv("STREAM_MJPEG_MAX_KBPS", "4000"))
+# Comma-separated camera environments whose unchanged frames are not re-sent
+STREAM_MOTION_GATE_ENVIRONMENTS = [
+    environment
+    for environment in os.getenv("STREAM_MOTION_GATE_ENVIRONMENTS", "indoor").split(",")
+    if environment
+]
+STREAM_MOTION_THRESHOLD = float(os.getenv("STREAM_MOTION_THRESHOLD", "0.01"))
+STREAM_MOTION_KEEPALIVE = float(os.getenv("STREAM_MOTION_KEEPALIVE", "5"))
+# Number of capture worker processes, 0 captures on threads of the ASGI process
+STREAM_CAPTURE_WORKERS = int(os.getenv("STREAM_CAPTURE_WORKERS", "0"))
+STREAM_RING_SLOTS = int(os.getenv("STREAM_RING_SLOTS", "8"))
+STREAM_RING_SLOT_BYTES = int(os.getenv("STREAM_RING_SLOT_BYTES", str(2 * 1024 * 1024)))
+# Share of the CPU cores of the node given to decoding and encoding frames,
+# split between cameras by the tier of their owner; 0 disables the scheduler
+STREAM_FRAME_BUDGET = float(os.getenv("STREAM_FRAME_BUDGET", "0.8"))
+STREAM_TIER_WEIGHTS = {
+    tier.strip(): float(weight)
+    for tier, weight in (
+        entry.split(":")
+        for entry in os.getenv(
+            "STREAM_TIER_WEIGHTS", "basic:1,standard:2,premium:4"
+        ).split(",")
+        if entry.strip()
+    )
+}
+# Camera connection supervision, delays in seconds
+STREAM_OPEN_TIMEOUT = float(os.getenv("STREAM_OPEN_TIMEOUT", "10"))
+STREAM_READ_TIMEOUT = float(os.getenv("STREAM_READ_TIMEOUT", "5"))
+STREAM_RECONNECT_BASE_DELAY = float(os.getenv("STREAM_RECONNECT_BASE_DELAY", "0.5"))
+STREAM_RECONNECT_MAX_DELAY = float(os.getenv("STREAM_RECONNECT_MAX_DELAY", "30"))
+# "grab" drains every frame of live cameras and only decodes the ones a viewer
+# is due for, "read" decodes every frame read at up to STREAM_MAX_FPS
+STREAM_CAPTURE_MODE = os.getenv("STREAM_CAPTURE_MODE", "grab")
+# Frames buffered by capture backends supporting it, 0 keeps their default
+STREAM_CAPTURE_BUFFER_SIZE = int(os.getenv("STREAM_CAPTURE_BUFFER_SIZE", "1"))
+# H.264 passthrough: cameras are repackaged by ffmpeg into fragmented MP4 for
+# viewers supporting Media Source Extensions, instead of decoded to JPEG. Off
+# by default: the ffmpeg session is a second connection to the camera, and
+# passthrough viewers keep no hub running for detection, motion events,
+# snapshots or recording
+STREAM_PASSTHROUGH = os.getenv("STREAM_PASSTHROUGH", "False") == "True"
+STREAM_FFMPEG_PATH = os.getenv("STREAM_FFMPEG_PATH", "ffmpeg")
+STREAM_PASSTHROUGH_FRAGMENT_SECONDS = float(
+    os.getenv("STREAM_PASSTHROUGH_FRAGMENT_SECONDS", "0.5")
+)
+STREAM_PASSTHROUGH_MAX_FRAGMENTS = int(
+    os.getenv("STREAM_PASSTHROUGH_MAX_FRAGMENTS", "16")
+)
+# Accept synthetic:// stream URLs generating frames or looping a local file,
+# for development and benchmarks
+STREAM_SYNTHETIC_CAMERAS = os.getenv("STREAM_SYNTHETIC_CAMERAS", "False") == "True"
+# How long a camera stays connected after its last viewer leaves, 0 disables
+STREAM_WARM_GRACE_SECONDS = float(os.getenv("STREAM_WARM_GRACE_SECONDS", "30"))
+# Cameras a single multiplexed WebSocket (ws/cameras/) may stream at once
+STREAM_MULTIPLEX_MAX_CAMERAS = int(os.getenv("STREAM_MULTIPLEX_MAX_CAMERAS", "16"))
+# Sharding cameras across streaming nodes: each camera is captured by the node
+# it hashes to and relayed by the others. Off unless STREAM_NODE_NAME is set.
+STREAM_NODE_NAME = os.getenv("STREAM_NODE_NAME")
+# WebSocket base URL other nodes reach this node at, e.g. ws://10.0.0.5:8000
+STREAM_NODE_URL = os.getenv("STREAM_NODE_URL", "ws://localhost:8000")
+# "database" shares the live nodes through the StreamingNode table, "local"
+# uses the fixed list of STREAM_NODES, as comma-separated name=url pairs
+STREAM_NODE_REGISTRY = os.getenv("STREAM_NODE_REGISTRY", "database")
+STREAM_NODES = dict(
+    entry.strip().split("=", 1)
+    for entry in os.getenv("STREAM_NODES", "").split(",")
+    if "=" in entry
+)
+STREAM_NODE_HEARTBEAT = float(os.getenv("STREAM_NODE_HEARTBEAT", "5"))
+STREAM_NODE_TTL = float(os.getenv("STREAM_NODE_TTL", "15"))
+STREAM_HASH_REPLICAS = int(os.getenv("STREAM_HASH_REPLICAS", "100"))
+# Shared secret nodes authenticate relay connections with
+STREAM_RELAY_TOKEN = os.getenv("STREAM_RELAY_TOKEN")
+# Camera recording
+STREAM_RECORDING_DIR = os.getenv("STREAM_RECORDING_DIR", str(BASE_DIR / "recordings"))
+STREAM_SEGMENT_SECONDS = float(os.getenv("STREAM_SEGMENT_SECONDS", "60"))
+STREAM_RECORDING_FPS = float(os.getenv("STREAM_RECORDING_FPS", "5"))
+STREAM_RECORDING_WIDTH = int(os.getenv("STREAM_RECORDING_WIDTH", "1280"))
+STREAM_RECORDING_QUALITY = os.getenv("STREAM_RECORDING_QUALITY", "medium")
+STREAM_RECORDING_RETENTION_HOURS = int(
+    os.getenv("STREAM_RECORDING_RETENTION_HOURS", "24")
+)
+# Seconds a camera's owner and decrypted URL are cached for stream connects
+STREAM_ACCESS_CACHE_TTL = float(os.getenv("STREAM_ACCESS_CACHE_TTL", "30"))
+# Bearer token required to scrape the streaming metrics, which are otherwise
+# only shown to staff users
+STREAM_METRICS_TOKEN = os.getenv("STREAM_METRICS_TOKEN")
+# Threat detection, disabled unless a network is set (e.g. MobileNet-SSD)
+STREAM_DETECTION_MODEL = os.getenv("STREAM_DETECTION_MODEL")
+STREAM_DETECTION_CONFIG = os.getenv("STREAM_DETECTION_CONFIG")
+STREAM_DETECTION_LABELS = [
+    label.strip()
+    for label in os.getenv("STREAM_DETECTION_LABELS", "").split(",")
+    if label.strip()
+]
+STREAM_DETECTION_INPUT_SIZE = int(os.getenv("STREAM_DETECTION_INPUT_SIZE", "300"))
+STREAM_DETECTION_SCALE = float(os.getenv("STREAM_DETECTION_SCALE", "0.007843"))
+STREAM_DETECTION_MEAN = float(os.getenv("STREAM_DETECTION_MEAN", "127.5"))
+STREAM_DETECTION_SWAP_RB = os.getenv("STREAM_DETECTION_SWAP_RB", "False") == "True"
+STREAM_DETECTION_CONFIDENCE = float(os.getenv("STREAM_DETECTION_CONFIDENCE", "0.5"))
+STREAM_DETECTION_INTERVAL = float(os.getenv("STREAM_DETECTION_INTERVAL", "1"))
+STREAM_DETECTION_MAX_BATCH = int(os.getenv("STREAM_DETECTION_MAX_BATCH", "16"))
+# Notifications created from camera events, at most one per camera and kind
+# of event per window; an empty list of events disables them
+STREAM_NOTIFICATION_EVENTS = [
+    kind.strip()
+    for kind in os.getenv("STREAM_NOTIFICATION_EVENTS", "motion,detection").split(",")
+    if kind.strip()
+]
+STREAM_NOTIFICATION_WINDOW = float(os.getenv("STREAM_NOTIFICATION_WINDOW", "300"))
+STREAM_NOTIFICATION_FLUSH_INTERVAL = float(
+    os.getenv("STREAM_NOTIFICATION_FLUSH_INTERVAL", "5")
+)
+# Camera thumbnails served by the snapshot endpoint
+STREAM_SNAPSHOT_WIDTH = int(os.getenv("STREAM_SNAPSHOT_WIDTH", "320"))
+STREAM_SNAPSHOT_MIN_INTERVAL = float(os.getenv("STREAM_SNAPSHOT_MIN_INTERVAL", "10"))
+STREAM_SNAPSHOT_CACHE_SIZE = int(os.getenv("STREAM_SNAPSHOT_CACHE_SIZE", "256"))
+STREAM_SNAPSHOT_DIR = os.getenv("STREAM_SNAPSHOT_DIR")
+# Threads grabbing snapshots from cameras nobody is watching, and how long a
+# request waits for one before answering with the previous snapshot
+STREAM_SNAPSHOT_WORKERS = int(os.getenv("STREAM_SNAPSHOT_WORKERS", "4"))
+STREAM_SNAPSHOT_WAIT = float(os.getenv("STREAM_SNAPSHOT_WAIT", "2"))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -1,3 +1,55 @@
-from django.test import TestCase
+from datetime import datetime
+from datetime import timezone as dt_timezone
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from .views import parse_range, parse_time
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_closed_range(self):
+        self.assertEqual(parse_range("bytes=10-19", 100), (10, 19))
+
+    def test_open_range_runs_to_the_end(self):
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+
+    def test_range_is_clamped_to_size(self):
+        self.assertEqual(parse_range("bytes=50-500", 100), (50, 99))
+
+    def test_unsatisfiable_ranges(self):
+        self.assertIsNone(parse_range("bytes=100-", 100))
+        self.assertIsNone(parse_range("bytes=20-10", 100))
+        self.assertIsNone(parse_range("bytes=-", 100))
+
+    def test_unsupported_ranges(self):
+        self.assertIsNone(parse_range("items=0-1", 100))
+        self.assertIsNone(parse_range("bytes=0-1,5-6", 100))
+
+
+class ParseTimeTests(SimpleTestCase):
+    def test_unix_timestamp(self):
+        self.assertEqual(
+            parse_time("1700000000.5"),
+            datetime(2023, 11, 14, 22, 13, 20, 500000, tzinfo=dt_timezone.utc),
+        )
+
+    def test_iso_datetime(self):
+        self.assertEqual(
+            parse_time("2024-01-02T03:04:05+00:00"),
+            datetime(2024, 1, 2, 3, 4, 5, tzinfo=dt_timezone.utc),
+        )
+
+    def test_naive_datetime_is_made_aware(self):
+        moment = parse_time("2024-01-02T03:04:05")
+
+        self.assertIsNotNone(moment.tzinfo)
+
+    def test_invalid_values(self):
+        self.assertIsNone(parse_time(None))
+        self.assertIsNone(parse_time(""))
+        self.assertIsNone(parse_time("yesterday"))
+        self.assertIsNone(parse_time("2024-13-45T00:00:00"))
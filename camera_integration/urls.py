@@ -5,6 +5,12 @@ from .views import (
     CameraRetrieveUpdateDestroyView,
     CameraStreamUrlView,
     CameraAuthenticationDetailsRetrieveView,
+    CameraSnapshotView,
+    CameraStatusView,
+    RecordingFrameView,
+    RecordingPolicyView,
+    RecordingSegmentListView,
+    RecordingSegmentPlaybackView,
 )
 
 urlpatterns = [
@@ -16,4 +22,26 @@ urlpatterns = [
         CameraAuthenticationDetailsRetrieveView.as_view(),
         name="camera-authentication",
     ),
+    path("<int:id>/snapshot/", CameraSnapshotView.as_view(), name="camera-snapshot"),
+    path("<int:id>/status/", CameraStatusView.as_view(), name="camera-status"),
+    path(
+        "<int:id>/recording-policy/",
+        RecordingPolicyView.as_view(),
+        name="camera-recording-policy",
+    ),
+    path(
+        "<int:id>/recordings/",
+        RecordingSegmentListView.as_view(),
+        name="camera-recordings",
+    ),
+    path(
+        "<int:id>/recordings/<int:segment_id>/",
+        RecordingSegmentPlaybackView.as_view(),
+        name="camera-recording-playback",
+    ),
+    path(
+        "<int:id>/recordings/frame/",
+        RecordingFrameView.as_view(),
+        name="camera-recording-frame",
+    ),
 ]
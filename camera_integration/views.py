@@ -1,8 +1,27 @@
-from drf_spectacular.utils import extend_schema, inline_serializer
+import re
+from datetime import datetime
+from datetime import timezone as dt_timezone
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema, inline_serializer
 from knox.auth import TokenAuthentication
 from rest_framework import generics, permissions, status, serializers
 from rest_framework.response import Response
 
+from live_streaming.access import camera_access_cache
+from live_streaming.hub import camera_status
+from live_streaming.models import RecordingPolicy, RecordingSegment
+from live_streaming.recording import SegmentReader, read_range, recording_root
+from live_streaming.serializers import (
+    RecordingPolicySerializer,
+    RecordingSegmentSerializer,
+)
+from live_streaming.snapshots import snapshot_cache
 from .serializers import CameraSerializer, AuthenticationDetailsSerializer
 from .models import Camera
 
@@ -101,3 +120,299 @@ class CameraStreamUrlView(generics.GenericAPIView):
                 status=status.HTTP_403_FORBIDDEN,
             )
         return Response({"stream_url": camera.stream_url}, status=status.HTTP_200_OK)
+
+
+class CameraSnapshotView(generics.GenericAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    authentication_classes = (TokenAuthentication,)
+
+    @extend_schema(
+        responses={
+            (200, "image/jpeg"): OpenApiTypes.BINARY,
+            304: None,
+            403: inline_serializer(
+                name="Snapshot403",
+                fields={"message": serializers.CharField()},
+            ),
+            404: inline_serializer(
+                name="Snapshot404",
+                fields={"message": serializers.CharField()},
+            ),
+            503: inline_serializer(
+                name="Snapshot503",
+                fields={"message": serializers.CharField()},
+            ),
+        },
+        description="Retrieve the latest JPEG thumbnail of a camera specified by ID in the URL. Supports revalidation through If-None-Match and If-Modified-Since.",
+    )
+    def get(self, request, *args, **kwargs):
+        try:
+            access = camera_access_cache.load(kwargs["id"])
+        except Camera.DoesNotExist:
+            return Response(
+                {"message": "Camera not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        if access.user_id != request.user.id:
+            return Response(
+                {"message": "This user does not have access to this camera"},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+        snapshot = snapshot_cache.latest(kwargs["id"], access.stream_url)
+        if snapshot is None:
+            return Response(
+                {"message": "Camera is unavailable"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        etag = quote_etag(snapshot.etag)
+        last_modified = int(snapshot.taken_at)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = HttpResponse(snapshot.data, content_type="image/jpeg")
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class CameraStatusView(generics.GenericAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    authentication_classes = (TokenAuthentication,)
+
+    @extend_schema(
+        responses={
+            200: inline_serializer(
+                name="Status200",
+                fields={
+                    "status": serializers.ChoiceField(
+                        choices=["idle", "warming", "live"]
+                    ),
+                    "viewers": serializers.IntegerField(),
+                    "last_frame_at": serializers.FloatField(allow_null=True),
+                },
+            ),
+            403: inline_serializer(
+                name="Status403",
+                fields={"message": serializers.CharField()},
+            ),
+            404: inline_serializer(
+                name="Status404",
+                fields={"message": serializers.CharField()},
+            ),
+        },
+        description="Retrieve whether a camera specified by ID in the URL is idle, warming up or live, and how many viewers it has.",
+    )
+    def get(self, request, *args, **kwargs):
+        try:
+            camera = Camera.objects.only("user_id").get(id=kwargs["id"])
+        except Camera.DoesNotExist:
+            return Response(
+                {"message": "Camera not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        if camera.user_id != request.user.id:
+            return Response(
+                {"message": "This user does not have access to this camera"},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+        return Response(camera_status(camera.id), status=status.HTTP_200_OK)
+
+
+def parse_time(value: str | None):
+    """
+    Parses an ISO 8601 datetime or a Unix timestamp from a query parameter.
+
+    Returns:
+        datetime | None: The aware datetime, or `None` if the value is invalid.
+    """
+    if not value:
+        return None
+    try:
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    except ValueError:
+        pass
+    try:
+        moment = parse_datetime(value)
+    except ValueError:
+        return None
+    if moment is not None and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parses a single-range `Range: bytes=...` header.
+
+    Returns:
+        tuple[int, int] | None: The first and last byte offsets, both included,
+        or `None` if the range cannot be satisfied.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last or size - 1), size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+class RecordingPolicyView(generics.RetrieveUpdateAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    authentication_classes = (TokenAuthentication,)
+    serializer_class = RecordingPolicySerializer
+
+    def get_object(self):
+        camera = generics.get_object_or_404(
+            Camera.objects.filter(user=self.request.user), id=self.kwargs["id"]
+        )
+        policy, _ = RecordingPolicy.objects.get_or_create(camera=camera)
+        return policy
+
+
+class RecordingSegmentListView(generics.ListAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    authentication_classes = (TokenAuthentication,)
+    serializer_class = RecordingSegmentSerializer
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("start", OpenApiTypes.DATETIME),
+            OpenApiParameter("end", OpenApiTypes.DATETIME),
+        ],
+        description="List the recorded segments of a camera specified by ID in the URL, optionally overlapping a start and end time.",
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        segments = RecordingSegment.objects.filter(
+            camera_id=self.kwargs["id"], camera__user=self.request.user
+        )
+        start = parse_time(self.request.query_params.get("start"))
+        end = parse_time(self.request.query_params.get("end"))
+        if start is not None:
+            segments = segments.filter(ended_at__gte=start)
+        if end is not None:
+            segments = segments.filter(started_at__lte=end)
+        return segments
+
+
+class RecordingSegmentPlaybackView(generics.GenericAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    authentication_classes = (TokenAuthentication,)
+
+    @extend_schema(
+        responses={
+            (200, "video/x-motion-jpeg"): OpenApiTypes.BINARY,
+            (206, "video/x-motion-jpeg"): OpenApiTypes.BINARY,
+            404: inline_serializer(
+                name="Segment404",
+                fields={"message": serializers.CharField()},
+            ),
+            416: None,
+        },
+        description="Download a recorded segment as concatenated JPEGs. Supports single byte ranges for seeking.",
+    )
+    def get(self, request, *args, **kwargs):
+        try:
+            segment = RecordingSegment.objects.get(
+                id=kwargs["segment_id"],
+                camera_id=kwargs["id"],
+                camera__user=request.user,
+            )
+        except RecordingSegment.DoesNotExist:
+            return Response(
+                {"message": "Segment not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        path = recording_root() / segment.path
+        if not path.exists():
+            return Response(
+                {"message": "Segment not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        content_type = "video/x-motion-jpeg"
+        header = request.headers.get("Range")
+        if not header:
+            response = FileResponse(open(path, "rb"), content_type=content_type)
+            response["Accept-Ranges"] = "bytes"
+            return response
+        size = path.stat().st_size
+        byte_range = parse_range(header, size)
+        if byte_range is None:
+            response = HttpResponse(
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+        start, end = byte_range
+        # Streamed from the file, however long the range
+        response = StreamingHttpResponse(
+            read_range(path, start, end + 1),
+            content_type=content_type,
+            status=status.HTTP_206_PARTIAL_CONTENT,
+        )
+        response["Content-Length"] = end + 1 - start
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Accept-Ranges"] = "bytes"
+        return response
+
+
+class RecordingFrameView(generics.GenericAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    authentication_classes = (TokenAuthentication,)
+
+    @extend_schema(
+        parameters=[OpenApiParameter("at", OpenApiTypes.DATETIME, required=True)],
+        responses={
+            (200, "image/jpeg"): OpenApiTypes.BINARY,
+            400: inline_serializer(
+                name="RecordingFrame400",
+                fields={"message": serializers.CharField()},
+            ),
+            404: inline_serializer(
+                name="RecordingFrame404",
+                fields={"message": serializers.CharField()},
+            ),
+        },
+        description="Retrieve the recorded frame of a camera specified by ID in the URL at a past time, for time-shifted viewing.",
+    )
+    def get(self, request, *args, **kwargs):
+        at = parse_time(request.query_params.get("at"))
+        if at is None:
+            return Response(
+                {"message": "A valid 'at' time is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        segment = (
+            RecordingSegment.objects.filter(
+                camera_id=kwargs["id"],
+                camera__user=request.user,
+                started_at__lte=at,
+            )
+            .order_by("-started_at")
+            .only("path")
+            .first()
+        )
+        frame = None
+        if segment is not None and (recording_root() / segment.path).exists():
+            with SegmentReader(segment.path) as reader:
+                frame = reader.frame_at(at.timestamp())
+        if frame is None:
+            return Response(
+                {"message": "No recording at this time"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        captured_at, frame_data = frame
+        response = HttpResponse(frame_data, content_type="image/jpeg")
+        response["Last-Modified"] = http_date(captured_at)
+        patch_cache_control(response, private=True, max_age=3600)
+        return response
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from django.conf import settings
+
+from camera_integration.models import Camera
+
+
+class CameraAccess(NamedTuple):
+    """
+    What a stream needs to know about a camera: who owns it, where to read
+    it from and where it is installed.
+    """
+
+    user_id: int
+    stream_url: str
+    environment: str
+
+
+def camera_access(camera: Camera) -> CameraAccess:
+    """
+    Returns the access of a camera. Cameras without a stream URL are read
+    from the webcam of the server, as `open_video` does for an empty URL.
+    """
+    stream_url = camera.stream_url if camera.encrypted_url else ""
+    return CameraAccess(camera.user_id, stream_url, camera.environment)
+
+
+class CameraAccessCache:
+    """
+    Short-lived cache of the owner and decrypted stream URL of cameras.
+
+    Viewers reconnecting together after a network blip would otherwise each
+    query the camera and decrypt its URL. Entries expire after
+    `STREAM_ACCESS_CACHE_TTL` seconds and are dropped as soon as the camera
+    is saved or deleted in this process, so other processes serve stale data
+    for at most the TTL.
+    """
+
+    def __init__(self, ttl: float | None = None, max_entries: int = 10000):
+        self.ttl = settings.STREAM_ACCESS_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[int, tuple[float, CameraAccess]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cam_id: int) -> CameraAccess | None:
+        """
+        Returns the cached access of a camera, if it has not expired.
+        """
+        with self._lock:
+            entry = self._entries.get(cam_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self._entries[cam_id]
+                return None
+            self._entries.move_to_end(cam_id)
+            return entry[1]
+
+    def put(self, cam_id: int, access: CameraAccess) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[cam_id] = (time.monotonic(), access)
+            self._entries.move_to_end(cam_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, cam_id: int) -> None:
+        with self._lock:
+            self._entries.pop(cam_id, None)
+
+    def load(self, cam_id: int) -> CameraAccess:
+        """
+        Returns the access of a camera, loading it with a single query on a
+        cache miss.
+
+        Args:
+            cam_id (int): The ID of the camera.
+
+        Returns:
+            CameraAccess: The owner, stream URL and environment of the camera.
+
+        Raises:
+            Camera.DoesNotExist: If the camera with the given ID does not exist.
+        """
+        access = self.get(cam_id)
+        if access is None:
+            camera = Camera.objects.only("user_id", "encrypted_url", "environment").get(
+                id=cam_id
+            )
+            access = camera_access(camera)
+            self.put(cam_id, access)
+        return access
+
+    def load_many(self, cam_ids: list[int]) -> dict[int, CameraAccess]:
+        """
+        Returns the access of several cameras, loading every cache miss with
+        a single query. Cameras that do not exist are left out.
+        """
+        found = {}
+        for cam_id in set(cam_ids):
+            access = self.get(cam_id)
+            if access is not None:
+                found[cam_id] = access
+        missing = set(cam_ids) - found.keys()
+        if missing:
+            cameras = Camera.objects.filter(id__in=missing).only(
+                "user_id", "encrypted_url", "environment"
+            )
+            for camera in cameras:
+                access = camera_access(camera)
+                self.put(camera.id, access)
+                found[camera.id] = access
+        return found
+
+
+camera_access_cache = CameraAccessCache()
+
+
+def invalidate_camera_access(sender, instance: Camera, **kwargs) -> None:
+    """
+    Drops the cached access of a camera when it is saved or deleted.
+    """
+    camera_access_cache.invalidate(instance.pk)
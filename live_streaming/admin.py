@@ -1,3 +1,22 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import RecordingPolicy, RecordingSegment, StreamingNode
+
+
+@admin.register(RecordingPolicy)
+class RecordingPolicyAdmin(admin.ModelAdmin):
+    list_display = ("camera", "mode", "start_time", "end_time", "retention_hours")
+    list_filter = ("mode",)
+
+
+@admin.register(RecordingSegment)
+class RecordingSegmentAdmin(admin.ModelAdmin):
+    list_display = ("camera", "started_at", "ended_at", "size", "frame_count")
+    list_filter = ("camera", "started_at")
+    ordering = ("-started_at",)
+
+
+@admin.register(StreamingNode)
+class StreamingNodeAdmin(admin.ModelAdmin):
+    list_display = ("name", "url", "heartbeat_at")
+    ordering = ("name",)
@@ -1,6 +1,35 @@
+import multiprocessing
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class LiveStreamingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'live_streaming'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
+        from camera_integration.models import Camera
+
+        from .access import invalidate_camera_access
+
+        post_save.connect(invalidate_camera_access, sender=Camera)
+        post_delete.connect(invalidate_camera_access, sender=Camera)
+
+        if settings.STREAM_DETECTION_MODEL:
+            from .detection import start_detection
+            from .hub import hub_started
+
+            hub_started.append(start_detection)
+
+        # Capture workers forward their events to the parent, which notifies them
+        if (
+            settings.STREAM_NOTIFICATION_EVENTS
+            and multiprocessing.parent_process() is None
+        ):
+            from .events import event_bus
+            from .notifications import event_notifier
+
+            event_bus.subscribe(event_notifier)
@@ -0,0 +1,322 @@
+import random
+import threading
+import time
+from typing import Callable
+
+import cv2 as cv
+from django.conf import settings
+
+from . import metrics
+from .events import event_bus
+from .motion import MotionGate
+from .renditions import Rendition, RenditionEncoder
+from .scheduler import frame_scheduler
+from .synthetic import open_video
+
+# Seconds between two motion events of a camera while the scene keeps moving
+MOTION_EVENT_INTERVAL = 1.0
+
+
+class SupervisedCapture:
+    """
+    A `cv.VideoCapture` that reconnects to network cameras when they fail.
+
+    Opening and reading are bounded by `STREAM_OPEN_TIMEOUT` and
+    `STREAM_READ_TIMEOUT`, so a stalled RTSP session shows up as a failed
+    read. The capture is then released and reopened with jittered exponential
+    backoff until it succeeds or `stopped` is set. Local files and webcams are
+    not reconnected: a failed read ends them.
+    """
+
+    def __init__(self, cam_url: str, stopped: threading.Event):
+        self.cam_url = cam_url
+        self.stopped = stopped
+        self.live = "://" in (cam_url or "")
+        self.camera = None
+        self.attempts = 0
+        self.reconnects = 0
+
+    def open(self) -> bool:
+        """
+        Opens the capture, waiting out the backoff delay of previous failures.
+
+        Returns:
+            bool: True if the capture is open, False if the reader was stopped
+            or a local source could not be opened.
+        """
+        while self.camera is None:
+            if self.attempts:
+                if not self.live:
+                    return False
+                # Full jitter keeps cameras that failed together from
+                # reconnecting in lockstep
+                delay = random.uniform(
+                    0,
+                    min(
+                        settings.STREAM_RECONNECT_MAX_DELAY,
+                        settings.STREAM_RECONNECT_BASE_DELAY * 2**self.attempts,
+                    ),
+                )
+                if self.stopped.wait(delay):
+                    return False
+                self.reconnects += 1
+            self.attempts += 1
+            camera = open_video(
+                self.cam_url,
+                [
+                    cv.CAP_PROP_OPEN_TIMEOUT_MSEC,
+                    int(settings.STREAM_OPEN_TIMEOUT * 1000),
+                    cv.CAP_PROP_READ_TIMEOUT_MSEC,
+                    int(settings.STREAM_READ_TIMEOUT * 1000),
+                ],
+            )
+            if camera.isOpened():
+                if settings.STREAM_CAPTURE_BUFFER_SIZE > 0:
+                    # Backends supporting it stop queuing frames ahead of us
+                    camera.set(
+                        cv.CAP_PROP_BUFFERSIZE, settings.STREAM_CAPTURE_BUFFER_SIZE
+                    )
+                self.camera = camera
+            else:
+                camera.release()
+        return True
+
+    def _call(self, method: str, *args):
+        """
+        Calls a method of the capture, reopening it on failure.
+        """
+        while self.open():
+            result = getattr(self.camera, method)(*args)
+            success = result[0] if isinstance(result, tuple) else result
+            if success:
+                self.attempts = 0
+                return result
+            self.release()
+            self.attempts = max(self.attempts, 1)
+        return (False, None) if method == "read" else False
+
+    def read(self, image=None):
+        """
+        Decodes the next frame, reconnecting if needed.
+
+        Args:
+            image (np.ndarray | None): A buffer to decode the frame into,
+                used if it has the size and type of the frame.
+
+        Returns:
+            tuple[bool, np.ndarray | None]: Whether a frame was read, and the frame.
+        """
+        return self._call("read", image)
+
+    def grab(self) -> bool:
+        """
+        Fetches the next frame without decoding it, reconnecting if needed.
+        """
+        return self._call("grab")
+
+    def retrieve(self, image=None):
+        """
+        Decodes the frame fetched by the last `grab`. A failure releases the
+        capture, so the next `grab` reconnects.
+
+        Args:
+            image (np.ndarray | None): A buffer to decode the frame into,
+                used if it has the size and type of the frame.
+
+        Returns:
+            tuple[bool, np.ndarray | None]: Whether a frame was decoded, and the
+            frame.
+        """
+        if self.camera is None:
+            return False, None
+        success, frame = self.camera.retrieve(image)
+        if not success:
+            self.release()
+            self.attempts = max(self.attempts, 1)
+        return success, frame
+
+    def release(self) -> None:
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+
+
+class CaptureReader(threading.Thread):
+    """
+    Reads and encodes the frames of a camera on a dedicated thread.
+
+    `cv.VideoCapture.read` and `cv.imencode` are blocking C calls, so running
+    them on the event loop would stall every other connection served by the
+    process. The reader does that work off the loop, encodes each frame once
+    for every rendition in `renditions` and passes the result to `on_frame`
+    along with the capture and encode times of the frame, followed by `None`
+    once the source has ended. With a `motion_gate`, frames showing no change
+    are dropped before being encoded at all, and frames passing because of
+    motion publish a `motion` event on the `event_bus`.
+
+    The camera is read through a `SupervisedCapture`, so network cameras are
+    reconnected after a stall instead of ending the stream. While no
+    rendition is requested, e.g. during the warm standby of a hub, frames
+    are only grabbed to keep the connection alive and are never decoded.
+
+    With `STREAM_CAPTURE_MODE` set to `grab`, live cameras are drained as
+    fast as they deliver frames with `grab`, which only demuxes, and a frame
+    is decoded with `retrieve` at most `fps` times per second, the rate of
+    the fastest viewer. Decoding then costs in proportion to what is sent
+    rather than to the frame rate of the camera, and the reader never falls
+    behind the camera, which would let the backend buffer frames and delay
+    the ones decoded. In `read` mode every frame read is decoded.
+
+    Frames are decoded into the same buffer every time and downscaled and
+    encoded by a `RenditionEncoder`, so a frame allocates little more than
+    its JPEGs, which are passed on as `memoryview`s rather than copied.
+
+    Frames are only decoded once the `frame_scheduler` grants them a slot,
+    so cameras share the CPU budget of the process by the tier of their
+    owner. Capture, decode and encode timings are recorded in `metrics`.
+    """
+
+    def __init__(
+        self,
+        cam_id: int,
+        cam_url: str,
+        on_frame: Callable[..., None],
+        motion_gate: MotionGate | None = None,
+    ):
+        super().__init__(name=f"capture-{cam_id}", daemon=True)
+        self.cam_id = cam_id
+        self.cam_url = cam_url
+        self.on_frame = on_frame
+        self.motion_gate = motion_gate
+        self.renditions: frozenset[Rendition] = frozenset()
+        self.fps = settings.STREAM_MAX_FPS
+        self._stopped = threading.Event()
+
+    def stop(self) -> None:
+        """
+        Asks the reader to stop after the frame it is currently processing.
+        """
+        self._stopped.set()
+
+    def refresh(self) -> None:
+        """
+        Makes the next frame go through even if the motion gate would skip it.
+        """
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
+
+    def run(self):
+        min_interval = 1 / settings.STREAM_MAX_FPS
+        next_read = next_decode = time.monotonic()
+        camera = SupervisedCapture(self.cam_url, self._stopped)
+        # Local files and webcams are paced by the reader rather than drained
+        draining = settings.STREAM_CAPTURE_MODE == "grab" and camera.live
+        reconnects = 0
+        label = str(self.cam_id)
+        captured = metrics.frames_captured.labels(label)
+        grabbed = metrics.frames_grabbed.labels(label)
+        skipped = metrics.frames_skipped.labels(label)
+        decode_seconds = metrics.decode_seconds.labels(label)
+        encode_seconds = {}
+        motion_reported_at = 0.0
+        encoder = RenditionEncoder()
+        # Reused by every frame of the same size, which is only safe because
+        # nothing keeps the decoded frame once it has been encoded
+        frame_buffer = None
+        share = frame_scheduler.register(self.cam_id)
+        throttled = metrics.frames_throttled.labels(label, share.tier)
+
+        try:
+            while not self._stopped.is_set():
+                if draining:
+                    # Live sources block until their next frame
+                    if not camera.grab():
+                        break
+                    now = time.monotonic()
+                    if not self.renditions or now < next_decode:
+                        grabbed.inc()
+                        continue
+                    next_decode = max(next_decode + 1 / self.fps, now)
+                else:
+                    # Capped at the fastest rate any viewer may ask for
+                    delay = next_read - time.monotonic()
+                    if delay > 0 and self._stopped.wait(delay):
+                        break
+                    next_read = max(next_read + min_interval, time.monotonic())
+
+                    if not self.renditions:
+                        if not camera.grab():
+                            break
+                        continue
+
+                if not frame_scheduler.acquire(share, min_interval):
+                    # Keep up with the camera without spending CPU on the frame
+                    throttled.inc()
+                    if not draining and not camera.grab():
+                        break
+                    continue
+
+                cpu_started = time.thread_time()
+                try:
+                    started = time.perf_counter()
+                    if draining:
+                        success, frame = camera.retrieve(frame_buffer)
+                        if not success:
+                            # The next grab reconnects
+                            continue
+                    else:
+                        success, frame = camera.read(frame_buffer)
+                        if not success:
+                            break
+                    decode_seconds.observe(time.perf_counter() - started)
+                    frame_buffer = frame
+                    captured_at = time.time()
+                    captured.inc()
+                    if camera.reconnects != reconnects:
+                        metrics.reconnects.labels(label).inc(
+                            camera.reconnects - reconnects
+                        )
+                        reconnects = camera.reconnects
+
+                    if (
+                        self.motion_gate is not None
+                        and not self.motion_gate.should_send(frame)
+                    ):
+                        skipped.inc()
+                        continue
+                    if (
+                        self.motion_gate is not None
+                        and self.motion_gate.moved
+                        and captured_at - motion_reported_at >= MOTION_EVENT_INTERVAL
+                    ):
+                        motion_reported_at = captured_at
+                        event_bus.emit(
+                            self.cam_id,
+                            "motion",
+                            {"score": round(self.motion_gate.score, 3)},
+                            captured_at,
+                        )
+
+                    # Convert frame to JPEG format, once per requested rendition
+                    encoded = {}
+                    for rendition in self.renditions:
+                        started = time.perf_counter()
+                        frame_data = encoder.encode(frame, rendition)
+                        if rendition not in encode_seconds:
+                            encode_seconds[rendition] = metrics.encode_seconds.labels(
+                                label, rendition.name
+                            )
+                        encode_seconds[rendition].observe(time.perf_counter() - started)
+                        if frame_data is not None:
+                            encoded[rendition] = frame_data
+                    if not encoded:
+                        continue
+
+                    self.on_frame(encoded, captured_at, time.time())
+                finally:
+                    frame_scheduler.release(share, time.thread_time() - cpu_started)
+
+        finally:
+            camera.release()  # Release the camera capture
+            frame_scheduler.unregister(share)
+            self.on_frame(None)
@@ -1,98 +1,887 @@
 import asyncio
-import cv2 as cv
+import hmac
+import json
+import time
+from collections import deque
+from urllib.parse import parse_qs
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from camera_integration.models import Camera
 
+from . import metrics
+from .access import CameraAccess, camera_access_cache
+from .events import CameraEvent, event_bus
+from .flow import FrameRateController, StreamSession
+from .hub import get_hub
+from .mosaic import Mosaic
+from .passthrough import FragmentMailbox, get_feed, passthrough_available
+from .protocol import (
+    FMP4_SUBPROTOCOL,
+    SEQ_MASK,
+    SUBPROTOCOL,
+    pack_frame,
+    pack_relay_frame,
+)
+from .relay import RELAY_TOKEN_HEADER, RelayMailbox
+from .renditions import RENDITIONS, rendition_from_query, select_rendition
+from .sharding import node_cluster
+from .tasks import stream_tasks
 
-@database_sync_to_async
-def get_camera_user(cam_id: int):
+
+async def get_camera_access(cam_id: int) -> CameraAccess:
     """
-    Retrieves the user associated with a given camera ID.
+    Retrieves the owner, stream URL and environment of a camera, from the
+    access cache or with a single query.
 
     Args:
         cam_id (int): The ID of the camera.
 
     Returns:
-        User: The user associated with the camera.
+        CameraAccess: The owner ID, stream URL and environment of the camera.
 
     Raises:
         Camera.DoesNotExist: If the camera with the given ID does not exist.
     """
-    return Camera.objects.get(id=cam_id).user
+    access = camera_access_cache.get(cam_id)
+    if access is None:
+        access = await database_sync_to_async(camera_access_cache.load)(cam_id)
+    return access
 
 
 @database_sync_to_async
-def get_camera_url(cam_id: int):
+def get_user_cameras(user, cam_ids: list[int]):
     """
-    Retrieves the URL of a camera based on its ID.
+    Retrieves the stream URL and environment of several cameras owned by a user.
 
     Args:
-        cam_id (int): The ID of the camera.
+        user (User): The owner of the cameras.
+        cam_ids (list[int]): The IDs of the cameras.
 
     Returns:
-        str: The URL of the camera.
+        dict[int, tuple[str, str]]: The URL and environment of each camera
+        owned by the user, keyed by camera ID.
+    """
+    cameras = camera_access_cache.load_many(cam_ids)
+    return {
+        cam_id: (access.stream_url, access.environment)
+        for cam_id, access in cameras.items()
+        if access.user_id == user.id
+    }
 
-    Raises:
-        Camera.DoesNotExist: If the camera with the given ID does not exist.
+
+def query_number(query: dict[str, list[str]], name: str, default: float) -> float:
+    """
+    Reads a positive number from a parsed query string.
+
+    Args:
+        query (dict[str, list[str]]): The query string parsed by `parse_qs`.
+        name (str): The name of the parameter.
+        default (float): The value used when the parameter is missing or invalid.
+
+    Returns:
+        float: The value of the parameter.
     """
-    return Camera.objects.get(id=cam_id).url
+    try:
+        value = float(query.get(name, [default])[0])
+    except ValueError:
+        return default
+    return value if 0 < value < float("inf") else default
+
+
+class StreamConsumer(AsyncWebsocketConsumer):
+    """
+    Base consumer running its frame loop as a background task.
+
+    Subclasses implement `stream` and call `start_streaming` once the socket
+    is accepted, so `connect` returns right away and client messages and
+    disconnects are handled while frames flow. The task is cancelled when
+    the client disconnects, or when the server stops the consumer, before
+    `leave` releases the subscriptions of the connection.
+    """
+
+    stream_task = None
+    stream_kind = "stream"
+    events = ()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # The server cancels consumers on shutdown without a disconnect
+            await self.stop_streaming()
+
+    async def disconnect(self, close_code):
+        """
+        Called when a WebSocket connection is closed.
+        """
+        await self.stop_streaming()
+
+    def start_streaming(self) -> None:
+        """
+        Starts the frame loop of the connection as a tracked task.
+        """
+        self.stream_task = stream_tasks.start(self.run_stream(), self.stream_kind)
+
+    async def stop_streaming(self) -> None:
+        """
+        Cancels the frame loop, if any, and waits for it to clean up.
+        """
+        task, self.stream_task = self.stream_task, None
+        await stream_tasks.cancel(task)
+        self.leave()
+
+    async def run_stream(self):
+        """
+        Runs `stream` and closes the socket once the stream has ended.
+        """
+        try:
+            await self.stream()
+        finally:
+            self.leave()
+        await self.close()
+
+    async def stream(self):
+        raise NotImplementedError
+
+    async def send_events(self):
+        """
+        Sends the camera events queued in `events` since the previous frame
+        as JSON.
+        """
+        while self.events:
+            event = self.events.popleft()
+            await self.send(
+                text_data=json.dumps(
+                    {
+                        "type": event.kind,
+                        "cam_id": event.cam_id,
+                        "occurred_at": event.occurred_at,
+                        **event.data,
+                    }
+                )
+            )
+
+    def leave(self):
+        """
+        Releases the hubs the connection is subscribed to.
+        """
 
 
-class CameraConsumer(AsyncWebsocketConsumer):
+class CameraConsumer(StreamConsumer):
     """
     Represents a consumer for streaming camera frames over a WebSocket connection.
+
+    Each connection keeps only the latest frame broadcast by the camera hub
+    and paces itself with a frame rate adapted to how fast the client
+    acknowledges frames, with `{"type": "ack"}` for every message received.
+    The `max_width` and `quality` query parameters select the rendition the
+    client receives, e.g. `ws/live_stream/1/?max_width=640&quality=low`.
+    Clients can ask for the counters of their session by sending
+    `{"type": "stats"}`.
+
+    Clients offering the `ispeco.frame.v1` subprotocol get every JPEG
+    prefixed with a `protocol.FRAME_HEADER` carrying the camera ID, sequence
+    number, capture, encode and send times and rendition of the frame, and
+    acknowledge frames with `{"type": "ack", "seq": <sequence number>}`,
+    which also acknowledges the frames before it, and may report the
+    latencies they measure with
+    `{"type": "latency", "samples": [<seconds>, ...]}`. They also receive the
+    events of the camera, such as detections, as JSON text messages between
+    frames.
+
+    Clients able to play H.264 through Media Source Extensions may offer the
+    `ispeco.fmp4.v1` subprotocol first. If `STREAM_PASSTHROUGH` is on and the
+    camera can be passed through, they get its video repackaged as fragmented
+    MP4 without any decoding, preceded by a `{"type": "init", "mime": ...}`
+    message, along with the camera events. If the stream turns out not to be
+    H.264, they get a `{"type": "fallback"}` message and the socket is
+    closed, and offering JPEG subprotocols alongside makes the next
+    connection negotiate JPEG.
     """
 
+    stream_kind = "camera"
+    session = None
+    hub = None
+    feed = None
+    stop_events = None
+
     async def connect(self):
         """
         Called when a WebSocket connection is established.
         """
         self.user = self.scope["user"]
-        self.cam_id = self.scope["url_route"]["kwargs"]["cam_id"]
+        self.cam_id = int(self.scope["url_route"]["kwargs"]["cam_id"])
         if self.user.is_anonymous:
             await self.close(code=4001, reason="Unauthorized")
-        if self.user != await get_camera_user(self.cam_id):
+            return
+        try:
+            access = await get_camera_access(self.cam_id)
+        except Camera.DoesNotExist:
+            await self.close(code=4004, reason="Camera not found")
+            return
+        if self.user.id != access.user_id:
             print("User does not have access to this camera...")
             await self.close(code=4001, reason="Unauthorized")
-        self.cam_url = await get_camera_url(self.cam_id)
-        await self.accept()
+            return
+        self.cam_url = access.stream_url
+        self.cam_environment = access.environment
+        subprotocols = self.scope.get("subprotocols", [])
+        self.events = deque(maxlen=16)
+        if FMP4_SUBPROTOCOL in subprotocols and passthrough_available(
+            self.cam_id, self.cam_url
+        ):
+            await self.accept(FMP4_SUBPROTOCOL)
+
+            # Subscribe to the camera's shared passthrough feed
+            self.session = StreamSession(
+                str(self.cam_id),
+                "fmp4",
+                FragmentMailbox(settings.STREAM_PASSTHROUGH_MAX_FRAGMENTS),
+            )
+            self.feed = get_feed(self.cam_id, self.cam_url)
+            self.feed.subscribe(self.session.mailbox)
+            self.stop_events = event_bus.subscribe(self.queue_event)
+            self.start_streaming()
+            return
+        self.framed = SUBPROTOCOL in subprotocols
+        await self.accept(SUBPROTOCOL if self.framed else None)
 
-        # Start generating frames and streaming to the client
-        async for frame_data in self.generate_frames():
+        # Subscribe to the camera's shared capture and stream to the client
+        self.session = StreamSession(str(self.cam_id), "websocket")
+        self.hub = get_hub(self.cam_id, self.cam_url, self.cam_environment)
+        self.hub.subscribe(
+            self.session.mailbox, self.get_rendition(), self.session.rate
+        )
+        if self.framed:
+            self.stop_events = event_bus.subscribe(self.queue_event)
+        self.start_streaming()
+
+    async def stream(self):
+        """
+        Sends the camera frames to the client as they become due, followed by
+        the events published since the previous frame.
+        """
+        if self.feed is not None:
+            await self.stream_fragments()
+            return
+        async for frame_data, info in self.generate_frames():
+            seq = None
+            if self.framed and info is not None:
+                frame_data = pack_frame(info, frame_data)
+                seq = info.seq & SEQ_MASK
+            else:
+                # Frames may be views of the encoder's buffer
+                frame_data = bytes(frame_data)
+            started = time.monotonic()
             await self.send(bytes_data=frame_data)
+            self.session.frame_sent(
+                len(frame_data),
+                time.monotonic() - started,
+                info.captured_at if info else None,
+                seq,
+            )
+            await self.send_events()
 
-    async def disconnect(self, close_code):
+    async def stream_fragments(self):
         """
-        Called when a WebSocket connection is closed.
+        Sends the fragmented MP4 stream of the camera to the client as it is
+        produced, each init segment preceded by its MIME type, or tells the
+        client to fall back to JPEG if the camera cannot be passed through.
+        """
+        started_streaming = False
+        while (fragment := await self.session.mailbox.get()) is not None:
+            if fragment.init:
+                started_streaming = True
+                await self.send(
+                    text_data=json.dumps({"type": "init", "mime": self.feed.mime})
+                )
+            started = time.monotonic()
+            await self.send(bytes_data=fragment.data)
+            self.session.frame_sent(len(fragment.data), time.monotonic() - started)
+            await self.send_events()
+        if not started_streaming:
+            await self.send(
+                text_data=json.dumps({"type": "fallback", "reason": self.feed.error})
+            )
+
+    def queue_event(self, event: CameraEvent) -> None:
+        """
+        Keeps the events of the streamed camera until the next frame is sent.
+        """
+        if event.cam_id == self.cam_id:
+            self.events.append(event)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Called when the client sends a message. Paces the stream on its
+        acknowledgements, answers requests for the session counters and
+        records the latencies reported by the client.
+        """
+        try:
+            message = json.loads(text_data or "")
+        except ValueError:
+            return
+        if not isinstance(message, dict) or self.session is None:
+            return
+        if message.get("type") == "ack":
+            self.session.ack(message_seq(message))
+        elif message.get("type") == "stats":
+            await self.send(
+                text_data=json.dumps({"type": "stats", **self.session.stats()})
+            )
+        elif message.get("type") == "latency" and isinstance(
+            message.get("samples"), list
+        ):
+            latency = metrics.client_latency_seconds.labels(self.cam_id)
+            for sample in message["samples"][:100]:
+                if isinstance(sample, (int, float)) and 0 <= sample < 3600:
+                    latency.observe(sample)
+
+    def get_rendition(self):
+        """
+        Returns the rendition requested through the query string.
         """
-        pass
+        return rendition_from_query(self.scope.get("query_string", b"").decode())
+
+    def leave(self):
+        """
+        Unsubscribes from the camera hub, letting it stop if this was the last viewer.
+        """
+        if self.stop_events is not None:
+            self.stop_events()
+            self.stop_events = None
+        if self.feed is not None:
+            self.feed.unsubscribe(self.session.mailbox)
+            self.feed = None
+        if self.hub is not None:
+            self.hub.unsubscribe(self.session.mailbox)
+            self.hub = None
 
     async def generate_frames(self):
         """
-        Generates camera frames and yields them as bytes.
+        Yields the newest camera frame as bytes, with its `FrameInfo`, each
+        time the client is due one.
+        """
+        while True:
+            frame_data = await self.session.next_frame()
+            if frame_data is None:
+                break
+            yield frame_data, self.session.mailbox.info
+
+
+class MosaicConsumer(StreamConsumer):
+    """
+    Streams several cameras of a user tiled into a single image.
+
+    Query parameters:
+        cams: Comma-separated camera IDs, e.g. `cams=1,2,3,4`.
+        layout: The grid as `<cols>x<rows>`, e.g. `2x2`. Defaults to the
+            smallest square grid fitting every camera.
+        tile_width: The width of a tile in pixels, 320 by default.
+        tile_fps: How often each tile may refresh, 5 times per second by default.
+        quality: The JPEG quality tier of the mosaic.
+
+    Clients acknowledge every mosaic received with `{"type": "ack"}`.
+    """
+
+    stream_kind = "mosaic"
+    session = None
+    hubs = ()
+
+    async def connect(self):
+        """
+        Called when a WebSocket connection is established.
         """
-        camera = cv.VideoCapture(
-            self.cam_url if self.cam_url else 0
-        )  # Use 0 for webcam, replace with camera URL for IP camera
+        self.user = self.scope["user"]
+        self.hubs = []
+        if self.user.is_anonymous:
+            await self.close(code=4001, reason="Unauthorized")
+            return
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        cam_ids = [
+            int(cam_id)
+            for cam_id in query.get("cams", [""])[0].split(",")
+            if cam_id.isdigit()
+        ]
+        cameras = await get_user_cameras(self.user, cam_ids)
+        if not cam_ids or len(cameras) != len(set(cam_ids)):
+            await self.close(code=4001, reason="Unauthorized")
+            return
+        await self.accept()
+
+        tile_width = min(int(query_number(query, "tile_width", 320)), 1280)
+        self.mosaic = Mosaic.from_layout(
+            list(dict.fromkeys(cam_ids)),
+            query.get("layout", [None])[0],
+            tile_width=tile_width,
+            tile_height=tile_width * 9 // 16,
+            tile_fps=query_number(query, "tile_fps", 5),
+            quality=query.get("quality", ["medium"])[0],
+        )
+        self.session = StreamSession("mosaic", "websocket")
+        for tile in self.mosaic.tiles:
+            cam_url, environment = cameras[tile.cam_id]
+            hub = get_hub(tile.cam_id, cam_url, environment)
+            hub.subscribe(tile.mailbox, self.mosaic.rendition, tile.rate)
+            self.hubs.append((hub, tile.mailbox))
+        self.start_streaming()
 
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Called when the client sends a message. Paces the mosaic on its
+        acknowledgements.
+        """
         try:
-            while True:
-                success, frame = camera.read()
-                if not success:
-                    break
+            message = json.loads(text_data or "")
+        except ValueError:
+            return
+        if isinstance(message, dict) and message.get("type") == "ack":
+            if self.session is not None:
+                self.session.ack()
 
-                # Convert frame to JPEG format
-                ret, buffer = cv.imencode(".jpg", frame)
-                if not ret:
-                    continue
+    def leave(self):
+        """
+        Unsubscribes every tile from its camera hub.
+        """
+        for hub, mailbox in self.hubs:
+            hub.unsubscribe(mailbox)
+        self.hubs = []
 
-                # Convert frame buffer to bytes and yield
-                yield buffer.tobytes()
+    async def stream(self):
+        """
+        Composes and sends the mosaic whenever a tile has a new frame.
+        """
+        loop = asyncio.get_running_loop()
+        while not all(tile.mailbox.closed for tile in self.mosaic.tiles):
+            await self.session.wait_turn()
+            frames = self.mosaic.take_due_frames()
+            if not frames:
+                await asyncio.sleep(self.session.rate.interval)
+                continue
+            # Decoding, resizing and encoding are blocking, keep them off the loop
+            frame_data = await loop.run_in_executor(None, self.mosaic.compose, frames)
+            if frame_data is None:
+                continue
+            started = time.monotonic()
+            await self.send(bytes_data=frame_data)
+            self.session.frame_sent(len(frame_data), time.monotonic() - started)
 
-                # Simulate processing delay
-                await asyncio.sleep(0.1)  # Adjust delay as needed
 
-        finally:
-            camera.release()  # Release the camera capture
+class CameraSubscription:
+    """
+    One camera streamed over a `MultiplexConsumer` connection: its hub, the
+    flow control of its frames and the task sending them.
+    """
+
+    def __init__(self, cam_id: int, hub, rendition):
+        self.cam_id = cam_id
+        self.hub = hub
+        self.rendition = rendition
+        self.session = StreamSession(str(cam_id), "multiplex")
+        self.task = None
+
+
+class MultiplexConsumer(StreamConsumer):
+    """
+    Streams any number of cameras of a user over a single WebSocket, e.g.
+    for dashboards, so a wall of cameras costs one connection and one
+    authentication instead of one per camera.
+
+    Every frame is sent with the `protocol.FRAME_HEADER` of the
+    `ispeco.frame.v1` subprotocol, whose camera ID tells the cameras apart,
+    and the events of the subscribed cameras are sent as JSON text messages.
+    Each camera is paced on its own, with the frame rate adapted to how
+    fast the client acknowledges its frames and capped at the rate asked for
+    by the client.
+
+    Clients manage their subscriptions with JSON messages:
+
+    - `{"type": "subscribe", "cams": [1, 2], "max_width": 640,
+      "quality": "low", "fps": 5}` starts streaming cameras of the user,
+      `max_width`, `quality` and `fps` being optional. Subscribing to a
+      camera again changes its rendition and rate. Answered with
+      `{"type": "subscribed", "cams": [...]}`, and with
+      `{"type": "error", "cams": [...], "reason": ...}` for the cameras
+      that cannot be streamed.
+    - `{"type": "unsubscribe", "cams": [1]}` stops streaming cameras,
+      answered with `{"type": "unsubscribed", "cams": [...]}`.
+    - `{"type": "rate", "cams": [1], "fps": 2}` caps the frame rate of
+      cameras.
+    - `{"type": "ack", "cam_id": 1, "seq": 42}` acknowledges a frame of a
+      camera and the frames of the camera sent before it.
+    - `{"type": "stats"}` asks for the counters of every camera.
+
+    A camera whose stream ends is announced with
+    `{"type": "ended", "cam_id": ...}`. The `cams`, `max_width`, `quality`
+    and `fps` query parameters subscribe to cameras right away, e.g.
+    `ws/cameras/?cams=1,2,3&fps=5`. At most `STREAM_MULTIPLEX_MAX_CAMERAS`
+    cameras are streamed at once.
+    """
+
+    stream_kind = "multiplex"
+    stop_events = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.subscriptions: dict[int, CameraSubscription] = {}
+
+    async def connect(self):
+        """
+        Called when a WebSocket connection is established.
+        """
+        self.user = self.scope["user"]
+        if self.user.is_anonymous:
+            await self.close(code=4001, reason="Unauthorized")
+            return
+        subprotocols = self.scope.get("subprotocols", [])
+        await self.accept(SUBPROTOCOL if SUBPROTOCOL in subprotocols else None)
+        self.events = deque(maxlen=64)
+        self.stop_events = event_bus.subscribe(self.queue_event)
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        if "cams" in query:
+            await self.subscribe(
+                {
+                    "cams": query["cams"][0].split(","),
+                    **{
+                        name: query[name][0]
+                        for name in ("max_width", "quality", "fps")
+                        if name in query
+                    },
+                }
+            )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Called when the client sends a message. Handles subscriptions, rate
+        limits and requests for the counters of the cameras.
+        """
+        try:
+            message = json.loads(text_data or "")
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        if message.get("type") == "subscribe":
+            await self.subscribe(message)
+        elif message.get("type") == "unsubscribe":
+            cam_ids = [
+                cam_id
+                for cam_id in message_cameras(message)
+                if cam_id in self.subscriptions
+            ]
+            for cam_id in cam_ids:
+                await self.unsubscribe(cam_id)
+            await self.send_json({"type": "unsubscribed", "cams": cam_ids})
+        elif message.get("type") == "ack":
+            subscription = self.subscriptions.get(message_camera(message))
+            if subscription is not None:
+                subscription.session.ack(message_seq(message))
+        elif message.get("type") == "rate":
+            fps = message_fps(message)
+            for cam_id in message_cameras(message):
+                if fps is not None and cam_id in self.subscriptions:
+                    self.subscriptions[cam_id].session.rate.limit(fps)
+        elif message.get("type") == "stats":
+            await self.send_json(
+                {
+                    "type": "stats",
+                    "cameras": {
+                        cam_id: subscription.session.stats()
+                        for cam_id, subscription in self.subscriptions.items()
+                    },
+                }
+            )
+
+    async def subscribe(self, message: dict) -> None:
+        """
+        Starts streaming the cameras of a `subscribe` message the user owns,
+        or updates their rendition and rate if they are already streamed.
+        """
+        cam_ids = message_cameras(message)
+        max_width = message.get("max_width")
+        rendition = select_rendition(
+            int(max_width) if str(max_width).isdigit() else None,
+            message.get("quality"),
+        )
+        fps = message_fps(message)
+        cameras = await get_user_cameras(self.user, cam_ids)
+        subscribed, refused = [], {}
+        for cam_id in cam_ids:
+            if cam_id not in cameras:
+                refused[cam_id] = "Camera not found"
+            elif (
+                cam_id not in self.subscriptions
+                and len(self.subscriptions) >= settings.STREAM_MULTIPLEX_MAX_CAMERAS
+            ):
+                refused[cam_id] = "Too many cameras"
+            else:
+                self.subscribe_camera(cam_id, *cameras[cam_id], rendition, fps)
+                subscribed.append(cam_id)
+        if subscribed:
+            await self.send_json({"type": "subscribed", "cams": subscribed})
+        for reason in dict.fromkeys(refused.values()):
+            await self.send_json(
+                {
+                    "type": "error",
+                    "cams": [cam_id for cam_id in refused if refused[cam_id] == reason],
+                    "reason": reason,
+                }
+            )
+
+    def subscribe_camera(
+        self, cam_id: int, cam_url: str, environment: str, rendition, fps
+    ) -> None:
+        """
+        Subscribes to the hub of a camera and starts sending its frames, or
+        updates the rendition and rate of an existing subscription.
+        """
+        subscription = self.subscriptions.get(cam_id)
+        if subscription is None:
+            subscription = CameraSubscription(
+                cam_id, get_hub(cam_id, cam_url, environment), rendition
+            )
+            self.subscriptions[cam_id] = subscription
+            subscription.task = stream_tasks.start(
+                self.stream_camera(subscription), self.stream_kind
+            )
+        subscription.rendition = rendition
+        if fps is not None:
+            subscription.session.rate.limit(fps)
+        subscription.hub.subscribe(
+            subscription.session.mailbox, rendition, subscription.session.rate
+        )
+
+    async def unsubscribe(self, cam_id: int) -> None:
+        """
+        Stops sending the frames of a camera and leaves its hub.
+        """
+        subscription = self.subscriptions.pop(cam_id)
+        await stream_tasks.cancel(subscription.task)
+        subscription.hub.unsubscribe(subscription.session.mailbox)
+
+    async def stream_camera(self, subscription: CameraSubscription) -> None:
+        """
+        Sends the frames of one camera as they become due, followed by the
+        events published since the previous frame.
+        """
+        session = subscription.session
+        while (frame_data := await session.next_frame()) is not None:
+            info = session.mailbox.info
+            frame_data = pack_frame(info, frame_data)
+            started = time.monotonic()
+            await self.send(bytes_data=frame_data)
+            session.frame_sent(
+                len(frame_data),
+                time.monotonic() - started,
+                info.captured_at,
+                info.seq & SEQ_MASK,
+            )
+            await self.send_events()
+
+        # The camera has stopped, forget it so it can be subscribed again
+        if self.subscriptions.get(subscription.cam_id) is subscription:
+            del self.subscriptions[subscription.cam_id]
+        subscription.hub.unsubscribe(session.mailbox)
+        await self.send_json({"type": "ended", "cam_id": subscription.cam_id})
+
+    async def send_json(self, message: dict) -> None:
+        await self.send(text_data=json.dumps(message))
+
+    def queue_event(self, event: CameraEvent) -> None:
+        """
+        Keeps the events of the subscribed cameras until a frame is sent.
+        """
+        if event.cam_id in self.subscriptions:
+            self.events.append(event)
+
+    async def stop_streaming(self) -> None:
+        """
+        Cancels the frame loop of every camera and waits for them to finish.
+        """
+        await asyncio.gather(
+            *(
+                stream_tasks.cancel(subscription.task)
+                for subscription in self.subscriptions.values()
+            )
+        )
+        await super().stop_streaming()
+
+    def leave(self):
+        """
+        Unsubscribes from the hub of every camera and from the camera events.
+        """
+        if self.stop_events is not None:
+            self.stop_events()
+            self.stop_events = None
+        for subscription in self.subscriptions.values():
+            subscription.hub.unsubscribe(subscription.session.mailbox)
+        self.subscriptions = {}
+
+
+class RelayConsumer(StreamConsumer):
+    """
+    Relays the frames of a camera this node owns to another streaming node,
+    whose `RelayReader` feeds them to its own viewers.
+
+    Connections must carry `STREAM_RELAY_TOKEN` in the `X-Relay-Token`
+    header and are refused with code 4009 if the camera belongs to another
+    node, e.g. while nodes disagree after one joined. The `renditions` and
+    `fps` query parameters, then `{"type": "renditions", "ids": [...]}`,
+    `{"type": "fps", "fps": ...}` and `{"type": "refresh"}` messages, mirror
+    what the viewers of the other node ask for. Every binary message holds
+    all the renditions of one frame, packed by `protocol.pack_relay_frame`,
+    and the socket is closed normally once the stream has ended.
+    """
+
+    stream_kind = "relay"
+    hub = None
+
+    async def connect(self):
+        """
+        Called when a WebSocket connection is established.
+        """
+        self.cam_id = int(self.scope["url_route"]["kwargs"]["cam_id"])
+        headers = dict(self.scope.get("headers", []))
+        token = headers.get(RELAY_TOKEN_HEADER.lower().encode(), b"")
+        if not settings.STREAM_RELAY_TOKEN or not hmac.compare_digest(
+            token, settings.STREAM_RELAY_TOKEN.encode()
+        ):
+            await self.close(code=4001, reason="Unauthorized")
+            return
+        if node_cluster is not None and not node_cluster.is_local(self.cam_id):
+            await self.close(code=4009, reason="Not the owner of the camera")
+            return
+        try:
+            access = await get_camera_access(self.cam_id)
+        except Camera.DoesNotExist:
+            await self.close(code=4004, reason="Camera not found")
+            return
+        await self.accept()
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.mailbox = RelayMailbox()
+        self.renditions = frozenset()
+        self.rate = FrameRateController()
+        self.hub = get_hub(self.cam_id, access.stream_url, access.environment)
+        self.set_fps(query_number(query, "fps", settings.STREAM_MAX_FPS))
+        self.set_renditions(query.get("renditions", [""])[0].split(","))
+        self.start_streaming()
+
+    def set_renditions(self, ids: list) -> None:
+        """
+        Subscribes to the renditions the other node needs and leaves the
+        others.
+        """
+        renditions = frozenset(
+            RENDITIONS[int(id)]
+            for id in ids
+            if str(id).isdigit() and int(id) < len(RENDITIONS)
+        )
+        for rendition in self.renditions - renditions:
+            self.hub.unsubscribe(self.mailbox.slot(rendition))
+        for rendition in renditions - self.renditions:
+            self.hub.subscribe(self.mailbox.slot(rendition), rendition, self.rate)
+        self.renditions = renditions
+
+    def set_fps(self, fps: float) -> None:
+        """
+        Lets the owner decode as many frames per second as the fastest viewer
+        of the other node takes.
+        """
+        fps = min(fps, settings.STREAM_MAX_FPS)
+        self.rate = FrameRateController(fps, fps)
+        for rendition in self.renditions:
+            self.hub.subscribe(self.mailbox.slot(rendition), rendition, self.rate)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Called when the other node sends a message. Updates the renditions
+        and frame rate relayed.
+        """
+        try:
+            message = json.loads(text_data or "")
+        except ValueError:
+            return
+        if not isinstance(message, dict) or self.hub is None:
+            return
+        if message.get("type") == "renditions" and isinstance(
+            message.get("ids"), list
+        ):
+            self.set_renditions(message["ids"])
+        elif message.get("type") == "fps":
+            fps = message_fps(message)
+            if fps is not None:
+                self.set_fps(fps)
+        elif message.get("type") == "refresh":
+            self.hub.refresh()
+
+    async def stream(self):
+        """
+        Sends every frame of the camera as soon as the hub broadcasts it.
+        """
+        while (frames := await self.mailbox.get()) is not None:
+            await self.send(bytes_data=pack_relay_frame(frames))
+
+    def leave(self):
+        """
+        Unsubscribes every relayed rendition from the camera hub.
+        """
+        if self.hub is not None:
+            for rendition in self.renditions:
+                self.hub.unsubscribe(self.mailbox.slot(rendition))
+            self.hub = None
+
+
+def message_cameras(message: dict) -> list[int]:
+    """
+    Reads the camera IDs of a client message, ignoring invalid ones.
+    """
+    cams = message.get("cams")
+    if not isinstance(cams, list):
+        return []
+    return list(
+        dict.fromkeys(
+            int(cam_id)
+            for cam_id in cams[: settings.STREAM_MULTIPLEX_MAX_CAMERAS * 4]
+            if str(cam_id).isdigit()
+        )
+    )
+
+
+def message_camera(message: dict) -> int | None:
+    """
+    Reads the camera ID of a client message, or `None` if it has none or it
+    is invalid.
+    """
+    cam_id = message.get("cam_id")
+    if not str(cam_id).isdigit():
+        return None
+    return int(cam_id)
+
+
+def message_fps(message: dict) -> float | None:
+    """
+    Reads the frame rate limit of a client message, capped at
+    `STREAM_MAX_FPS`, or `None` if it has none or it is invalid.
+    """
+    try:
+        fps = float(message.get("fps"))
+    except (TypeError, ValueError):
+        return None
+    if not 0 < fps < float("inf"):
+        return None
+    return min(fps, settings.STREAM_MAX_FPS)
+
+
+def message_seq(message: dict) -> int | None:
+    """
+    Reads the sequence number a client message acknowledges, or `None` if
+    it has none or it is invalid.
+    """
+    seq = message.get("seq")
+    if isinstance(seq, int) and not isinstance(seq, bool) and 0 <= seq <= SEQ_MASK:
+        return seq
+    return None
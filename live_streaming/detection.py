@@ -0,0 +1,266 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import cv2 as cv
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+from .events import event_bus
+from .hub import CameraHub, running_hubs
+from .renditions import Rendition
+from .tasks import stream_tasks
+
+
+class Detection(NamedTuple):
+    """
+    An object found in a frame.
+
+    Attributes:
+        label (str): The name of the class, or its ID when no labels are set.
+        class_id (int): The class ID returned by the network.
+        score (float): The confidence of the network, between 0 and 1.
+        box (tuple[int, int, int, int]): The left, top, right and bottom
+            edges of the object, in pixels of the analysed frame.
+    """
+
+    label: str
+    class_id: int
+    score: float
+    box: tuple[int, int, int, int]
+
+    def as_dict(self) -> dict:
+        return {
+            "label": self.label,
+            "class_id": self.class_id,
+            "score": round(self.score, 3),
+            "box": list(self.box),
+        }
+
+
+class ThreatDetector:
+    """
+    Runs an SSD-style detection network, such as MobileNet-SSD, with the
+    OpenCV DNN module on the CPU.
+
+    Frames of several cameras go through the network in a single forward
+    pass. The network must return the usual `DetectionOutput` rows of
+    `[image_id, class_id, score, left, top, right, bottom]` with normalized
+    coordinates, where `image_id` is the index of the frame in the batch.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        config: str | None = None,
+        input_size: int = 300,
+        confidence: float = 0.5,
+        labels: list[str] | None = None,
+        scale: float = 1 / 127.5,
+        mean: float = 127.5,
+        swap_rb: bool = False,
+    ):
+        self.net = cv.dnn.readNet(model, config or "")
+        self.net.setPreferableBackend(cv.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
+        self.input_size = input_size
+        self.confidence = confidence
+        self.labels = labels or []
+        self.scale = scale
+        self.mean = mean
+        self.swap_rb = swap_rb
+
+    def label(self, class_id: int) -> str:
+        if 0 <= class_id < len(self.labels):
+            return self.labels[class_id]
+        return str(class_id)
+
+    def detect(self, images: list[np.ndarray]) -> list[list[Detection]]:
+        """
+        Finds objects in a batch of frames with a single forward pass.
+
+        Args:
+            images (list[np.ndarray]): The decoded BGR frames.
+
+        Returns:
+            list[list[Detection]]: The objects found in each frame, in order.
+        """
+        blob = cv.dnn.blobFromImages(
+            images,
+            self.scale,
+            (self.input_size, self.input_size),
+            (self.mean, self.mean, self.mean),
+            swapRB=self.swap_rb,
+        )
+        self.net.setInput(blob)
+        output = self.net.forward()
+        results = [[] for _ in images]
+        for image_id, class_id, score, *edges in output.reshape(-1, 7):
+            image_id = int(image_id)
+            if score < self.confidence or not 0 <= image_id < len(images):
+                continue
+            height, width = images[image_id].shape[:2]
+            left, top, right, bottom = np.clip(edges, 0, 1) * (width, height, width, height)
+            results[image_id].append(
+                Detection(
+                    self.label(int(class_id)),
+                    int(class_id),
+                    float(score),
+                    (int(left), int(top), int(right), int(bottom)),
+                )
+            )
+        return results
+
+
+def pick_rendition(available, input_size: int) -> Rendition:
+    """
+    Picks the smallest rendition at least as wide as the network input, or
+    the widest one when all of them are smaller.
+    """
+
+    def width(rendition: Rendition) -> float:
+        return rendition.max_width or float("inf")
+
+    wide_enough = [r for r in available if width(r) >= input_size]
+    if wide_enough:
+        return min(wide_enough, key=width)
+    return max(available, key=width)
+
+
+class DetectionPipeline:
+    """
+    Samples the newest frame of every running camera hub at
+    `STREAM_DETECTION_INTERVAL` and analyses them together.
+
+    Frames are taken from the renditions viewers already requested, so
+    sampling costs no extra capture or encode, and only cameras somebody is
+    watching or recording are analysed. At most `STREAM_DETECTION_MAX_BATCH`
+    cameras go into a batch, in turns when more are live. Inference runs on
+    a dedicated thread and every frame with detections publishes a
+    `detection` event on the `event_bus`.
+    """
+
+    def __init__(self, detector: ThreatDetector, interval: float, max_batch: int):
+        self.detector = detector
+        self.interval = interval
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detection")
+        self.task = None
+        self._seen: dict[int, int] = {}
+        self._turn = 0
+
+    def ensure_running(self, hub: CameraHub | None = None) -> None:
+        """
+        Starts the sampling task on the running event loop if it is not
+        running yet. Called whenever a hub is created.
+        """
+        if self.task is None or self.task.done():
+            self.task = stream_tasks.start(self.run(), "detection")
+
+    def take_frames(self) -> list[tuple[int, float, bytes]]:
+        """
+        Takes the newest unseen frame of up to `max_batch` running hubs.
+        """
+        hubs = [hub for hub in running_hubs() if hub.subscribers and hub.latest]
+        for cam_id in self._seen.keys() - {hub.cam_id for hub in hubs}:
+            del self._seen[cam_id]
+        if len(hubs) > self.max_batch:
+            self._turn = (self._turn + self.max_batch) % len(hubs)
+            hubs = (hubs[self._turn :] + hubs[: self._turn])[: self.max_batch]
+        frames = []
+        for hub in hubs:
+            if self._seen.get(hub.cam_id) == hub.seq:
+                continue
+            self._seen[hub.cam_id] = hub.seq
+            rendition = pick_rendition(hub.latest, self.detector.input_size)
+            frames.append((hub.cam_id, hub.latest_at, hub.latest[rendition]))
+        return frames
+
+    def analyse(
+        self, frames: list[tuple[int, float, bytes]]
+    ) -> list[tuple[int, float, list[Detection]]]:
+        """
+        Decodes a batch of frames and runs the detector on it. Blocking,
+        meant to run on the detection thread.
+        """
+        decoded = []
+        for cam_id, captured_at, frame_data in frames:
+            image = cv.imdecode(np.frombuffer(frame_data, np.uint8), cv.IMREAD_COLOR)
+            if image is not None:
+                decoded.append((cam_id, captured_at, image))
+        if not decoded:
+            return []
+        started = time.perf_counter()
+        results = self.detector.detect([image for _, _, image in decoded])
+        metrics.detection_seconds.labels().observe(time.perf_counter() - started)
+        return [
+            (cam_id, captured_at, detections)
+            for (cam_id, captured_at, _), detections in zip(decoded, results)
+        ]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        batch_size = metrics.detection_batch_size.labels()
+        # Stop with the last hub, the next hub to start wakes the pipeline up
+        while running_hubs():
+            await asyncio.sleep(self.interval)
+            frames = self.take_frames()
+            if not frames:
+                continue
+            batch_size.observe(len(frames))
+            results = await loop.run_in_executor(self.executor, self.analyse, frames)
+            for cam_id, captured_at, detections in results:
+                if not detections:
+                    continue
+                for detection in detections:
+                    metrics.detections.labels(cam_id, detection.label).inc()
+                event_bus.emit(
+                    cam_id,
+                    "detection",
+                    {"detections": [detection.as_dict() for detection in detections]},
+                    captured_at,
+                )
+
+
+def load_detection_pipeline() -> DetectionPipeline | None:
+    """
+    Builds the detection pipeline from the `STREAM_DETECTION_*` settings.
+
+    Returns:
+        DetectionPipeline | None: The pipeline, or `None` when
+        `STREAM_DETECTION_MODEL` is not set.
+    """
+    if not settings.STREAM_DETECTION_MODEL:
+        return None
+    detector = ThreatDetector(
+        settings.STREAM_DETECTION_MODEL,
+        settings.STREAM_DETECTION_CONFIG,
+        input_size=settings.STREAM_DETECTION_INPUT_SIZE,
+        confidence=settings.STREAM_DETECTION_CONFIDENCE,
+        labels=settings.STREAM_DETECTION_LABELS,
+        scale=settings.STREAM_DETECTION_SCALE,
+        mean=settings.STREAM_DETECTION_MEAN,
+        swap_rb=settings.STREAM_DETECTION_SWAP_RB,
+    )
+    return DetectionPipeline(
+        detector,
+        settings.STREAM_DETECTION_INTERVAL,
+        settings.STREAM_DETECTION_MAX_BATCH,
+    )
+
+
+_pipeline: DetectionPipeline | None = None
+
+
+def start_detection(hub: CameraHub) -> None:
+    """
+    Wakes the detection pipeline up when a hub starts, building it on first
+    use so the network is only loaded by processes serving streams.
+    """
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = load_detection_pipeline()
+    if _pipeline is not None:
+        _pipeline.ensure_running(hub)
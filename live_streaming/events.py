@@ -0,0 +1,72 @@
+import threading
+import time
+from typing import Callable, NamedTuple
+
+
+class CameraEvent(NamedTuple):
+    """
+    Something noticed on a camera, such as motion or a detected object.
+
+    Attributes:
+        cam_id (int): The ID of the camera.
+        kind (str): The kind of event, e.g. `motion` or `detection`.
+        occurred_at (float): The capture time of the frame, as a Unix timestamp.
+        data (dict): The details of the event, JSON-serializable.
+    """
+
+    cam_id: int
+    kind: str
+    occurred_at: float
+    data: dict
+
+
+class EventBus:
+    """
+    Delivers camera events to every listener of the process.
+
+    Listeners are called synchronously by `publish`, from the thread that
+    published the event, so they must only hand the event over, e.g. to a
+    queue, and never block.
+    """
+
+    def __init__(self):
+        self.listeners: list[Callable[[CameraEvent], None]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, listener: Callable[[CameraEvent], None]) -> Callable[[], None]:
+        """
+        Registers a listener.
+
+        Returns:
+            Callable[[], None]: Unregisters the listener when called.
+        """
+        with self._lock:
+            self.listeners = [*self.listeners, listener]
+
+        def unsubscribe():
+            with self._lock:
+                self.listeners = [
+                    existing for existing in self.listeners if existing is not listener
+                ]
+
+        return unsubscribe
+
+    def publish(self, event: CameraEvent) -> None:
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as exc:
+                print(f"Camera event listener failed: {exc!r}")
+
+    def emit(
+        self, cam_id: int, kind: str, data: dict, occurred_at: float | None = None
+    ) -> CameraEvent:
+        """
+        Builds and publishes an event.
+        """
+        event = CameraEvent(cam_id, kind, occurred_at or time.time(), data)
+        self.publish(event)
+        return event
+
+
+event_bus = EventBus()
@@ -0,0 +1,315 @@
+import asyncio
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+
+class LatestFrame:
+    """
+    Single-slot mailbox holding only the newest frame for one viewer.
+
+    Putting a frame while the previous one has not been taken yet replaces it
+    and counts the replaced frame as dropped, so a slow viewer never builds up
+    a backlog of stale frames. The metadata of the last frame taken is kept
+    in `info`.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.frame_info = None
+        self.info = None
+        self.closed = False
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def put(self, frame_data: bytes | None, info=None) -> None:
+        """
+        Stores a frame, replacing any frame that is still pending.
+
+        Args:
+            frame_data (bytes | None): The encoded frame, or `None` to signal
+            the end of the stream.
+            info (FrameInfo | None): The metadata of the frame.
+        """
+        if frame_data is None:
+            self.closed = True
+        else:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame_data
+            self.frame_info = info
+        self._ready.set()
+
+    async def get(self) -> bytes | None:
+        """
+        Waits for the next frame.
+
+        Returns:
+            bytes | None: The newest frame, or `None` once the stream has ended.
+        """
+        await self._ready.wait()
+        return self.take()
+
+    def take(self) -> bytes | None:
+        """
+        Takes the pending frame without waiting.
+
+        Returns:
+            bytes | None: The newest frame, or `None` if there is none pending.
+        """
+        frame_data, self.frame = self.frame, None
+        if frame_data is not None:
+            self.info = self.frame_info
+        if not self.closed:
+            self._ready.clear()
+        return frame_data
+
+
+class FrameRateController:
+    """
+    Adapts the frame rate of one viewer to how fast it acknowledges frames.
+
+    Sending a frame only queues it in the server's transport buffer, so the
+    time spent sending says nothing about the client. Clients acknowledge
+    the frames they received instead: the target frame rate creeps up
+    additively with every acknowledgement and backs off multiplicatively
+    whenever the window of unacknowledged frames is full. Viewers that
+    never acknowledge stay at the initial frame rate.
+    """
+
+    def __init__(
+        self,
+        min_fps: float | None = None,
+        max_fps: float | None = None,
+        initial_fps: float | None = None,
+    ):
+        self.min_fps = min_fps or settings.STREAM_MIN_FPS
+        self.max_fps = max_fps or settings.STREAM_MAX_FPS
+        self.fps = min(
+            max(initial_fps or settings.STREAM_INITIAL_FPS, self.min_fps),
+            self.max_fps,
+        )
+        self.round_trip = 0.0
+
+    @property
+    def interval(self) -> float:
+        """
+        Returns the time budget for a single frame, in seconds.
+        """
+        return 1 / self.fps
+
+    def acked(self, round_trip: float) -> None:
+        """
+        Raises the target frame rate after the client acknowledged a frame.
+
+        Args:
+            round_trip (float): The time from sending the frame to receiving
+                its acknowledgement, in seconds.
+        """
+        # Smoothed for the stats of the session
+        self.round_trip = 0.8 * self.round_trip + 0.2 * round_trip
+        self.fps = min(self.max_fps, self.fps + 0.5)
+
+    def stalled(self) -> None:
+        """
+        Cuts the target frame rate when the client has too many frames left
+        to acknowledge.
+        """
+        self.fps = max(self.min_fps, self.fps * 0.75)
+
+    def limit(self, max_fps: float) -> None:
+        """
+        Caps the frame rate, e.g. at the rate a client asked for.
+
+        Args:
+            max_fps (float): The highest frame rate allowed from now on.
+        """
+        self.max_fps = max_fps
+        self.min_fps = min(self.min_fps, max_fps)
+        self.fps = min(self.fps, max_fps)
+
+
+class LatencyWindow:
+    """
+    Keeps the most recent latencies of a viewer to report percentiles.
+    """
+
+    def __init__(self, size: int = 256):
+        self.samples = deque(maxlen=size)
+
+    def add(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def percentiles(self, *ranks: float) -> dict[str, float]:
+        """
+        Returns the given percentiles of the window, in milliseconds.
+
+        Args:
+            ranks (float): The percentiles to compute, e.g. 50 and 99.
+
+        Returns:
+            dict[str, float]: The latency of each percentile, keyed `p<rank>`.
+        """
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {}
+        return {
+            f"p{rank:g}": round(
+                ordered[min(len(ordered) - 1, int(rank / 100 * len(ordered)))] * 1000, 2
+            )
+            for rank in ranks
+        }
+
+
+class StreamSession:
+    """
+    Flow-control state of one viewer: its mailbox, frame rate and counters.
+
+    Frames are paced by the client's acknowledgements: at most
+    `STREAM_ACK_WINDOW` frames may be sent and not yet acknowledged, beyond
+    which the session waits for an acknowledgement and cuts its frame rate.
+    Acknowledgements that do not come within `STREAM_ACK_TIMEOUT` seconds
+    are given up on, at the lowest frame rate. Until its first
+    acknowledgement the client is assumed not to send any and gets the
+    initial frame rate, as HTTP viewers do.
+
+    The counters are also added to the `metrics` of the camera and endpoint
+    the session streams from.
+
+    Args:
+        camera (str): The metrics label of the streamed camera.
+        endpoint (str): The metrics label of the transport, e.g. `websocket`.
+        mailbox: Where the frames of the viewer wait to be sent, a new
+            `LatestFrame` by default.
+    """
+
+    def __init__(self, camera: str = "", endpoint: str = "websocket", mailbox=None):
+        self.mailbox = LatestFrame() if mailbox is None else mailbox
+        self.rate = FrameRateController()
+        self.window = settings.STREAM_ACK_WINDOW
+        self.acking = False
+        self.in_flight: deque[tuple[int | None, float]] = deque(maxlen=64)
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.started_at = time.monotonic()
+        self.frame_age = LatencyWindow()
+        self._acked = asyncio.Event()
+        self._last_sent_at = 0.0
+        self._reported_dropped = 0
+        self._frames_metric = metrics.frames_sent.labels(camera, endpoint)
+        self._bytes_metric = metrics.bytes_sent.labels(camera, endpoint)
+        self._dropped_metric = metrics.frames_dropped.labels(camera, endpoint)
+        self._send_metric = metrics.send_seconds.labels(camera, endpoint)
+        self._age_metric = metrics.frame_age_seconds.labels(camera, endpoint)
+
+    @property
+    def frames_dropped(self) -> int:
+        return self.mailbox.dropped
+
+    async def next_frame(self) -> bytes | None:
+        """
+        Waits until the viewer is due for a frame and returns the newest one.
+
+        Frames replaced in the mailbox while waiting are counted as dropped.
+
+        Returns:
+            bytes | None: The frame to send, or `None` once the stream has ended.
+        """
+        await self.wait_turn()
+        return await self.mailbox.get()
+
+    async def wait_turn(self) -> None:
+        """
+        Waits until the viewer is due for its next frame and has room for it
+        in its window of unacknowledged frames.
+        """
+        delay = self._last_sent_at + self.rate.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if not self.acking or len(self.in_flight) < self.window:
+            return
+        self.rate.stalled()
+        while len(self.in_flight) >= self.window:
+            self._acked.clear()
+            try:
+                await asyncio.wait_for(
+                    self._acked.wait(), settings.STREAM_ACK_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                self.in_flight.clear()
+                self.rate.fps = self.rate.min_fps
+
+    def frame_sent(
+        self,
+        size: int,
+        send_latency: float,
+        captured_at: float | None = None,
+        seq: int | None = None,
+    ) -> None:
+        """
+        Records a frame delivered to the viewer.
+
+        Args:
+            size (int): The size of the frame, in bytes.
+            send_latency (float): The time spent sending the frame, in seconds.
+            captured_at (float | None): The capture time of the frame, as a
+                Unix timestamp, to track how old frames are once sent.
+            seq (int | None): The sequence number the client acknowledges
+                the frame with, if it has one.
+        """
+        if captured_at:
+            age = time.time() - captured_at
+            self.frame_age.add(age)
+            self._age_metric.observe(age)
+        self._last_sent_at = time.monotonic() - send_latency
+        self.in_flight.append((seq, time.monotonic()))
+        self.frames_sent += 1
+        self.bytes_sent += size
+        self._frames_metric.inc()
+        self._bytes_metric.inc(size)
+        self._send_metric.observe(send_latency)
+        dropped = self.frames_dropped
+        if dropped != self._reported_dropped:
+            self._dropped_metric.inc(dropped - self._reported_dropped)
+            self._reported_dropped = dropped
+
+    def ack(self, seq: int | None = None) -> None:
+        """
+        Records an acknowledgement from the client.
+
+        Args:
+            seq (int | None): The sequence number of the frame acknowledged,
+                which also acknowledges every frame sent before it, or `None`
+                to acknowledge the oldest frame only.
+        """
+        if seq is not None and all(sent != seq for sent, _ in self.in_flight):
+            # Unknown or already acknowledged
+            return
+        sent_at = None
+        while self.in_flight:
+            sent, sent_at = self.in_flight.popleft()
+            if seq is None or sent == seq:
+                break
+        if sent_at is None:
+            return
+        self.acking = True
+        self.rate.acked(time.monotonic() - sent_at)
+        self._acked.set()
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the session.
+        """
+        return {
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "bytes_sent": self.bytes_sent,
+            "target_fps": round(self.rate.fps, 2),
+            "frames_in_flight": len(self.in_flight),
+            "round_trip_ms": round(self.rate.round_trip * 1000, 2),
+            "frame_age_ms": self.frame_age.percentiles(50, 90, 99),
+            "uptime": round(time.monotonic() - self.started_at, 2),
+        }
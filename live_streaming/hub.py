@@ -0,0 +1,439 @@
+import asyncio
+import math
+import time
+from typing import Callable
+
+from django.conf import settings
+
+from . import metrics
+from .capture import CaptureReader
+from .flow import FrameRateController, LatestFrame
+from .motion import motion_gate_for
+from .protocol import FrameInfo
+from .relay import RelayReader
+from .renditions import Rendition
+from .sharding import node_cluster
+from .workers import get_worker_pool
+
+
+class CameraHub:
+    """
+    Shares a single capture of a camera between every viewer subscribed to it.
+
+    The hub runs one `CaptureReader` thread for the camera, or reads from a
+    capture worker process when `STREAM_CAPTURE_WORKERS` is set. The source
+    encodes each frame once per rendition requested by at least one viewer,
+    and the hub broadcasts the same bytes to the mailbox of every subscriber
+    of that rendition, along with a `FrameInfo` numbering the frame. It is
+    reference-counted through its subscribers and stops once the last one
+    unsubscribes, after a warm standby of `STREAM_WARM_GRACE_SECONDS` during
+    which the camera connection is kept open so viewers coming back after a
+    page refresh get frames instantly.
+
+    Cameras in an environment listed in `STREAM_MOTION_GATE_ENVIRONMENTS`
+    get their unchanged frames suppressed.
+
+    When cameras are sharded across nodes, only the hub on the node owning
+    the camera captures it, the hubs of other nodes relay its frames from
+    the owner. `source_node` is the node the frames come from, and
+    `switch_source` moves a running hub to another source without
+    interrupting its viewers once the camera changed owner.
+
+    The source only decodes as many frames per second as the fastest
+    subscriber is due for, from the `FrameRateController` each subscriber
+    paces itself with.
+
+    The hub reports whether the camera is `idle`, `warming` or `live` through
+    `status`.
+    """
+
+    def __init__(self, cam_id: int, cam_url: str, environment: str | None = None):
+        self.cam_id = cam_id
+        self.cam_url = cam_url
+        self.environment = environment
+        self.subscribers: dict[LatestFrame, Rendition] = {}
+        self.renditions: frozenset[Rendition] = frozenset()
+        self.rates: dict[LatestFrame, FrameRateController | None] = {}
+        self.fps = settings.STREAM_MAX_FPS
+        self.latest: dict[Rendition, bytes | memoryview] = {}
+        self.latest_at: float | None = None
+        self.seq = 0
+        self.source_node: str | None = None
+        self._task = None
+        self._reader = None
+        self._frames = None
+        self._loop = None
+        self._linger = None
+
+    def subscribe(
+        self,
+        mailbox: LatestFrame,
+        rendition: Rendition,
+        rate: FrameRateController | None = None,
+    ) -> None:
+        """
+        Registers a new viewer and starts the capture if it is not running yet.
+
+        Args:
+            mailbox (LatestFrame): The mailbox the viewer receives frames from.
+            rendition (Rendition): The rendition the viewer wants to receive.
+            rate (FrameRateController | None): The frame rate the viewer takes
+                frames at, `STREAM_MAX_FPS` if not given.
+        """
+        if self._linger is not None:
+            self._linger.cancel()
+            self._linger = None
+        self.subscribers[mailbox] = rendition
+        self.rates[mailbox] = rate
+        self._update_renditions()
+        # Let the new viewer see the scene without waiting for motion
+        self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def unsubscribe(self, mailbox: LatestFrame) -> None:
+        """
+        Removes a viewer and stops the capture once no viewers are left and
+        the warm standby has run out.
+
+        Args:
+            mailbox (LatestFrame): The mailbox passed to `subscribe`.
+        """
+        self.subscribers.pop(mailbox, None)
+        self.rates.pop(mailbox, None)
+        self._update_renditions()
+        if self.subscribers or self._linger is not None:
+            return
+        if settings.STREAM_WARM_GRACE_SECONDS > 0 and self._task is not None:
+            self._linger = asyncio.get_running_loop().call_later(
+                settings.STREAM_WARM_GRACE_SECONDS, self.stop
+            )
+        else:
+            self.stop()
+
+    @property
+    def status(self) -> str:
+        """
+        Returns `idle` while nobody is subscribed, `warming` while the capture
+        is starting or reconnecting, and `live` while frames are delivered.
+        """
+        if not self.subscribers or self._task is None:
+            return "idle"
+        # Motion-gated cameras only send a keepalive frame while nothing moves
+        stale_after = settings.STREAM_READ_TIMEOUT + settings.STREAM_MOTION_KEEPALIVE
+        if self.latest_at is None or time.time() - self.latest_at > stale_after:
+            return "warming"
+        return "live"
+
+    def _update_renditions(self) -> None:
+        """
+        Recomputes the set of renditions the capture thread has to encode.
+        """
+        self.renditions = frozenset(self.subscribers.values())
+        if self._reader is not None:
+            self._reader.renditions = self.renditions
+        self._update_fps()
+
+    def _update_fps(self) -> None:
+        """
+        Lets the capture decode as many frames per second as the fastest
+        subscriber takes, rounded up to a whole frame rate so adapting
+        viewers do not update the capture on every frame.
+        """
+        fps = min(
+            settings.STREAM_MAX_FPS,
+            math.ceil(
+                max(
+                    (
+                        settings.STREAM_MAX_FPS if rate is None else rate.fps
+                        for rate in self.rates.values()
+                    ),
+                    default=settings.STREAM_MAX_FPS,
+                )
+            ),
+        )
+        if fps != self.fps:
+            self.fps = fps
+            if self._reader is not None:
+                self._reader.fps = fps
+
+    def stop(self) -> None:
+        """
+        Cancels the broadcast task, which stops the capture thread, and removes
+        the hub from the registry.
+        """
+        if self._linger is not None:
+            self._linger.cancel()
+            self._linger = None
+        if _hubs.get(self.cam_id) is self:
+            del _hubs[self.cam_id]
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def broadcast(
+        self,
+        encoded: dict[Rendition, bytes | memoryview] | None,
+        captured_at: float | None = None,
+        encoded_at: float | None = None,
+    ) -> None:
+        """
+        Pushes a frame to every subscriber. Viewers that have not taken the
+        previous frame yet get it replaced by this one.
+
+        Args:
+            encoded (dict[Rendition, bytes | memoryview] | None): The frame
+            encoded once per rendition, or `None` to signal the end of the
+            stream.
+            captured_at (float | None): The capture time of the frame.
+            encoded_at (float | None): The time the frame was encoded.
+        """
+        if encoded is None:
+            for mailbox in self.subscribers:
+                mailbox.put(None)
+            return
+        now = time.time()
+        self.seq += 1
+        self.latest = encoded
+        self.latest_at = captured_at or now
+        infos = {
+            rendition: FrameInfo(
+                self.cam_id, self.seq, self.latest_at, encoded_at or now, rendition.id
+            )
+            for rendition in encoded
+        }
+        for mailbox, rendition in self.subscribers.items():
+            if rendition in encoded:
+                mailbox.put(encoded[rendition], infos[rendition])
+        self._update_fps()
+
+    def hand_over(
+        self,
+        encoded: dict[Rendition, bytes | memoryview] | None,
+        captured_at: float | None = None,
+        encoded_at: float | None = None,
+    ) -> None:
+        """
+        Hands a frame over to the event loop. Called from the capture thread.
+
+        Args:
+            encoded (dict[Rendition, bytes | memoryview] | None): The frame
+            encoded once per rendition, or `None` to signal the end of the
+            stream.
+            captured_at (float | None): The capture time of the frame.
+            encoded_at (float | None): The time the frame was encoded.
+        """
+        frame = None if encoded is None else (encoded, captured_at, encoded_at)
+        try:
+            self._loop.call_soon_threadsafe(self._put_latest, frame)
+        except RuntimeError:
+            # The event loop has been closed, nobody is left to receive frames
+            pass
+
+    def _put_latest(self, frame: tuple | None) -> None:
+        """
+        Queues a frame on the event loop, replacing the pending one if it has
+        not been broadcast yet so the queue never holds stale frames.
+        """
+        if self._frames.full():
+            self._frames.get_nowait()
+        self._frames.put_nowait(frame)
+
+    def refresh(self) -> None:
+        """
+        Makes the next frame go through even if the motion gate would skip it.
+        """
+        if self._reader is not None:
+            self._reader.refresh()
+
+    def open_source(self):
+        """
+        Creates the reader producing the frames of the camera: a relay from
+        the node owning the camera, or a capture on a thread of this process
+        or in a capture worker process.
+        """
+        self.source_node = None
+        if node_cluster is not None:
+            owner = node_cluster.owner(self.cam_id)
+            if owner != node_cluster.name and owner in node_cluster.urls:
+                self.source_node = owner
+                return RelayReader(
+                    self.cam_id, node_cluster.urls[owner], self.hand_over
+                )
+            self.source_node = node_cluster.name
+        pool = get_worker_pool()
+        if pool is not None:
+            return pool.open(self.cam_id, self.cam_url, self.environment, self.hand_over)
+        return CaptureReader(
+            self.cam_id,
+            self.cam_url,
+            self.hand_over,
+            motion_gate=motion_gate_for(self.environment),
+        )
+
+    def _start_reader(self) -> None:
+        self._reader.renditions = self.renditions
+        self._reader.fps = self.fps
+        self._reader.start()
+
+    def switch_source(self) -> None:
+        """
+        Replaces the source of a running hub with the one `open_source`
+        picks now, e.g. once the camera moved to another node, keeping the
+        viewers subscribed. Frames of the previous source are dropped from
+        then on.
+        """
+        if self._reader is None:
+            return
+        previous, self._reader = self._reader, self.open_source()
+        previous.on_frame = discard_frame
+        previous.stop()
+        self._start_reader()
+
+    async def run(self):
+        """
+        Starts the capture source and broadcasts every frame it hands back.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._frames = asyncio.Queue(maxsize=1)
+        self._reader = self.open_source()
+        self._start_reader()
+        try:
+            while True:
+                frame = await self._frames.get()
+                if frame is None:
+                    break
+                self.broadcast(*frame)
+        finally:
+            self._reader.stop()
+            self._reader = None
+
+        # The source has ended, let every viewer know and forget the hub
+        self._task = None
+        self.broadcast(None)
+        self.stop()
+
+
+def discard_frame(*args) -> None:
+    """
+    Frame callback of sources replaced by `CameraHub.switch_source`.
+    """
+
+
+_hubs: dict[int, CameraHub] = {}
+
+# Called with every new hub, e.g. to wake up the analysis of running cameras
+hub_started: list[Callable[[CameraHub], None]] = []
+
+
+def count_viewers() -> dict[tuple, int]:
+    """
+    Returns the number of subscribers of every running hub, for `metrics`.
+    """
+    return {(cam_id,): len(hub.subscribers) for cam_id, hub in list(_hubs.items())}
+
+
+def count_statuses() -> dict[tuple, int]:
+    """
+    Returns the number of running hubs in each status, for `metrics`.
+    """
+    counts = {("warming",): 0, ("live",): 0, ("idle",): 0}
+    for hub in list(_hubs.values()):
+        counts[(hub.status,)] += 1
+    return counts
+
+
+metrics.viewers.set_function(count_viewers)
+metrics.cameras.set_function(count_statuses)
+
+
+def running_hubs() -> list[CameraHub]:
+    """
+    Returns every running hub of the process.
+    """
+    return list(_hubs.values())
+
+
+def find_hub(cam_id: int) -> CameraHub | None:
+    """
+    Returns the running hub for a camera without starting one. Safe to call
+    from any thread.
+
+    Args:
+        cam_id (int): The ID of the camera.
+
+    Returns:
+        CameraHub | None: The hub, or `None` if nobody is watching the camera.
+    """
+    return _hubs.get(cam_id)
+
+
+def stop_all_hubs() -> None:
+    """
+    Stops every running hub, releasing all cameras of the process.
+    """
+    for hub in list(_hubs.values()):
+        hub.stop()
+
+
+def camera_status(cam_id: int) -> dict:
+    """
+    Returns the streaming status of a camera in this process. Safe to call
+    from any thread.
+
+    Args:
+        cam_id (int): The ID of the camera.
+
+    Returns:
+        dict: The `status` of the camera (`idle`, `warming` or `live`), its
+        number of `viewers` and the capture time of its `last_frame_at`.
+    """
+    hub = find_hub(cam_id)
+    if hub is None:
+        return {"status": "idle", "viewers": 0, "last_frame_at": None}
+    return {
+        "status": hub.status,
+        "viewers": len(hub.subscribers),
+        "last_frame_at": hub.latest_at,
+    }
+
+
+def get_hub(cam_id: int, cam_url: str, environment: str | None = None) -> CameraHub:
+    """
+    Returns the running hub for a camera, creating it if needed.
+
+    Args:
+        cam_id (int): The ID of the camera.
+        cam_url (str): The stream URL of the camera.
+        environment (str | None): The environment of the camera, used to
+            decide whether unchanged frames are suppressed.
+
+    Returns:
+        CameraHub: The hub shared by every viewer of the camera.
+    """
+    hub = _hubs.get(cam_id)
+    if hub is None:
+        hub = _hubs[cam_id] = CameraHub(cam_id, cam_url, environment)
+        for callback in hub_started:
+            callback(hub)
+    return hub
+
+
+def rebalance_hubs() -> None:
+    """
+    Moves every running hub whose camera changed owner to its new source,
+    once nodes joined or left. Called from the heartbeat thread of the
+    `node_cluster`, so only the cameras whose owner changed move.
+    """
+    for hub in running_hubs():
+        if hub._loop is None or hub.source_node == node_cluster.owner(hub.cam_id):
+            continue
+        try:
+            hub._loop.call_soon_threadsafe(hub.switch_source)
+        except RuntimeError:
+            # The event loop has been closed
+            pass
+
+
+if node_cluster is not None:
+    node_cluster.changed.append(rebalance_hubs)
@@ -0,0 +1,163 @@
+import json
+import time
+import tracemalloc
+
+import cv2 as cv
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from live_streaming.protocol import FrameInfo, pack_frame
+from live_streaming.renditions import RenditionEncoder, select_rendition
+from live_streaming.synthetic import open_video
+
+# Allocations at least this large are counted as frame buffers
+LARGE_ALLOCATION = 4096
+
+
+class CopyingLoop:
+    """
+    The frame loop as it was: a new frame from every `read`, a new
+    downscaled frame per rendition and a `bytes` copy of every JPEG.
+
+    Every step returns what it allocated, so allocations freed before the
+    end of the frame are counted as well.
+    """
+
+    def __init__(self, camera, renditions):
+        self.camera = camera
+        self.renditions = renditions
+
+    def step(self, info: FrameInfo) -> list:
+        success, frame = self.camera.read()
+        if not success:
+            raise CommandError("The source did not deliver a frame")
+        allocated = [frame]
+        for rendition in self.renditions:
+            height, width = frame.shape[:2]
+            max_width = rendition.max_width
+            scaled = frame
+            if max_width and width > max_width:
+                size = (max_width, round(height * max_width / width))
+                scaled = cv.resize(frame, size, interpolation=cv.INTER_AREA)
+                allocated.append(scaled)
+            _, buffer = cv.imencode(
+                ".jpg", scaled, [cv.IMWRITE_JPEG_QUALITY, rendition.jpeg_quality]
+            )
+            frame_data = buffer.tobytes()
+            allocated += [buffer, frame_data, pack_frame(info, frame_data)]
+        return allocated
+
+
+class ReusingLoop:
+    """
+    The frame loop of `CaptureReader`: frames decoded into the same buffer,
+    downscaled and encoded by a `RenditionEncoder`.
+    """
+
+    def __init__(self, camera, renditions):
+        self.camera = camera
+        self.renditions = renditions
+        self.encoder = RenditionEncoder()
+        self.frame_buffer = None
+
+    def step(self, info: FrameInfo) -> list:
+        success, frame = self.camera.read(self.frame_buffer)
+        if not success:
+            raise CommandError("The source did not deliver a frame")
+        self.frame_buffer = frame
+        allocated = [frame]
+        for rendition in self.renditions:
+            frame_data = self.encoder.encode(frame, rendition)
+            allocated += [frame_data, pack_frame(info, frame_data)]
+        return allocated
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the memory allocated per frame by the capture loop, copying "
+        "frames as it used to and reusing buffers as it does now"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            default="synthetic://3840x2160?fps=1000&pattern=bars",
+            help="Stream URL read, 8MP color bars by default",
+        )
+        parser.add_argument("--frames", type=int, default=30, help="Frames measured")
+        parser.add_argument(
+            "--widths",
+            default="source,640",
+            help="Comma-separated rendition widths encoded, `source` for full size",
+        )
+        parser.add_argument("--quality", default="medium", help="Rendition quality")
+        parser.add_argument("--json", action="store_true", help="Print JSON")
+
+    def handle(self, *args, **options):
+        settings.STREAM_SYNTHETIC_CAMERAS = True
+        renditions = [
+            select_rendition(
+                None if width.strip() == "source" else int(width), options["quality"]
+            )
+            for width in options["widths"].split(",")
+        ]
+        report = {
+            name: self.measure(loop, options["source"], renditions, options["frames"])
+            for name, loop in (("copying", CopyingLoop), ("reusing", ReusingLoop))
+        }
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(
+            f"{'loop':>8} {'allocations':>12} {'MB/frame':>9} {'ms/frame':>9}"
+        )
+        for name, row in report.items():
+            self.stdout.write(
+                f"{name:>8} {row['allocations']:>12} {row['mb_per_frame']:>9} "
+                f"{row['ms_per_frame']:>9}"
+            )
+
+    def measure(self, loop_class, source: str, renditions: list, frames: int) -> dict:
+        """
+        Runs a frame loop over `frames` frames of `source`.
+
+        Allocations are traced during each frame only, while what it
+        allocated is still referenced, so the buffers reused across frames
+        are not counted and the ones allocated anew are.
+
+        Returns:
+            dict: The large allocations and the megabytes allocated per frame,
+            and the time per frame measured without tracing.
+        """
+        camera = open_video(source)
+        if not camera.isOpened():
+            raise CommandError(f"Could not open {source}")
+        loop = loop_class(camera, renditions)
+        info = FrameInfo(0, 0, time.time(), time.time(), renditions[0].id)
+        try:
+            # Lets the reusing loop allocate its buffers before measuring
+            loop.step(info)
+            allocations = allocated = 0
+            for _ in range(frames):
+                tracemalloc.start()
+                # Keeps the frame referenced until the snapshot is taken, so
+                # what it allocated is still traced
+                result = loop.step(info)
+                allocations += sum(
+                    trace.size >= LARGE_ALLOCATION
+                    for trace in tracemalloc.take_snapshot().traces
+                )
+                allocated += tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                del result
+            started = time.perf_counter()
+            for _ in range(frames):
+                loop.step(info)
+            elapsed = time.perf_counter() - started
+        finally:
+            camera.release()
+        return {
+            "allocations": round(allocations / frames, 1),
+            "mb_per_frame": round(allocated / frames / 2**20, 2),
+            "ms_per_frame": round(elapsed / frames * 1000, 2),
+        }
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from live_streaming.recording import prune_recordings
+
+
+class Command(BaseCommand):
+    help = "Delete recorded segments older than the retention of their camera"
+
+    def handle(self, *args, **kwargs):
+        deleted = prune_recordings()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} segments"))
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+
+from live_streaming.models import RecordingPolicy
+from live_streaming.recording import CameraRecorder, prune_recordings
+
+
+@database_sync_to_async
+def get_active_cameras() -> dict[int, tuple[str, str]]:
+    """
+    Returns the URL and environment of every camera that should be recording
+    right now, by ID.
+    """
+    policies = RecordingPolicy.objects.exclude(mode="off").select_related("camera")
+    return {
+        policy.camera_id: (policy.camera.stream_url, policy.camera.environment)
+        for policy in policies
+        if policy.is_active()
+    }
+
+
+class Command(BaseCommand):
+    help = "Record every camera with an active recording policy and prune old recordings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=30,
+            help="Seconds between two checks of the recording policies",
+        )
+        parser.add_argument(
+            "--prune-interval",
+            type=float,
+            default=3600,
+            help="Seconds between two prunings of expired recordings",
+        )
+
+    def handle(self, *args, **kwargs):
+        try:
+            asyncio.run(self.record(kwargs["poll_interval"], kwargs["prune_interval"]))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("Recording stopped"))
+
+    async def record(self, poll_interval: float, prune_interval: float):
+        recorders: dict[int, asyncio.Task] = {}
+        pruned_at = 0.0
+        try:
+            while True:
+                active = await get_active_cameras()
+                for cam_id, task in list(recorders.items()):
+                    if cam_id not in active or task.done():
+                        task.cancel()
+                        del recorders[cam_id]
+                for cam_id, (cam_url, environment) in active.items():
+                    if cam_id not in recorders:
+                        recorder = CameraRecorder(cam_id, cam_url, environment)
+                        recorders[cam_id] = asyncio.create_task(recorder.run())
+                if time.monotonic() - pruned_at >= prune_interval:
+                    deleted = await database_sync_to_async(prune_recordings)()
+                    pruned_at = time.monotonic()
+                    print(f"Pruned {deleted} recorded segments")
+                await asyncio.sleep(poll_interval)
+        finally:
+            for task in recorders.values():
+                task.cancel()
+            await asyncio.gather(*recorders.values(), return_exceptions=True)
@@ -0,0 +1,302 @@
+import asyncio
+import json
+import os
+import resource
+import time
+from urllib.parse import urlencode
+
+import numpy as np
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from live_streaming.access import CameraAccess, camera_access_cache
+from live_streaming.protocol import SUBPROTOCOL, unpack_frame
+from live_streaming.routing import websocket_urlpatterns
+from live_streaming.tasks import stream_tasks
+from live_streaming.workers import get_worker_pool
+from user_authentication.models import User
+
+# IDs given to the simulated cameras and their owner, which never reach the
+# database; the access cache answers for them
+FIRST_CAMERA_ID = 900_000_000
+OWNER_ID = 0
+
+
+def resident_memory(pid: int | str = "self") -> int:
+    """
+    Returns the resident memory of a process in bytes, or 0 if unknown.
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def cpu_seconds(pid: int | None = None) -> float:
+    """
+    Returns the CPU time used so far by this process, or by another process
+    when `pid` is given, or 0 if unknown.
+    """
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # Fields after the command name, which may contain spaces
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def usage() -> tuple[float, int]:
+    """
+    Returns the CPU time and resident memory of this process and its
+    capture workers.
+    """
+    pids = [None]
+    pool = get_worker_pool()
+    if pool is not None:
+        pids += [worker.process.pid for worker in pool.workers]
+    return (
+        sum(cpu_seconds(pid) for pid in pids),
+        sum(resident_memory(pid or "self") for pid in pids),
+    )
+
+
+class ViewerStats:
+    """
+    What one simulated viewer received after the warm-up.
+    """
+
+    def __init__(self, cam_id: int):
+        self.cam_id = cam_id
+        self.connected = False
+        self.frames = 0
+        self.bytes = 0
+        self.latencies: list[float] = []
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream synthetic cameras to simulated WebSocket viewers in-process and "
+        "report the frame rate, capture-to-receipt latency, CPU and memory"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cameras", type=int, default=4, help="Cameras streamed")
+        parser.add_argument(
+            "--viewers", type=int, default=4, help="Viewers of each camera"
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10, help="Seconds measured"
+        )
+        parser.add_argument(
+            "--warmup",
+            type=float,
+            default=2,
+            help="Seconds streamed before measuring, while the cameras start",
+        )
+        parser.add_argument(
+            "--source",
+            default="synthetic://1280x720?fps=30&pattern=bars",
+            help="Stream URL of every camera, e.g. synthetic:///path/to/video.mp4",
+        )
+        parser.add_argument(
+            "--environment",
+            default="outdoor",
+            help="Environment of the cameras, indoor ones go through the motion gate",
+        )
+        parser.add_argument("--max-width", type=int, help="Rendition width requested")
+        parser.add_argument("--quality", help="Rendition quality requested")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.STREAM_CAPTURE_WORKERS,
+            help="Capture worker processes, 0 captures on threads",
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON")
+
+    def handle(self, *args, **options):
+        # Worker processes read the settings from the environment
+        os.environ["STREAM_SYNTHETIC_CAMERAS"] = "True"
+        os.environ["STREAM_CAPTURE_WORKERS"] = str(options["workers"])
+        settings.STREAM_SYNTHETIC_CAMERAS = True
+        settings.STREAM_CAPTURE_WORKERS = options["workers"]
+
+        # The cameras only exist in the cache, which must outlive the run
+        camera_access_cache.ttl = float("inf")
+        cam_ids = [FIRST_CAMERA_ID + index for index in range(options["cameras"])]
+        for cam_id in cam_ids:
+            camera_access_cache.put(
+                cam_id,
+                CameraAccess(OWNER_ID, options["source"], options["environment"]),
+            )
+
+        query = urlencode(
+            {
+                name: options[option]
+                for name, option in (("max_width", "max_width"), ("quality", "quality"))
+                if options[option]
+            }
+        )
+        report = asyncio.run(self.benchmark(cam_ids, query, options))
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report)
+
+    async def benchmark(self, cam_ids: list[int], query: str, options: dict) -> dict:
+        application = URLRouter(websocket_urlpatterns)
+        owner = User(id=OWNER_ID, email="benchmark@localhost")
+        viewers = [
+            ViewerStats(cam_id)
+            for cam_id in cam_ids
+            for _ in range(options["viewers"])
+        ]
+        # Starts the capture workers, so their baseline memory is not counted
+        cpu_before, memory_before = usage()
+        peak_memory = memory_before
+        measured_from = time.monotonic() + options["warmup"]
+        until = measured_from + options["duration"]
+
+        async def sample_usage():
+            nonlocal cpu_before, peak_memory
+            await asyncio.sleep(max(0.0, measured_from - time.monotonic()))
+            cpu_before = usage()[0]
+            while True:
+                peak_memory = max(peak_memory, usage()[1])
+                await asyncio.sleep(0.5)
+
+        sampler = asyncio.create_task(sample_usage())
+        try:
+            await asyncio.gather(
+                *(
+                    self.watch(application, owner, stats, query, measured_from, until)
+                    for stats in viewers
+                )
+            )
+            cpu_used = usage()[0] - cpu_before
+        finally:
+            sampler.cancel()
+            await stream_tasks.shutdown()
+            pool = get_worker_pool()
+            if pool is not None:
+                pool.shutdown()
+
+        streams = len(viewers)
+        cpu_percent = 100 * cpu_used / options["duration"]
+        memory = max(0, peak_memory - memory_before)
+        return {
+            "cameras": [
+                self.summarize(
+                    [stats for stats in viewers if stats.cam_id == cam_id],
+                    options["duration"],
+                )
+                | {"camera": cam_id}
+                for cam_id in cam_ids
+            ],
+            "total": self.summarize(viewers, options["duration"])
+            | {
+                "streams": streams,
+                "cpu_percent": round(cpu_percent, 1),
+                "cpu_percent_per_stream": round(cpu_percent / max(1, streams), 2),
+                "memory_mb": round(memory / 2**20, 1),
+                "memory_mb_per_stream": round(memory / 2**20 / max(1, streams), 2),
+                "workers": options["workers"],
+                "source": options["source"],
+            },
+        }
+
+    async def watch(
+        self,
+        application,
+        owner: User,
+        stats: ViewerStats,
+        query: str,
+        measured_from: float,
+        until: float,
+    ) -> None:
+        """
+        Receives and acknowledges the framed stream of a camera like a browser
+        would, counting the frames received between `measured_from` and
+        `until`.
+        """
+        path = f"/ws/live_stream/{stats.cam_id}/" + (f"?{query}" if query else "")
+        communicator = WebsocketCommunicator(
+            application, path, subprotocols=[SUBPROTOCOL]
+        )
+        communicator.scope["user"] = owner
+        stats.connected, _ = await communicator.connect(timeout=10)
+        if not stats.connected:
+            return
+        stopped = False
+        try:
+            while (remaining := until - time.monotonic()) > 0:
+                try:
+                    message = await communicator.receive_output(timeout=remaining)
+                except asyncio.TimeoutError:
+                    # The communicator stops the consumer when it times out
+                    stopped = True
+                    break
+                if message["type"] == "websocket.close":
+                    break
+                received_at = time.time()
+                if message.get("bytes") is None:
+                    continue
+                info, _, data = unpack_frame(message["bytes"])
+                await communicator.send_json_to({"type": "ack", "seq": info.seq})
+                if time.monotonic() < measured_from:
+                    continue
+                stats.frames += 1
+                stats.bytes += len(data)
+                stats.latencies.append(received_at - info.captured_at)
+        finally:
+            if not stopped:
+                await communicator.disconnect()
+
+    def summarize(self, viewers: list[ViewerStats], duration: float) -> dict:
+        latencies = np.array(
+            [latency for stats in viewers for latency in stats.latencies]
+        )
+        p50, p99 = (
+            np.percentile(latencies, (50, 99)) * 1000 if latencies.size else (0, 0)
+        )
+        frames = sum(stats.frames for stats in viewers)
+        return {
+            "viewers": len(viewers),
+            "failed": sum(not stats.connected for stats in viewers),
+            "fps": round(frames / duration / max(1, len(viewers)), 2),
+            "p50_ms": round(float(p50), 1),
+            "p99_ms": round(float(p99), 1),
+            "kbps": round(
+                sum(stats.bytes for stats in viewers) * 8 / duration / 1000, 1
+            ),
+        }
+
+    def print_report(self, report: dict) -> None:
+        self.stdout.write(
+            f"{'camera':>10} {'viewers':>8} {'fps':>7} "
+            f"{'p50 ms':>8} {'p99 ms':>8} {'kbps':>10}"
+        )
+        for row in [*report["cameras"], report["total"] | {"camera": "all"}]:
+            self.stdout.write(
+                f"{row['camera']:>10} {row['viewers']:>8} {row['fps']:>7} "
+                f"{row['p50_ms']:>8} {row['p99_ms']:>8} {row['kbps']:>10}"
+            )
+        total = report["total"]
+        if total["failed"]:
+            self.stdout.write(
+                self.style.ERROR(f"{total['failed']} viewers could not connect")
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"CPU {total['cpu_percent']}% of a core "
+                f"({total['cpu_percent_per_stream']}% per stream), memory "
+                f"+{total['memory_mb']} MB ({total['memory_mb_per_stream']} MB per "
+                f"stream), {total['workers']} capture workers"
+            )
+        )
@@ -0,0 +1,378 @@
+import threading
+from bisect import bisect_left
+from typing import Callable
+
+# Upper bounds of the latency histograms, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class CounterChild:
+    """
+    A monotonically increasing value for one combination of label values.
+    """
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def sample(self) -> float:
+        return self.value
+
+
+class GaugeChild(CounterChild):
+    """
+    A value that can go up and down for one combination of label values.
+    """
+
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class HistogramChild:
+    """
+    Observations bucketed by upper bound for one combination of label values.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        # The last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def sample(self) -> tuple[list[int], float]:
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Metric:
+    """
+    A named metric holding one child per combination of label values.
+
+    Children are created on first use and meant to be looked up once and
+    kept by the code updating them, so recording a value is a single locked
+    addition.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children = {}
+        self._lock = threading.Lock()
+        self._function = None
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        Returns the child for a combination of label values, creating it if needed.
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self.new_child())
+        return child
+
+    def remove(self, *values) -> None:
+        """
+        Forgets the child of a combination of label values.
+        """
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+    def set_function(self, function: Callable[[], dict[tuple, float]]) -> None:
+        """
+        Computes the samples of the metric at collection time instead of
+        keeping children, for values that are cheaper to read than to track.
+
+        Args:
+            function (Callable): Returns the value of each combination of
+            label values.
+        """
+        self._function = function
+
+    def snapshot(self) -> dict[tuple, object]:
+        """
+        Returns the current sample of every child, keyed by label values.
+        """
+        if self._function is not None:
+            return {
+                tuple(str(value) for value in key): value
+                for key, value in self._function().items()
+            }
+        with self._lock:
+            children = list(self._children.items())
+        return {key: child.sample() for key, child in children}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+
+def merge_sample(first, second):
+    """
+    Adds up two samples of the same metric and label values.
+    """
+    if isinstance(first, tuple):
+        counts = [a + b for a, b in zip(first[0], second[0])]
+        return counts, first[1] + second[1]
+    return first + second
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(
+            name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the process and renders them in the Prometheus text
+    exposition format.
+
+    Collectors registered with `add_collector` return snapshots taken in
+    other processes, such as capture workers, which are added to the local
+    samples when rendering.
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list[Callable[[], list[dict]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, tuple(labelnames)))
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, documentation, tuple(labelnames)))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, tuple(labelnames), buckets))
+
+    def add_collector(self, collector: Callable[[], list[dict]]) -> None:
+        self.collectors.append(collector)
+
+    def snapshot(self) -> dict[str, dict[tuple, object]]:
+        """
+        Returns the samples of every metric, in a picklable form.
+        """
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def collect(self) -> dict[str, dict[tuple, object]]:
+        """
+        Returns the samples of every metric, including other processes.
+        """
+        samples = self.snapshot()
+        for collector in self.collectors:
+            for snapshot in collector():
+                for name, children in snapshot.items():
+                    merged = samples.setdefault(name, {})
+                    for key, value in children.items():
+                        merged[key] = (
+                            merge_sample(merged[key], value) if key in merged else value
+                        )
+        return samples
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, children in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(children.items()):
+                if metric.kind != "histogram":
+                    labels = format_labels(metric.labelnames, key)
+                    lines.append(f"{name}{labels} {format_value(value)}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip((*metric.buckets, "+Inf"), counts):
+                    cumulative += count
+                    labels = format_labels(metric.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                labels = format_labels(metric.labelnames, key)
+                lines.append(f"{name}_sum{labels} {format_value(total)}")
+                lines.append(f"{name}_count{labels} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+frames_captured = REGISTRY.counter(
+    "ispeco_stream_frames_captured_total",
+    "Frames read from the camera.",
+    ("camera",),
+)
+frames_grabbed = REGISTRY.counter(
+    "ispeco_stream_frames_grabbed_total",
+    "Frames grabbed from the camera but not decoded as no viewer was due for one.",
+    ("camera",),
+)
+frames_skipped = REGISTRY.counter(
+    "ispeco_stream_frames_skipped_total",
+    "Frames dropped by the motion gate before encoding.",
+    ("camera",),
+)
+reconnects = REGISTRY.counter(
+    "ispeco_stream_reconnects_total",
+    "Reconnections to the camera after a failed read.",
+    ("camera",),
+)
+decode_seconds = REGISTRY.histogram(
+    "ispeco_stream_decode_seconds",
+    "Time spent reading and decoding a frame.",
+    ("camera",),
+)
+encode_seconds = REGISTRY.histogram(
+    "ispeco_stream_encode_seconds",
+    "Time spent resizing and JPEG-encoding a frame for one rendition.",
+    ("camera", "rendition"),
+)
+send_seconds = REGISTRY.histogram(
+    "ispeco_stream_send_seconds",
+    "Time spent sending a frame to a viewer.",
+    ("camera", "endpoint"),
+)
+frame_age_seconds = REGISTRY.histogram(
+    "ispeco_stream_frame_age_seconds",
+    "Time from the capture of a frame to the end of its delivery to a viewer.",
+    ("camera", "endpoint"),
+)
+client_latency_seconds = REGISTRY.histogram(
+    "ispeco_stream_client_latency_seconds",
+    "Capture-to-display latency reported by viewers of framed streams.",
+    ("camera",),
+)
+frames_sent = REGISTRY.counter(
+    "ispeco_stream_frames_sent_total",
+    "Frames delivered to viewers.",
+    ("camera", "endpoint"),
+)
+frames_dropped = REGISTRY.counter(
+    "ispeco_stream_frames_dropped_total",
+    "Frames replaced in a viewer's mailbox before being sent.",
+    ("camera", "endpoint"),
+)
+bytes_sent = REGISTRY.counter(
+    "ispeco_stream_bytes_sent_total",
+    "Bytes of frames delivered to viewers.",
+    ("camera", "endpoint"),
+)
+viewers = REGISTRY.gauge(
+    "ispeco_stream_viewers",
+    "Subscribers of each running camera hub.",
+    ("camera",),
+)
+cameras = REGISTRY.gauge(
+    "ispeco_stream_cameras",
+    "Running camera hubs by status.",
+    ("status",),
+)
+stream_tasks = REGISTRY.gauge(
+    "ispeco_stream_tasks",
+    "Running streaming tasks by kind of stream.",
+    ("kind",),
+)
+frames_throttled = REGISTRY.counter(
+    "ispeco_stream_frames_throttled_total",
+    "Frames grabbed but not decoded because the frame budget went to other cameras.",
+    ("camera", "tier"),
+)
+frame_cost_seconds = REGISTRY.gauge(
+    "ispeco_stream_frame_cost_seconds",
+    "Average CPU time spent decoding and encoding a frame of each camera.",
+    ("camera", "tier"),
+)
+detection_seconds = REGISTRY.histogram(
+    "ispeco_detection_inference_seconds",
+    "Time spent in one batched forward pass of the detection network.",
+)
+detection_batch_size = REGISTRY.histogram(
+    "ispeco_detection_batch_size",
+    "Frames analysed per forward pass of the detection network.",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+detections = REGISTRY.counter(
+    "ispeco_detections_total",
+    "Objects detected above the confidence threshold.",
+    ("camera", "label"),
+)
+notifications_created = REGISTRY.counter(
+    "ispeco_notifications_created_total",
+    "Notifications created from camera events.",
+    ("kind",),
+)
+notifications_suppressed = REGISTRY.counter(
+    "ispeco_notifications_suppressed_total",
+    "Camera events not notified because of an earlier one in the same window.",
+    ("kind",),
+)
@@ -1,3 +1,99 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.utils import timezone
+
+from camera_integration.models import Camera
+
+
+class RecordingPolicy(models.Model):
+    """
+    Represents when a camera is recorded and how long its recordings are kept.
+    Attributes:
+        camera (OneToOneField): The recorded camera.
+        mode (CharField): Whether the camera is never, always or periodically recorded.
+        start_time (TimeField): The daily start of the recording window, for scheduled recording.
+        end_time (TimeField): The daily end of the recording window, for scheduled recording.
+        retention_hours (PositiveIntegerField): How long recordings are kept before being pruned, at least an hour.
+    Methods:
+        is_active(self, now: datetime | None = None) -> bool:
+            Returns whether the camera should be recording at the given time.
+    """
+
+    MODE_CHOICES = [
+        ("off", "Off"),
+        ("continuous", "Continuous"),
+        ("scheduled", "Scheduled"),
+    ]
+    camera = models.OneToOneField(
+        Camera, on_delete=models.CASCADE, related_name="recording_policy"
+    )
+    mode = models.CharField(max_length=20, choices=MODE_CHOICES, default="off")
+    start_time = models.TimeField(blank=True, null=True)
+    end_time = models.TimeField(blank=True, null=True)
+    retention_hours = models.PositiveIntegerField(
+        default=settings.STREAM_RECORDING_RETENTION_HOURS,
+        validators=[MinValueValidator(1)],
+    )
+
+    def __str__(self) -> str:
+        return f"{self.camera} - {self.mode}"
+
+    def is_active(self, now: datetime | None = None) -> bool:
+        if self.mode == "continuous":
+            return True
+        if self.mode != "scheduled" or not self.start_time or not self.end_time:
+            return False
+        current = timezone.localtime(now).time()
+        if self.start_time <= self.end_time:
+            return self.start_time <= current < self.end_time
+        # The window wraps around midnight
+        return current >= self.start_time or current < self.end_time
+
+
+class RecordingSegment(models.Model):
+    """
+    Represents a fixed-duration recording file of a camera.
+    Attributes:
+        camera (ForeignKey): The recorded camera.
+        started_at (DateTimeField): The capture time of the first frame.
+        ended_at (DateTimeField): The capture time of the last frame.
+        path (CharField): The segment file, relative to STREAM_RECORDING_DIR.
+        size (BigIntegerField): The size of the segment file, in bytes.
+        frame_count (PositiveIntegerField): The number of frames in the segment.
+    """
+
+    camera = models.ForeignKey(
+        Camera, on_delete=models.CASCADE, related_name="recording_segments"
+    )
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    path = models.CharField(max_length=255)
+    size = models.BigIntegerField(default=0)
+    frame_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ("started_at",)
+        indexes = [models.Index(fields=["camera", "started_at"])]
+
+    def __str__(self) -> str:
+        return f"{self.camera} - {self.started_at:%Y-%m-%d %H:%M:%S}"
+
+
+class StreamingNode(models.Model):
+    """
+    Represents a streaming server process, for sharding cameras across nodes.
+    Attributes:
+        name (CharField): The unique name of the node, from STREAM_NODE_NAME.
+        url (CharField): The WebSocket base URL other nodes relay frames from.
+        heartbeat_at (DateTimeField): When the node last announced itself.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    url = models.CharField(max_length=255)
+    heartbeat_at = models.DateTimeField(db_index=True)
 
-# Create your models here.
+    def __str__(self) -> str:
+        return self.name
@@ -0,0 +1,133 @@
+import math
+import time
+
+import cv2 as cv
+import numpy as np
+
+from .flow import FrameRateController, LatestFrame
+from .renditions import QUALITY_TIERS, Rendition, select_rendition
+
+MAX_MOSAIC_TILES = 16
+
+
+class MosaicTile:
+    """
+    One camera of a mosaic: its mailbox, refresh rate and position on the
+    canvas.
+    """
+
+    def __init__(self, cam_id: int, index: int, refresh_interval: float):
+        self.cam_id = cam_id
+        self.index = index
+        self.refresh_interval = refresh_interval
+        self.mailbox = LatestFrame()
+        self.rate = FrameRateController(1 / refresh_interval, 1 / refresh_interval)
+        self.updated_at = 0.0
+
+    def due(self, now: float) -> bool:
+        return now - self.updated_at >= self.refresh_interval
+
+
+class Mosaic:
+    """
+    Composes the latest frame of several cameras into a single image.
+
+    Tiles are drawn into a canvas allocated once for the lifetime of the
+    mosaic. Each tile is refreshed at most once per `refresh_interval` and
+    only when its camera delivered a new frame, so a slow or stalled camera
+    keeps showing its last frame without holding up the others.
+    """
+
+    def __init__(
+        self,
+        cam_ids: list[int],
+        rows: int,
+        cols: int,
+        tile_width: int = 320,
+        tile_height: int = 180,
+        tile_fps: float = 5,
+        quality: str = "medium",
+    ):
+        self.rows = rows
+        self.cols = cols
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.jpeg_quality = QUALITY_TIERS.get(quality, QUALITY_TIERS["medium"])
+        self.rendition: Rendition = select_rendition(tile_width, "medium")
+        self.tiles = [
+            MosaicTile(cam_id, index, 1 / tile_fps)
+            for index, cam_id in enumerate(cam_ids[: rows * cols])
+        ]
+        self.canvas = np.zeros((rows * tile_height, cols * tile_width, 3), np.uint8)
+
+    @classmethod
+    def from_layout(cls, cam_ids: list[int], layout: str | None = None, **kwargs):
+        """
+        Builds a mosaic from a `<cols>x<rows>` layout, or the smallest square
+        grid fitting every camera when no valid layout is given.
+        """
+        cam_ids = cam_ids[:MAX_MOSAIC_TILES]
+        try:
+            cols, rows = (int(part) for part in (layout or "").lower().split("x"))
+        except ValueError:
+            cols = math.ceil(math.sqrt(len(cam_ids)))
+            rows = math.ceil(len(cam_ids) / cols)
+        cols = min(max(cols, 1), MAX_MOSAIC_TILES)
+        rows = min(max(rows, 1), math.ceil(MAX_MOSAIC_TILES / cols))
+        return cls(cam_ids, rows, cols, **kwargs)
+
+    def take_due_frames(self) -> dict[MosaicTile, bytes]:
+        """
+        Takes the pending frame of every tile that is due for a refresh.
+        Runs on the event loop.
+        """
+        now = time.monotonic()
+        frames = {}
+        for tile in self.tiles:
+            if tile.due(now):
+                frame_data = tile.mailbox.take()
+                if frame_data is not None:
+                    frames[tile] = frame_data
+                    tile.updated_at = now
+        return frames
+
+    def compose(self, frames: dict[MosaicTile, bytes]) -> bytes | None:
+        """
+        Draws new tile frames into the canvas and encodes it. Blocking, meant
+        to run off the event loop.
+
+        Args:
+            frames (dict[MosaicTile, bytes]): The new JPEG of each updated tile.
+
+        Returns:
+            bytes | None: The encoded mosaic, or `None` if encoding failed.
+        """
+        for tile, frame_data in frames.items():
+            image = cv.imdecode(np.frombuffer(frame_data, np.uint8), cv.IMREAD_COLOR)
+            if image is not None:
+                self.draw(tile, image)
+        ret, buffer = cv.imencode(
+            ".jpg", self.canvas, [cv.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        )
+        if not ret:
+            return None
+        return buffer.tobytes()
+
+    def draw(self, tile: MosaicTile, image: np.ndarray) -> None:
+        """
+        Letterboxes an image into the cell of a tile.
+        """
+        row, col = divmod(tile.index, self.cols)
+        top, left = row * self.tile_height, col * self.tile_width
+        cell = self.canvas[top : top + self.tile_height, left : left + self.tile_width]
+
+        height, width = image.shape[:2]
+        scale = min(self.tile_width / width, self.tile_height / height)
+        fit_width = max(1, round(width * scale))
+        fit_height = max(1, round(height * scale))
+        y = (self.tile_height - fit_height) // 2
+        x = (self.tile_width - fit_width) // 2
+        cell[:] = 0
+        cell[y : y + fit_height, x : x + fit_width] = cv.resize(
+            image, (fit_width, fit_height), interpolation=cv.INTER_AREA
+        )
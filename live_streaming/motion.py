@@ -0,0 +1,94 @@
+import time
+
+import cv2 as cv
+import numpy as np
+from django.conf import settings
+
+
+class MotionGate:
+    """
+    Skips frames that barely differ from the last frame that was let through.
+
+    Frames are compared as small grayscale thumbnails: the share of pixels
+    whose intensity changed by more than `pixel_delta` has to reach
+    `threshold` for the frame to pass. A keepalive frame still passes every
+    `keepalive` seconds so viewers of a static scene see a live clock.
+    `moved` tells whether the last frame let through passed because of motion.
+    """
+
+    def __init__(
+        self,
+        threshold: float | None = None,
+        keepalive: float | None = None,
+        sample_width: int = 64,
+        pixel_delta: int = 25,
+    ):
+        self.threshold = (
+            threshold if threshold is not None else settings.STREAM_MOTION_THRESHOLD
+        )
+        self.keepalive = (
+            keepalive if keepalive is not None else settings.STREAM_MOTION_KEEPALIVE
+        )
+        self.sample_width = sample_width
+        self.pixel_delta = pixel_delta
+        self.score = 0.0
+        self.skipped = 0
+        self.moved = False
+        self._previous = None
+        self._passed_at = 0.0
+
+    def reset(self) -> None:
+        """
+        Lets the next frame through regardless of how much it changed.
+        """
+        self._previous = None
+
+    def should_send(self, frame: np.ndarray) -> bool:
+        """
+        Decides whether a frame differs enough from the last one let through.
+
+        Args:
+            frame (np.ndarray): The decoded BGR frame.
+
+        Returns:
+            bool: True if the frame should be encoded and sent.
+        """
+        height, width = frame.shape[:2]
+        size = (self.sample_width, max(1, round(height * self.sample_width / width)))
+        sample = cv.cvtColor(
+            cv.resize(frame, size, interpolation=cv.INTER_AREA), cv.COLOR_BGR2GRAY
+        )
+
+        now = time.monotonic()
+        previous = self._previous
+        if previous is None or previous.shape != sample.shape:
+            self.score = 1.0
+            self.moved = False
+        else:
+            changed = cv.absdiff(sample, previous) > self.pixel_delta
+            self.score = np.count_nonzero(changed) / changed.size
+            self.moved = self.score >= self.threshold
+            if not self.moved and now - self._passed_at < self.keepalive:
+                self.skipped += 1
+                return False
+
+        self._previous = sample
+        self._passed_at = now
+        return True
+
+
+def motion_gate_for(environment: str | None) -> MotionGate | None:
+    """
+    Returns a motion gate for cameras installed in an environment listed in
+    `STREAM_MOTION_GATE_ENVIRONMENTS`.
+
+    Args:
+        environment (str | None): The `Camera.environment` of the camera.
+
+    Returns:
+        MotionGate | None: A new gate, or `None` if gating is disabled for
+        the environment.
+    """
+    if environment in settings.STREAM_MOTION_GATE_ENVIRONMENTS:
+        return MotionGate()
+    return None
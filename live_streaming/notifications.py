@@ -0,0 +1,200 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from camera_integration.models import Camera
+from user_authentication.models import Notification
+
+from . import metrics
+from .events import CameraEvent
+
+
+def event_title(kind: str) -> str:
+    """
+    Returns how the titles of the notifications of a kind of event start.
+    """
+    if kind == "motion":
+        return "Motion detected"
+    if kind == "detection":
+        return "Threat detected"
+    return f"Camera event: {kind}"
+
+
+def describe_event(event: CameraEvent, camera_name: str) -> tuple[str, str]:
+    """
+    Writes the title and message of the notification of an event.
+
+    Args:
+        event (CameraEvent): The event to notify.
+        camera_name (str): The name of the camera the event happened on.
+
+    Returns:
+        tuple[str, str]: The title and the message.
+    """
+    occurred_at = datetime.fromtimestamp(event.occurred_at, dt_timezone.utc)
+    when = occurred_at.strftime("%Y-%m-%d %H:%M:%S UTC")
+    if event.kind == "motion":
+        message = f"Motion was detected on {camera_name} at {when}."
+        return event_title("motion"), message
+    if event.kind == "detection":
+        labels = sorted(
+            {detection["label"] for detection in event.data.get("detections", [])}
+        )
+        title = f"{event_title('detection')}: {', '.join(labels)}"[:100]
+        return title, f"{', '.join(labels)} detected on {camera_name} at {when}."
+    title = event_title(event.kind)[:100]
+    return title, f"{event.kind} on {camera_name} at {when}."
+
+
+class EventNotifier:
+    """
+    Turns camera events into notifications for the owner of the camera.
+
+    Listens on the `event_bus`. The first event of each camera and kind is
+    notified and the next ones are dropped until `window` seconds have passed
+    since it, so a busy doorway notifies once per window rather than once
+    per frame. Notifications are queued in memory and written with a single
+    `bulk_create` every `flush_interval` seconds by a background thread,
+    never from the capture or event loop threads publishing the events.
+
+    Every process capturing a camera publishes its events, e.g. each ASGI
+    worker with viewers of it and `record_cameras`, so the window is also
+    checked against the notifications already in the database before
+    writing. Processes flushing the same burst at the same moment can still
+    both notify it.
+    """
+
+    def __init__(
+        self,
+        kinds: list[str] | None = None,
+        window: float | None = None,
+        flush_interval: float | None = None,
+    ):
+        if kinds is None:
+            kinds = settings.STREAM_NOTIFICATION_EVENTS
+        self.kinds = set(kinds)
+        self.window = settings.STREAM_NOTIFICATION_WINDOW if window is None else window
+        self.flush_interval = (
+            settings.STREAM_NOTIFICATION_FLUSH_INTERVAL
+            if flush_interval is None
+            else flush_interval
+        )
+        self.pending: list[CameraEvent] = []
+        self._last: dict[tuple[int, str], float] = {}
+        self._lock = threading.Lock()
+        self._flusher: threading.Thread | None = None
+
+    def __call__(self, event: CameraEvent) -> None:
+        if event.kind not in self.kinds:
+            return
+        key = (event.cam_id, event.kind)
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and event.occurred_at - last < self.window:
+                metrics.notifications_suppressed.labels(event.kind).inc()
+                return
+            self._last[key] = event.occurred_at
+            self.pending.append(event)
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self.run, name="notification-flusher", daemon=True
+                )
+                self._flusher.start()
+                atexit.register(self.flush)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes the pending notifications and forgets the windows that have
+        ended.
+
+        Returns:
+            int: The number of notifications created.
+        """
+        with self._lock:
+            events, self.pending = self.pending, []
+            if events:
+                newest = max(event.occurred_at for event in events)
+                self._last = {
+                    key: last
+                    for key, last in self._last.items()
+                    if newest - last < self.window
+                }
+        if not events:
+            return 0
+        close_old_connections()
+        try:
+            cameras = {
+                cam_id: (user_id, name)
+                for cam_id, user_id, name in Camera.objects.filter(
+                    id__in={event.cam_id for event in events}
+                ).values_list("id", "user_id", "name")
+            }
+            notified = self.notified(events, cameras)
+            notifications = []
+            kinds = []
+            for event in events:
+                if event.cam_id not in cameras:
+                    continue
+                user_id, name = cameras[event.cam_id]
+                title, message = describe_event(event, name)
+                created_at = datetime.fromtimestamp(event.occurred_at, dt_timezone.utc)
+                if any(
+                    other_title.startswith(event_title(event.kind))
+                    and f" on {name} at " in other_message
+                    and abs(created_at - notified_at).total_seconds() < self.window
+                    for other_title, other_message, notified_at in notified.get(
+                        user_id, ()
+                    )
+                ):
+                    metrics.notifications_suppressed.labels(event.kind).inc()
+                    continue
+                kinds.append(event.kind)
+                notifications.append(
+                    Notification(
+                        user_id=user_id,
+                        title=title,
+                        message=message,
+                        created_at=created_at,
+                    )
+                )
+            Notification.objects.bulk_create(notifications)
+        except Exception as exc:
+            print(f"Failed to create {len(events)} camera notifications: {exc!r}")
+            return 0
+        finally:
+            close_old_connections()
+        for kind in kinds:
+            metrics.notifications_created.labels(kind).inc()
+        return len(notifications)
+
+    def notified(
+        self, events: list[CameraEvent], cameras: dict[int, tuple[int, str]]
+    ) -> dict[int, list[tuple[str, str, datetime]]]:
+        """
+        Loads the notifications of the owners of the cameras of some events
+        created within a window of them, by this or any other process.
+
+        Returns:
+            dict[int, list[tuple[str, str, datetime]]]: The title, message and
+            creation time of the notifications, keyed by user ID.
+        """
+        oldest = min(event.occurred_at for event in events) - self.window
+        notified = {}
+        for user_id, title, message, created_at in Notification.objects.filter(
+            user_id__in={user_id for user_id, _ in cameras.values()},
+            created_at__gt=datetime.fromtimestamp(oldest, dt_timezone.utc),
+        ).values_list("user_id", "title", "message", "created_at"):
+            notified.setdefault(user_id, []).append((title, message, created_at))
+        return notified
+
+
+event_notifier = EventNotifier()
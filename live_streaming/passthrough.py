@@ -0,0 +1,423 @@
+import asyncio
+import random
+import shutil
+import struct
+import time
+from collections import deque
+from functools import lru_cache
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .sharding import node_cluster
+from .synthetic import is_synthetic
+from .tasks import stream_tasks
+
+# Largest MP4 box accepted from ffmpeg, a fragment of a few seconds at most
+MAX_BOX_SIZE = 64 * 1024 * 1024
+# How long a camera whose stream cannot be passed through is served as JPEG
+# before passthrough is tried again, in seconds
+UNSUPPORTED_RETRY = 300
+# Sample flag of the ISO BMFF `trun`/`tfhd` boxes marking a non-keyframe
+NON_SYNC_SAMPLE = 0x10000
+
+BOX_HEADER = struct.Struct(">I4s")
+
+
+class Fragment(NamedTuple):
+    """
+    A piece of the fragmented MP4 stream of a camera.
+
+    Attributes:
+        data (bytes): The `ftyp` and `moov` boxes of an init segment, or the
+            `moof` and `mdat` boxes of a media fragment.
+        keyframe (bool): Whether playback can start with this fragment.
+        init (bool): Whether this is an init segment, sent before the media
+            fragments following it.
+    """
+
+    data: bytes
+    keyframe: bool
+    init: bool = False
+
+
+def iter_boxes(data: bytes, start: int = 0, end: int | None = None):
+    """
+    Yields the type, payload start and end offset of the MP4 boxes found
+    between `start` and `end`.
+    """
+    end = len(data) if end is None else end
+    offset = start
+    while offset + BOX_HEADER.size <= end:
+        size, kind = BOX_HEADER.unpack_from(data, offset)
+        header_size = BOX_HEADER.size
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + header_size)[0]
+            header_size += 8
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            return
+        yield kind, offset + header_size, offset + size
+        offset += size
+
+
+def find_box(data: bytes, kind: bytes, start: int = 0, end: int | None = None):
+    """
+    Returns the payload start and end of the first box of a type, or `None`.
+    """
+    for box_kind, payload, box_end in iter_boxes(data, start, end):
+        if box_kind == kind:
+            return payload, box_end
+    return None
+
+
+def codec_string(init_segment: bytes) -> str | None:
+    """
+    Returns the RFC 6381 codec of an H.264 init segment, e.g. `avc1.64001f`,
+    as expected by `MediaSource.isTypeSupported`, or `None` for other codecs.
+    """
+    index = init_segment.find(b"avcC")
+    if index < 0 or index + 8 > len(init_segment):
+        return None
+    # configurationVersion, AVCProfileIndication, profile_compatibility,
+    # AVCLevelIndication
+    profile, compatibility, level = init_segment[index + 5 : index + 8]
+    return f"avc1.{profile:02x}{compatibility:02x}{level:02x}"
+
+
+def is_keyframe_fragment(moof: bytes) -> bool:
+    """
+    Tells whether the first sample of a `moof` box is a keyframe, from the
+    sample flags of its first track run. Fragments without flags are assumed
+    to start with a keyframe, as ffmpeg starts one at every keyframe.
+    """
+    box = find_box(moof, b"moof")
+    if box is None:
+        return True
+    traf = find_box(moof, b"traf", *box)
+    if traf is None:
+        return True
+    flags = None
+    tfhd = find_box(moof, b"tfhd", *traf)
+    if tfhd is not None:
+        tfhd_flags = int.from_bytes(moof[tfhd[0] + 1 : tfhd[0] + 4], "big")
+        # track_ID, then the optional fields in the order of their flags
+        offset = tfhd[0] + 8
+        for flag, size in ((0x1, 8), (0x2, 4), (0x8, 4), (0x10, 4)):
+            if tfhd_flags & flag:
+                offset += size
+        if tfhd_flags & 0x20:
+            flags = int.from_bytes(moof[offset : offset + 4], "big")
+    trun = find_box(moof, b"trun", *traf)
+    if trun is not None:
+        trun_flags = int.from_bytes(moof[trun[0] + 1 : trun[0] + 4], "big")
+        # sample_count, then the optional data offset
+        offset = trun[0] + 8 + (4 if trun_flags & 0x1 else 0)
+        if trun_flags & 0x4:
+            flags = int.from_bytes(moof[offset : offset + 4], "big")
+        elif trun_flags & 0x400:
+            offset += 4 if trun_flags & 0x100 else 0
+            offset += 4 if trun_flags & 0x200 else 0
+            flags = int.from_bytes(moof[offset : offset + 4], "big")
+    return flags is None or not flags & NON_SYNC_SAMPLE
+
+
+async def read_box(stream: asyncio.StreamReader) -> tuple[bytes, bytes] | None:
+    """
+    Reads the next top-level box of an MP4 stream.
+
+    Returns:
+        tuple[bytes, bytes] | None: The type and the whole box, or `None` at
+        the end of the stream.
+
+    Raises:
+        ValueError: If the box is malformed or larger than `MAX_BOX_SIZE`.
+    """
+    try:
+        header = await stream.readexactly(BOX_HEADER.size)
+        size, kind = BOX_HEADER.unpack(header)
+        if size == 1:
+            extended = await stream.readexactly(8)
+            header += extended
+            size = struct.unpack(">Q", extended)[0]
+        if not len(header) <= size <= MAX_BOX_SIZE:
+            raise ValueError(f"Unsupported {kind!r} box of {size} bytes")
+        return kind, header + await stream.readexactly(size - len(header))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class FragmentMailbox:
+    """
+    Queue of the fragments waiting to be sent to one passthrough viewer.
+
+    Media fragments cannot be skipped like JPEG frames, as later frames
+    depend on earlier ones. A viewer that falls `max_fragments` behind has
+    its backlog dropped instead and resumes at the next keyframe.
+    """
+
+    def __init__(self, max_fragments: int):
+        self.max_fragments = max_fragments
+        self.fragments: deque[Fragment] = deque()
+        self.closed = False
+        self.dropped = 0
+        self._synced = False
+        self._ready = asyncio.Event()
+
+    def put(self, fragment: Fragment | None) -> None:
+        """
+        Queues a fragment, or closes the mailbox when given `None`.
+        """
+        if fragment is None:
+            self.closed = True
+        elif fragment.init:
+            # A new init segment restarts the stream at its next keyframe
+            self.dropped += sum(not pending.init for pending in self.fragments)
+            self.fragments.clear()
+            self.fragments.append(fragment)
+            self._synced = False
+        else:
+            if self._synced and len(self.fragments) >= self.max_fragments:
+                pending = [f for f in self.fragments if f.init]
+                self.dropped += len(self.fragments) - len(pending)
+                self.fragments = deque(pending)
+                self._synced = False
+            if not self._synced and not fragment.keyframe:
+                self.dropped += 1
+                return
+            self._synced = True
+            self.fragments.append(fragment)
+        self._ready.set()
+
+    async def get(self) -> Fragment | None:
+        """
+        Waits for the next fragment.
+
+        Returns:
+            Fragment | None: The fragment, or `None` once the stream has ended.
+        """
+        while not self.fragments:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        return self.fragments.popleft()
+
+
+def ffmpeg_command(cam_url: str) -> list[str]:
+    """
+    Builds the ffmpeg command repackaging the video of a camera into
+    fragmented MP4 on its standard output, without transcoding.
+    """
+    timeout = str(int(settings.STREAM_READ_TIMEOUT * 1_000_000))
+    if is_synthetic(cam_url):
+        source = ["-re", "-stream_loop", "-1", "-i", urlsplit(cam_url).path]
+    elif cam_url.startswith("rtsp"):
+        source = ["-rtsp_transport", "tcp", "-timeout", timeout, "-i", cam_url]
+    elif "://" in cam_url:
+        source = ["-rw_timeout", timeout, "-i", cam_url]
+    else:
+        # Play local files at their own rate, like a camera
+        source = ["-re", "-i", cam_url]
+    fragment = str(int(settings.STREAM_PASSTHROUGH_FRAGMENT_SECONDS * 1_000_000))
+    return [
+        settings.STREAM_FFMPEG_PATH,
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-nostdin",
+        *source,
+        "-map",
+        "0:v:0",
+        "-an",
+        "-c:v",
+        "copy",
+        "-f",
+        "mp4",
+        "-movflags",
+        "empty_moov+default_base_moof+frag_keyframe",
+        "-frag_duration",
+        fragment,
+        "pipe:1",
+    ]
+
+
+class PassthroughFeed:
+    """
+    Shares one ffmpeg process repackaging the H.264 stream of a camera into
+    fragmented MP4 between every passthrough viewer of the camera.
+
+    The feed keeps the init segment and the fragments since the last
+    keyframe, so a new viewer starts playing right away. If the stream
+    cannot be passed through, e.g. because the camera does not send H.264,
+    the viewers are closed, the error is kept in `error` and the camera is
+    served as JPEG for `UNSUPPORTED_RETRY` seconds. Once streaming, ffmpeg
+    is restarted with jittered exponential backoff when the camera drops.
+    The feed stops when its last viewer leaves.
+    """
+
+    def __init__(self, cam_id: int, cam_url: str):
+        self.cam_id = cam_id
+        self.cam_url = cam_url
+        self.subscribers: set[FragmentMailbox] = set()
+        self.init_segment: bytes | None = None
+        self.mime: str | None = None
+        self.error: str | None = None
+        self.gop: list[Fragment] = []
+        self._task = None
+
+    def subscribe(self, mailbox: FragmentMailbox) -> None:
+        self.subscribers.add(mailbox)
+        if self.init_segment is not None:
+            mailbox.put(Fragment(self.init_segment, True, init=True))
+            for fragment in self.gop:
+                mailbox.put(fragment)
+        if self._task is None:
+            self._task = stream_tasks.start(self.run(), "passthrough")
+
+    def unsubscribe(self, mailbox: FragmentMailbox) -> None:
+        self.subscribers.discard(mailbox)
+        if not self.subscribers and self._task is not None:
+            # Viewers arriving from now on start a new feed
+            if _feeds.get(self.cam_id) is self:
+                del _feeds[self.cam_id]
+            self._task.cancel()
+
+    def publish(self, fragment: Fragment) -> None:
+        if fragment.init:
+            self.gop = []
+        elif fragment.keyframe:
+            self.gop = [fragment]
+        elif self.gop and len(self.gop) < settings.STREAM_PASSTHROUGH_MAX_FRAGMENTS:
+            self.gop.append(fragment)
+        else:
+            # Too long to replay, new viewers wait for the next keyframe
+            self.gop = []
+        for mailbox in self.subscribers:
+            mailbox.put(fragment)
+
+    async def run(self):
+        attempts = 0
+        try:
+            while self.subscribers:
+                if await self.capture():
+                    attempts = 0
+                elif self.init_segment is None:
+                    # Never got a stream out of the camera, serve it as JPEG
+                    _unsupported[self.cam_id] = time.monotonic()
+                    return
+                else:
+                    attempts += 1
+                await asyncio.sleep(
+                    random.uniform(
+                        0,
+                        min(
+                            settings.STREAM_RECONNECT_MAX_DELAY,
+                            settings.STREAM_RECONNECT_BASE_DELAY * 2**attempts,
+                        ),
+                    )
+                )
+        finally:
+            if _feeds.get(self.cam_id) is self:
+                del _feeds[self.cam_id]
+            for mailbox in self.subscribers:
+                mailbox.put(None)
+
+    async def capture(self) -> bool:
+        """
+        Runs ffmpeg until it exits, publishing what it produces.
+
+        Returns:
+            bool: Whether ffmpeg produced any media fragment.
+        """
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg_command(self.cam_url),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        errors = deque(maxlen=5)
+
+        async def drain_errors():
+            async for line in process.stderr:
+                errors.append(line.decode(errors="replace").strip())
+
+        drain = asyncio.create_task(drain_errors())
+        streamed = False
+        try:
+            header = b""
+            moof = None
+            while (box := await read_box(process.stdout)) is not None:
+                kind, data = box
+                if kind == b"ftyp":
+                    header = data
+                elif kind == b"moov":
+                    mime = codec_string(data)
+                    if mime is None:
+                        self.error = "The camera does not stream H.264"
+                        return False
+                    self.init_segment = header + data
+                    self.mime = f'video/mp4; codecs="{mime}"'
+                    self.publish(Fragment(self.init_segment, True, init=True))
+                elif kind == b"moof":
+                    moof = data
+                elif kind == b"mdat" and moof is not None:
+                    self.publish(Fragment(moof + data, is_keyframe_fragment(moof)))
+                    moof = None
+                    streamed = True
+        except ValueError as exc:
+            errors.append(str(exc))
+        finally:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            await asyncio.gather(drain, return_exceptions=True)
+            if not streamed and self.error is None:
+                self.error = "; ".join(errors) or "ffmpeg exited without output"
+        return streamed
+
+
+_feeds: dict[int, PassthroughFeed] = {}
+_unsupported: dict[int, float] = {}
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_available(path: str) -> bool:
+    return shutil.which(path) is not None
+
+
+def passthrough_available(cam_id: int, cam_url: str | None) -> bool:
+    """
+    Tells whether a camera may be offered as fragmented MP4: passthrough is
+    on, ffmpeg is installed, the camera sends compressed video, its stream
+    was not found unsupported recently and, when cameras are sharded, this
+    node owns it. Viewers on other nodes get the JPEG frames relayed from the
+    owner, so the camera is never opened by more than one node.
+    """
+    if not (
+        settings.STREAM_PASSTHROUGH
+        and cam_url
+        and ffmpeg_available(settings.STREAM_FFMPEG_PATH)
+    ):
+        return False
+    if node_cluster is not None and not node_cluster.is_local(cam_id):
+        return False
+    if is_synthetic(cam_url):
+        # Generated frames have no compressed stream, local files do
+        parts = urlsplit(cam_url)
+        if parts.netloc or not parts.path or not settings.STREAM_SYNTHETIC_CAMERAS:
+            return False
+    failed_at = _unsupported.get(cam_id)
+    return failed_at is None or time.monotonic() - failed_at >= UNSUPPORTED_RETRY
+
+
+def get_feed(cam_id: int, cam_url: str) -> PassthroughFeed:
+    """
+    Returns the running passthrough feed of a camera, creating it if needed.
+    """
+    feed = _feeds.get(cam_id)
+    if feed is None:
+        feed = _feeds[cam_id] = PassthroughFeed(cam_id, cam_url)
+    return feed
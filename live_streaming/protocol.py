@@ -0,0 +1,129 @@
+import struct
+import time
+from typing import NamedTuple
+
+# WebSocket subprotocol of framed streams. Clients that do not offer it keep
+# receiving bare JPEG messages.
+SUBPROTOCOL = "ispeco.frame.v1"
+PROTOCOL_VERSION = 1
+# WebSocket subprotocol of passthrough streams: a JSON `init` message with
+# the MIME type of the stream, then the fragmented MP4 init segment and media
+# fragments as binary messages, for Media Source Extensions
+FMP4_SUBPROTOCOL = "ispeco.fmp4.v1"
+
+# Version, header size, rendition ID, camera ID, sequence number, capture
+# time, encode time and send time as Unix timestamps in seconds, all
+# little-endian. Clients skip `header size` bytes to reach the JPEG, so
+# later versions may append fields.
+FRAME_HEADER = struct.Struct("<BBHIIddd")
+# Relay messages between streaming nodes carry every rendition of a frame,
+# each as a framed message prefixed with its length (little-endian)
+RELAY_LENGTH = struct.Struct("<I")
+# Sequence numbers wrap around in the header
+SEQ_MASK = 0xFFFFFFFF
+
+
+class FrameInfo(NamedTuple):
+    """
+    Metadata of one encoded frame, as broadcast by a `CameraHub`.
+    """
+
+    cam_id: int
+    seq: int
+    captured_at: float
+    encoded_at: float
+    rendition_id: int
+
+
+def pack_frame(info: FrameInfo, frame_data: bytes | memoryview) -> bytes:
+    """
+    Prefixes a JPEG with the frame header, stamped with the current time as
+    its send time.
+
+    Args:
+        info (FrameInfo): The metadata of the frame.
+        frame_data (bytes | memoryview): The encoded frame, copied once
+            into the message.
+
+    Returns:
+        bytes: The WebSocket message.
+    """
+    return b"".join((frame_header(info), frame_data))
+
+
+def frame_header(info: FrameInfo) -> bytes:
+    """
+    Packs the frame header of a frame, stamped with the current time as its
+    send time.
+    """
+    return FRAME_HEADER.pack(
+        PROTOCOL_VERSION,
+        FRAME_HEADER.size,
+        info.rendition_id,
+        info.cam_id,
+        info.seq & SEQ_MASK,
+        info.captured_at,
+        info.encoded_at,
+        time.time(),
+    )
+
+
+def unpack_frame(message: bytes) -> tuple[FrameInfo, float, bytes]:
+    """
+    Splits a framed message back into its metadata, send time and JPEG.
+
+    Raises:
+        ValueError: If the message is not a supported frame.
+    """
+    if len(message) < FRAME_HEADER.size or message[0] != PROTOCOL_VERSION:
+        raise ValueError("Unsupported frame")
+    _, size, rendition_id, cam_id, seq, captured_at, encoded_at, sent_at = (
+        FRAME_HEADER.unpack_from(message)
+    )
+    info = FrameInfo(cam_id, seq, captured_at, encoded_at, rendition_id)
+    return info, sent_at, message[size:]
+
+
+def pack_relay_frame(frames: list[tuple[FrameInfo, bytes | memoryview]]) -> bytes:
+    """
+    Packs every rendition of a frame into a single relay message.
+
+    Args:
+        frames (list[tuple[FrameInfo, bytes | memoryview]]): The metadata and
+            encoded data of each rendition.
+
+    Returns:
+        bytes: The WebSocket message.
+    """
+    parts = []
+    for info, frame_data in frames:
+        parts += [
+            RELAY_LENGTH.pack(FRAME_HEADER.size + len(frame_data)),
+            frame_header(info),
+            frame_data,
+        ]
+    return b"".join(parts)
+
+
+def unpack_relay_frame(message: bytes) -> list[tuple[FrameInfo, memoryview]]:
+    """
+    Splits a relay message back into the metadata and data of each
+    rendition, without copying the data.
+
+    Raises:
+        ValueError: If the message is truncated or holds an unsupported frame.
+    """
+    view = memoryview(message)
+    frames = []
+    offset = 0
+    while offset < len(view):
+        if offset + RELAY_LENGTH.size > len(view):
+            raise ValueError("Truncated relay message")
+        (length,) = RELAY_LENGTH.unpack_from(view, offset)
+        offset += RELAY_LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("Truncated relay message")
+        info, _, frame_data = unpack_frame(view[offset : offset + length])
+        frames.append((info, frame_data))
+        offset += length
+    return frames
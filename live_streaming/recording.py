@@ -0,0 +1,272 @@
+import asyncio
+import mmap
+import struct
+import time
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from pathlib import Path
+
+import numpy as np
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .flow import FrameRateController, LatestFrame
+from .hub import get_hub
+from .models import RecordingPolicy, RecordingSegment
+from .renditions import select_rendition
+
+# One entry per frame of a segment: capture time, offset and length of the JPEG
+INDEX_ENTRY = struct.Struct("<dQI")
+INDEX_DTYPE = np.dtype([("captured_at", "<f8"), ("offset", "<u8"), ("length", "<u4")])
+# Byte ranges of segments are streamed in chunks of this size
+RANGE_CHUNK_SIZE = 64 * 1024
+# Shortest retention applied, so pruning never reaches a segment still being
+# written, whose end time is its start time until it is finished
+MIN_RETENTION_HOURS = 1
+
+
+def recording_root() -> Path:
+    return Path(settings.STREAM_RECORDING_DIR)
+
+
+def index_path(path: Path) -> Path:
+    return path.with_suffix(".idx")
+
+
+def to_datetime(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+
+
+class SegmentWriter:
+    """
+    Appends JPEG frames to a segment file and records each frame's capture
+    time and byte range in a sidecar index file.
+
+    Segments are plain concatenations of JPEGs, so any byte range returned by
+    the index can be served as is without decoding or re-muxing.
+    """
+
+    def __init__(self, cam_id: int, started_at: float):
+        self.started_at = started_at
+        self.ended_at = started_at
+        self.size = 0
+        self.frame_count = 0
+        self.relative_path = f"{cam_id}/{int(started_at * 1000)}.mjpeg"
+        path = recording_root() / self.relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.data = open(path, "ab")
+        self.index = open(index_path(path), "ab")
+
+    def append(self, frame_data: bytes, captured_at: float) -> None:
+        """
+        Appends a frame. Blocking, meant to run off the event loop.
+        """
+        self.data.write(frame_data)
+        # Readers must never find an index entry pointing past the data
+        self.data.flush()
+        self.index.write(INDEX_ENTRY.pack(captured_at, self.size, len(frame_data)))
+        self.index.flush()
+        self.size += len(frame_data)
+        self.frame_count += 1
+        self.ended_at = captured_at
+
+    def close(self) -> None:
+        self.data.close()
+        self.index.close()
+
+
+class SegmentReader:
+    """
+    Memory-maps a segment and its frame index for playback.
+
+    Only the pages holding the requested frames are read from disk, whatever
+    the size of the segment.
+    """
+
+    def __init__(self, relative_path: str):
+        self.path = recording_root() / relative_path
+        self._file = open(self.path, "rb")
+        size = self.path.stat().st_size
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        frames = index_path(self.path).stat().st_size // INDEX_DTYPE.itemsize
+        self.index = (
+            np.memmap(index_path(self.path), dtype=INDEX_DTYPE, mode="r", shape=(frames,))
+            if frames
+            else np.empty(0, dtype=INDEX_DTYPE)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def frame_at(self, timestamp: float) -> tuple[float, bytes] | None:
+        """
+        Returns the last frame captured at or before a time.
+
+        Args:
+            timestamp (float): The requested time, as a Unix timestamp.
+
+        Returns:
+            tuple[float, bytes] | None: The capture time and JPEG of the frame,
+            or `None` if the segment has no frame yet.
+        """
+        if not len(self.index):
+            return None
+        position = np.searchsorted(self.index["captured_at"], timestamp, side="right")
+        entry = self.index[max(position - 1, 0)]
+        offset, length = int(entry["offset"]), int(entry["length"])
+        if offset + length > self.size:
+            return None
+        return float(entry["captured_at"]), self.data[offset : offset + length]
+
+    def close(self) -> None:
+        self.index = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+
+
+def read_range(path: Path, start: int, end: int):
+    """
+    Yields the bytes of a segment file between two offsets, `end` excluded,
+    in chunks of `RANGE_CHUNK_SIZE`, so serving a range of any length only
+    holds one chunk in memory.
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = file.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+@database_sync_to_async
+def create_segment(cam_id: int, writer: SegmentWriter) -> RecordingSegment:
+    return RecordingSegment.objects.create(
+        camera_id=cam_id,
+        started_at=to_datetime(writer.started_at),
+        ended_at=to_datetime(writer.ended_at),
+        path=writer.relative_path,
+    )
+
+
+@database_sync_to_async
+def finish_segment(segment: RecordingSegment, writer: SegmentWriter) -> None:
+    segment.ended_at = to_datetime(writer.ended_at)
+    segment.size = writer.size
+    segment.frame_count = writer.frame_count
+    segment.save(update_fields=["ended_at", "size", "frame_count"])
+
+
+class CameraRecorder:
+    """
+    Records a camera into segments of `STREAM_SEGMENT_SECONDS`, at most
+    `STREAM_RECORDING_FPS` frames per second.
+
+    The recorder is an ordinary subscriber of the camera's `CameraHub` in
+    the process it runs in. Run by the `record_cameras` command, that is a
+    process of its own, which opens and decodes the camera again even when
+    somebody is watching it through the ASGI process, in its capture worker
+    when `STREAM_CAPTURE_WORKERS` is set.
+    """
+
+    def __init__(self, cam_id: int, cam_url: str, environment: str | None = None):
+        self.cam_id = cam_id
+        self.cam_url = cam_url
+        self.environment = environment
+        self.rendition = select_rendition(
+            settings.STREAM_RECORDING_WIDTH, settings.STREAM_RECORDING_QUALITY
+        )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        interval = 1 / settings.STREAM_RECORDING_FPS
+        mailbox = LatestFrame()
+        hub = get_hub(self.cam_id, self.cam_url, self.environment)
+        hub.subscribe(
+            mailbox,
+            self.rendition,
+            FrameRateController(
+                settings.STREAM_RECORDING_FPS, settings.STREAM_RECORDING_FPS
+            ),
+        )
+        writer = segment = None
+        try:
+            while True:
+                frame_data = await mailbox.get()
+                if frame_data is None:
+                    break
+                captured_at = mailbox.info.captured_at if mailbox.info else time.time()
+                if (
+                    writer is None
+                    or captured_at - writer.started_at >= settings.STREAM_SEGMENT_SECONDS
+                ):
+                    if writer is not None:
+                        await self.finish(segment, writer)
+                    writer = SegmentWriter(self.cam_id, captured_at)
+                    segment = await create_segment(self.cam_id, writer)
+                await loop.run_in_executor(None, writer.append, frame_data, captured_at)
+                await asyncio.sleep(interval)
+        finally:
+            hub.unsubscribe(mailbox)
+            if writer is not None:
+                await self.finish(segment, writer)
+
+    async def finish(self, segment: RecordingSegment, writer: SegmentWriter) -> None:
+        writer.close()
+        await finish_segment(segment, writer)
+
+
+def prune_recordings(now: datetime | None = None) -> int:
+    """
+    Deletes every segment older than the retention of its camera, in a single
+    query, then removes the segment files. Retentions shorter than
+    `MIN_RETENTION_HOURS` are raised to it.
+
+    Args:
+        now (datetime | None): The current time, `timezone.now()` by default.
+
+    Returns:
+        int: The number of deleted segments.
+    """
+    now = now or timezone.now()
+    expired = Q(
+        camera__recording_policy__isnull=True,
+        ended_at__lt=retention_cutoff(now, settings.STREAM_RECORDING_RETENTION_HOURS),
+    )
+    for hours in set(
+        RecordingPolicy.objects.values_list("retention_hours", flat=True)
+    ):
+        expired |= Q(
+            camera__recording_policy__retention_hours=hours,
+            ended_at__lt=retention_cutoff(now, hours),
+        )
+    segments = RecordingSegment.objects.filter(expired)
+    paths = list(segments.values_list("path", flat=True))
+    segments.delete()
+    root = recording_root()
+    for path in paths:
+        (root / path).unlink(missing_ok=True)
+        index_path(root / path).unlink(missing_ok=True)
+    return len(paths)
+
+
+def retention_cutoff(now: datetime, hours: int) -> datetime:
+    """
+    Returns the end time before which segments kept for `hours` expire.
+    """
+    return now - timedelta(
+        hours=max(hours, MIN_RETENTION_HOURS),
+        seconds=settings.STREAM_SEGMENT_SECONDS,
+    )
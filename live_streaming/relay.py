@@ -0,0 +1,242 @@
+import asyncio
+import json
+import random
+import threading
+from typing import Callable
+from urllib.parse import urlencode, urlsplit
+
+import aiohttp
+from django.conf import settings
+
+from .protocol import FrameInfo, unpack_relay_frame
+from .renditions import RENDITIONS, Rendition
+
+# Header carrying STREAM_RELAY_TOKEN on relay connections
+RELAY_TOKEN_HEADER = "X-Relay-Token"
+
+
+class RelayReader(threading.Thread):
+    """
+    Receives the frames of a camera from the node owning it and passes them
+    to `on_frame`, the same way a `CaptureReader` does, so the viewers of
+    every node share the single capture of the owner.
+
+    The reader connects to `ws/relay/<cam_id>/` on the owner and forwards
+    the renditions, frame rate and refresh requests of the local hub, which
+    the owner then subscribes to for it. Every message holds all the
+    renditions of one frame. A lost connection is reopened with jittered
+    exponential backoff, like a camera, until the reader is stopped or the
+    owner closes the relay normally because the stream has ended; a hub
+    whose camera moved to another node replaces its reader instead.
+    """
+
+    def __init__(self, cam_id: int, node_url: str, on_frame: Callable[..., None]):
+        super().__init__(name=f"relay-{cam_id}", daemon=True)
+        self.cam_id = cam_id
+        self.node_url = node_url.rstrip("/")
+        self.on_frame = on_frame
+        self.attempts = 0
+        self._renditions: frozenset[Rendition] = frozenset()
+        self._fps = settings.STREAM_MAX_FPS
+        self._stopped = threading.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        self._socket: aiohttp.ClientWebSocketResponse | None = None
+
+    @property
+    def renditions(self) -> frozenset[Rendition]:
+        return self._renditions
+
+    @renditions.setter
+    def renditions(self, renditions: frozenset[Rendition]) -> None:
+        self._renditions = renditions
+        self._send({"type": "renditions", "ids": [r.id for r in renditions]})
+
+    @property
+    def fps(self) -> float:
+        return self._fps
+
+    @fps.setter
+    def fps(self, fps: float) -> None:
+        self._fps = fps
+        self._send({"type": "fps", "fps": fps})
+
+    def refresh(self) -> None:
+        self._send({"type": "refresh"})
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._task.cancel)
+            except RuntimeError:
+                # The relay has already finished
+                pass
+
+    def _send(self, message: dict) -> None:
+        """
+        Sends a request to the owner, if connected. Requests made while
+        disconnected are part of the query string of the next connection.
+        """
+        if self._loop is None:
+            return
+
+        def send():
+            if self._socket is not None and not self._socket.closed:
+                asyncio.ensure_future(self._socket.send_str(json.dumps(message)))
+
+        try:
+            self._loop.call_soon_threadsafe(send)
+        except RuntimeError:
+            pass
+
+    def run(self):
+        try:
+            asyncio.run(self.relay())
+        finally:
+            self.on_frame(None)
+
+    async def relay(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        if self._stopped.is_set():
+            return
+        try:
+            async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    total=None, connect=settings.STREAM_OPEN_TIMEOUT
+                )
+            ) as session:
+                while not self._stopped.is_set():
+                    if self.attempts:
+                        # Full jitter keeps relays that failed together from
+                        # reconnecting in lockstep
+                        await asyncio.sleep(
+                            random.uniform(
+                                0,
+                                min(
+                                    settings.STREAM_RECONNECT_MAX_DELAY,
+                                    settings.STREAM_RECONNECT_BASE_DELAY
+                                    * 2**self.attempts,
+                                ),
+                            )
+                        )
+                    self.attempts += 1
+                    try:
+                        await self.receive(session)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                        print(f"Relay of camera {self.cam_id} failed: {exc!r}")
+        except asyncio.CancelledError:
+            pass
+
+    async def receive(self, session: aiohttp.ClientSession) -> None:
+        """
+        Receives the frames of the camera over one connection to the owner.
+        """
+        query = urlencode(
+            {
+                "renditions": ",".join(str(r.id) for r in self._renditions),
+                "fps": self._fps,
+            }
+        )
+        parts = urlsplit(self.node_url)
+        origin = f"{'https' if parts.scheme == 'wss' else 'http'}://{parts.netloc}"
+        async with session.ws_connect(
+            f"{self.node_url}/ws/relay/{self.cam_id}/?{query}",
+            headers={RELAY_TOKEN_HEADER: settings.STREAM_RELAY_TOKEN or ""},
+            origin=origin,
+            heartbeat=settings.STREAM_READ_TIMEOUT,
+        ) as socket:
+            self._socket = socket
+            try:
+                async for message in socket:
+                    if message.type != aiohttp.WSMsgType.BINARY:
+                        continue
+                    try:
+                        frames = unpack_relay_frame(message.data)
+                    except ValueError:
+                        continue
+                    if not frames:
+                        continue
+                    self.attempts = 0
+                    encoded = {
+                        RENDITIONS[info.rendition_id]: frame_data
+                        for info, frame_data in frames
+                        if info.rendition_id < len(RENDITIONS)
+                    }
+                    info = frames[0][0]
+                    self.on_frame(encoded, info.captured_at, info.encoded_at)
+            finally:
+                self._socket = None
+            if socket.close_code == aiohttp.WSCloseCode.OK:
+                # The owner closes the relay normally once the stream has ended
+                self._stopped.set()
+
+
+class RenditionSlot:
+    """
+    One rendition of a `RelayMailbox`, subscribed to a `CameraHub` like the
+    mailbox of a viewer.
+    """
+
+    def __init__(self, mailbox, rendition: Rendition):
+        self.mailbox = mailbox
+        self.rendition = rendition
+
+    def put(self, frame_data: bytes | memoryview | None, info=None) -> None:
+        self.mailbox.put(self.rendition, frame_data, info)
+
+
+class RelayMailbox:
+    """
+    Mailbox of a relay connection, collecting every rendition of the newest
+    frame of a camera.
+
+    A hub puts all the renditions of a frame at once, so the relay finds
+    them together. Renditions of an older frame still pending when a newer
+    one arrives are dropped, as a slow node is better off skipping frames.
+    """
+
+    def __init__(self):
+        self.frames: dict[int, tuple[FrameInfo, bytes | memoryview]] = {}
+        self.slots: dict[Rendition, RenditionSlot] = {}
+        self.closed = False
+        self.dropped = 0
+        self._seq = None
+        self._ready = asyncio.Event()
+
+    def slot(self, rendition: Rendition) -> RenditionSlot:
+        if rendition not in self.slots:
+            self.slots[rendition] = RenditionSlot(self, rendition)
+        return self.slots[rendition]
+
+    def put(
+        self,
+        rendition: Rendition,
+        frame_data: bytes | memoryview | None,
+        info: FrameInfo | None = None,
+    ) -> None:
+        if frame_data is None:
+            self.closed = True
+        else:
+            if info.seq != self._seq:
+                self.dropped += bool(self.frames)
+                self.frames = {}
+                self._seq = info.seq
+            self.frames[rendition.id] = (info, frame_data)
+        self._ready.set()
+
+    async def get(self) -> list[tuple[FrameInfo, bytes | memoryview]] | None:
+        """
+        Waits for the next frame.
+
+        Returns:
+            list[tuple[FrameInfo, bytes | memoryview]] | None: Every rendition
+            of the newest frame, or `None` once the stream has ended.
+        """
+        await self._ready.wait()
+        frames, self.frames = self.frames, {}
+        if self.closed:
+            return None
+        self._ready.clear()
+        return list(frames.values())
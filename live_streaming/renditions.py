@@ -0,0 +1,162 @@
+from typing import NamedTuple
+from urllib.parse import parse_qs
+
+import cv2 as cv
+import numpy as np
+
+
+class Rendition(NamedTuple):
+    """
+    A downscaled, re-compressed variant of a camera stream.
+
+    Attributes:
+        id (int): The position of the rendition in `RENDITIONS`.
+        max_width (int | None): The maximum frame width, `None` keeps the
+            source resolution.
+        quality (str): The name of the JPEG quality tier.
+    """
+
+    id: int
+    max_width: int | None
+    quality: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.max_width or 'source'}-{self.quality}"
+
+    @property
+    def jpeg_quality(self) -> int:
+        return QUALITY_TIERS[self.quality]
+
+
+RENDITION_WIDTHS = (320, 640, 1280, None)
+QUALITY_TIERS = {"low": 50, "medium": 70, "high": 90}
+DEFAULT_QUALITY = "high"
+
+RENDITIONS = [
+    Rendition(index, width, quality)
+    for index, (width, quality) in enumerate(
+        (width, quality) for width in RENDITION_WIDTHS for quality in QUALITY_TIERS
+    )
+]
+
+
+def select_rendition(
+    max_width: int | None = None, quality: str | None = None
+) -> Rendition:
+    """
+    Picks the smallest rendition of the ladder that is at least as wide as
+    requested, falling back to the source resolution.
+
+    Args:
+        max_width (int | None): The width the client displays the stream at.
+        quality (str | None): The name of the requested quality tier.
+
+    Returns:
+        Rendition: The matching rendition of the ladder.
+    """
+    if quality not in QUALITY_TIERS:
+        quality = DEFAULT_QUALITY
+    width = None
+    if max_width:
+        width = next(
+            (w for w in RENDITION_WIDTHS if w is not None and w >= max_width), None
+        )
+    return next(r for r in RENDITIONS if r.max_width == width and r.quality == quality)
+
+
+def rendition_from_query(query_string: str) -> Rendition:
+    """
+    Picks the rendition requested through the `max_width` and `quality`
+    parameters of a query string.
+
+    Args:
+        query_string (str): The raw query string of the request.
+
+    Returns:
+        Rendition: The matching rendition of the ladder.
+    """
+    query = parse_qs(query_string)
+    max_width = query.get("max_width", [""])[0]
+    return select_rendition(
+        max_width=int(max_width) if max_width.isdigit() else None,
+        quality=query.get("quality", [None])[0],
+    )
+
+
+def encode_rendition(frame: np.ndarray, rendition: Rendition) -> bytes | None:
+    """
+    Downscales a frame to the width of a rendition and encodes it as JPEG.
+
+    Args:
+        frame (np.ndarray): The decoded BGR frame.
+        rendition (Rendition): The rendition to produce.
+
+    Returns:
+        bytes | None: The encoded frame, or `None` if encoding failed.
+    """
+    height, width = frame.shape[:2]
+    if rendition.max_width and width > rendition.max_width:
+        size = (rendition.max_width, round(height * rendition.max_width / width))
+        frame = cv.resize(frame, size, interpolation=cv.INTER_AREA)
+    ret, buffer = cv.imencode(
+        ".jpg", frame, [cv.IMWRITE_JPEG_QUALITY, rendition.jpeg_quality]
+    )
+    if not ret:
+        return None
+    return buffer.tobytes()
+
+
+class RenditionEncoder:
+    """
+    Encodes the frames of one camera into renditions without allocating a
+    new frame for each of them.
+
+    The downscaled frame of each size is drawn into a buffer allocated once
+    and reused for every following frame of the same size. The JPEG comes
+    back as a `memoryview` of the buffer OpenCV encoded it into instead of a
+    `bytes` copy of it, which is all it takes to prefix it with a frame
+    header, send it or write it to a capture worker's ring. Not thread-safe,
+    meant to be owned by the capture thread of the camera.
+    """
+
+    def __init__(self):
+        self._scaled: dict[tuple[int, int], np.ndarray] = {}
+
+    def scale(self, frame: np.ndarray, max_width: int | None) -> np.ndarray:
+        """
+        Downscales a frame to `max_width`, into the buffer of that size.
+
+        Returns:
+            np.ndarray: The frame itself if it is not wider than `max_width`,
+            otherwise the reused buffer holding the downscaled frame.
+        """
+        height, width = frame.shape[:2]
+        if not max_width or width <= max_width:
+            return frame
+        size = (max_width, round(height * max_width / width))
+        scaled = cv.resize(
+            frame, size, dst=self._scaled.get(size), interpolation=cv.INTER_AREA
+        )
+        self._scaled[size] = scaled
+        return scaled
+
+    def encode(self, frame: np.ndarray, rendition: Rendition) -> memoryview | None:
+        """
+        Downscales a frame to the width of a rendition and encodes it as JPEG.
+
+        Args:
+            frame (np.ndarray): The decoded BGR frame.
+            rendition (Rendition): The rendition to produce.
+
+        Returns:
+            memoryview | None: The encoded frame, or `None` if encoding failed.
+        """
+        ret, buffer = cv.imencode(
+            ".jpg",
+            self.scale(frame, rendition.max_width),
+            [cv.IMWRITE_JPEG_QUALITY, rendition.jpeg_quality],
+        )
+        if not ret:
+            return None
+        return buffer.reshape(-1).data
@@ -1,7 +1,15 @@
 from django.urls import re_path
 
-from .consumers import CameraConsumer
+from .consumers import (
+    CameraConsumer,
+    MosaicConsumer,
+    MultiplexConsumer,
+    RelayConsumer,
+)
 
 websocket_urlpatterns = [
     re_path(r"ws/live_stream/(?P<cam_id>\d+)/$", CameraConsumer.as_asgi()),
+    re_path(r"ws/mosaic/$", MosaicConsumer.as_asgi()),
+    re_path(r"ws/cameras/$", MultiplexConsumer.as_asgi()),
+    re_path(r"ws/relay/(?P<cam_id>\d+)/$", RelayConsumer.as_asgi()),
 ]
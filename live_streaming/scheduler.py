@@ -0,0 +1,224 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from . import metrics
+
+# Weight of the cameras of owners without an active subscription
+DEFAULT_TIER = "basic"
+# Cost assumed for the first frame of a camera, in CPU seconds
+INITIAL_COST = 0.01
+# Weight of the newest frame in the average cost of a camera
+COST_SMOOTHING = 0.2
+# Seconds of budget that may be spent at once after an idle period
+BURST_SECONDS = 0.1
+
+
+def camera_tier(cam_id: int) -> str:
+    """
+    Returns the best plan among the active subscriptions of the owner of a
+    camera, or `DEFAULT_TIER` if there is none.
+
+    Runs one query and closes the connection of the calling thread, meant to
+    be called once from a capture thread when it starts.
+    """
+    # Imported here as capture workers load this module before setting Django up
+    from payment.models import Subscription
+
+    now = timezone.now()
+    try:
+        tiers = list(
+            Subscription.objects.filter(
+                user__cameras__id=cam_id, start_date__lte=now, end_date__gt=now
+            ).values_list("plan__name", flat=True)
+        )
+    except Exception as exc:
+        print(f"Failed to load the subscription tier of camera {cam_id}: {exc!r}")
+        tiers = []
+    finally:
+        connection.close()
+    return max(tiers, key=tier_weight, default=DEFAULT_TIER)
+
+
+def tier_weight(tier: str) -> float:
+    weights = settings.STREAM_TIER_WEIGHTS
+    return weights.get(tier, weights.get(DEFAULT_TIER, 1.0))
+
+
+class CameraShare:
+    """
+    The place of a camera in the `FrameScheduler`.
+
+    Attributes:
+        cam_id (int): The ID of the camera.
+        tier (str): The plan of the owner of the camera.
+        weight (float): The share of the budget of the camera relative to
+            the other cameras, from `STREAM_TIER_WEIGHTS`.
+        cost (float): The average CPU time of a frame of the camera.
+        finish (float): The virtual time at which the last frame granted to
+            the camera is done.
+        start (float | None): The virtual start of the last refused request,
+            kept so a camera whose frames are refused does not lose its place
+            in the queue.
+    """
+
+    __slots__ = ("cam_id", "tier", "weight", "cost", "finish", "start", "granted")
+
+    def __init__(self, cam_id: int, tier: str, weight: float):
+        self.cam_id = cam_id
+        self.tier = tier
+        self.weight = weight
+        self.cost = INITIAL_COST
+        self.finish = 0.0
+        self.start = None
+        self.granted = 0.0
+
+
+class FrameScheduler:
+    """
+    Shares the CPU time of the process available for decoding and encoding
+    frames between cameras, by the tier of their owner.
+
+    Capture threads ask for a slot before decoding each frame. Slots are
+    handed out by weighted fair queuing: a request is tagged with the
+    virtual time at which it would finish if the camera got `weight` times
+    its share of the budget, and the smallest tag is served first, charging
+    the average CPU cost of a frame of the camera against a budget refilled
+    at `capacity` CPU seconds per second. While the budget suffices, every
+    request is served at once; once it runs out, cameras get CPU time in
+    proportion to their weight and requests still waiting after a frame
+    interval are refused, so the reader grabs the frame without decoding it.
+    Basic cameras therefore lose frame rate first and premium cameras last.
+    The cost of each camera is measured from the CPU time of its frames, so
+    heavy cameras use their share up with fewer frames.
+
+    A `capacity` of 0 turns scheduling off and grants every request.
+    """
+
+    def __init__(self, capacity: float | None = None):
+        if capacity is None:
+            capacity = (os.cpu_count() or 1) * settings.STREAM_FRAME_BUDGET
+        self.shares: dict[int, CameraShare] = {}
+        self._waiting: list[tuple[float, int, CameraShare]] = []
+        self._order = itertools.count()
+        self._virtual_time = 0.0
+        self._cond = threading.Condition()
+        self.set_capacity(capacity)
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def set_capacity(self, capacity: float) -> None:
+        """
+        Changes the CPU seconds per second shared between cameras.
+        """
+        with self._cond:
+            self.capacity = capacity
+            self._tokens = capacity * BURST_SECONDS
+            self._refilled_at = time.monotonic()
+            self._cond.notify_all()
+
+    def register(self, cam_id: int) -> CameraShare:
+        """
+        Adds a camera to the scheduler, looking the tier of its owner up
+        when scheduling is on. Blocking.
+        """
+        tier = camera_tier(cam_id) if self.enabled else DEFAULT_TIER
+        share = CameraShare(cam_id, tier, tier_weight(tier))
+        with self._cond:
+            self.shares[cam_id] = share
+        return share
+
+    def unregister(self, share: CameraShare) -> None:
+        with self._cond:
+            if self.shares.get(share.cam_id) is share:
+                del self.shares[share.cam_id]
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity * BURST_SECONDS,
+            self._tokens + (now - self._refilled_at) * self.capacity,
+        )
+        self._refilled_at = now
+
+    def acquire(self, share: CameraShare, timeout: float) -> bool:
+        """
+        Waits for the slot of the next frame of a camera.
+
+        Args:
+            share (CameraShare): The camera asking for a slot.
+            timeout (float): How long the frame may wait, usually the frame
+                interval of the camera.
+
+        Returns:
+            bool: Whether the frame may be decoded, `False` if the slot was
+            not granted before the timeout.
+        """
+        if not self.enabled:
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            start = share.start
+            if start is None:
+                start = max(self._virtual_time, share.finish)
+            request = (start + share.cost / share.weight, next(self._order), share)
+            heapq.heappush(self._waiting, request)
+            while True:
+                self._refill()
+                if self._waiting[0] is request and self._tokens > 0:
+                    heapq.heappop(self._waiting)
+                    self._tokens -= share.cost
+                    self._virtual_time = max(self._virtual_time, start)
+                    share.finish = request[0]
+                    share.start = None
+                    share.granted = share.cost
+                    self._cond.notify_all()
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(request)
+                    heapq.heapify(self._waiting)
+                    share.start = start
+                    self._cond.notify_all()
+                    return False
+                if self._tokens <= 0:
+                    remaining = min(remaining, -self._tokens / self.capacity + 0.001)
+                self._cond.wait(remaining)
+
+    def release(self, share: CameraShare, cost: float) -> None:
+        """
+        Records the CPU time actually spent on a granted frame.
+
+        Args:
+            share (CameraShare): The camera the slot was granted to.
+            cost (float): The CPU seconds spent decoding and encoding it.
+        """
+        if not self.enabled:
+            return
+        with self._cond:
+            self._tokens += share.granted - cost
+            share.granted = 0.0
+            share.cost += COST_SMOOTHING * (cost - share.cost)
+            self._cond.notify_all()
+
+    def costs(self) -> dict[tuple, float]:
+        """
+        Returns the average frame cost of every camera, by camera and tier.
+        """
+        return {
+            (share.cam_id, share.tier): share.cost
+            for share in list(self.shares.values())
+        }
+
+
+frame_scheduler = FrameScheduler()
+
+metrics.frame_cost_seconds.set_function(frame_scheduler.costs)
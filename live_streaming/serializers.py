@@ -0,0 +1,27 @@
+from typing import Any
+
+from rest_framework import serializers
+
+from .models import RecordingPolicy, RecordingSegment
+
+
+class RecordingPolicySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RecordingPolicy
+        exclude = ("id", "camera")
+
+    def validate(self, attrs: dict[str, Any]) -> dict[str, Any]:
+        mode = attrs.get("mode", getattr(self.instance, "mode", "off"))
+        start_time = attrs.get("start_time", getattr(self.instance, "start_time", None))
+        end_time = attrs.get("end_time", getattr(self.instance, "end_time", None))
+        if mode == "scheduled" and (start_time is None or end_time is None):
+            raise serializers.ValidationError(
+                "Scheduled recording requires a start_time and an end_time."
+            )
+        return attrs
+
+
+class RecordingSegmentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RecordingSegment
+        fields = ("id", "started_at", "ended_at", "size", "frame_count")
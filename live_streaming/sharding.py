@@ -0,0 +1,230 @@
+import atexit
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Iterable
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def ring_hash(key: str) -> int:
+    """
+    Returns a stable 64-bit hash of a key, the same on every node.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring assigning cameras to streaming nodes.
+
+    Every node is placed on the ring at `replicas` points and a camera
+    belongs to the node of the first point following the hash of its ID.
+    A node joining only takes over the cameras falling just before its
+    points, about one in `n` of them, and a node leaving only hands its own
+    cameras over to the nodes next to its points: every other camera keeps
+    its node.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int | None = None):
+        self.replicas = settings.STREAM_HASH_REPLICAS if replicas is None else replicas
+        self.nodes = frozenset(nodes)
+        points = sorted(
+            (ring_hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(self.replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, cam_id: int) -> str | None:
+        """
+        Returns the node a camera belongs to, or `None` if the ring is empty.
+        """
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, ring_hash(f"camera:{cam_id}"))
+        return self._owners[index % len(self._owners)]
+
+
+class LocalNodeRegistry:
+    """
+    In-memory registry of streaming nodes, for tests and for a fixed set of
+    nodes listed in `STREAM_NODES`.
+    """
+
+    def __init__(self, nodes: dict[str, str] | None = None):
+        self._nodes = dict(nodes or {})
+        self._lock = threading.Lock()
+
+    def heartbeat(self, name: str, url: str) -> None:
+        with self._lock:
+            self._nodes[name] = url
+
+    def leave(self, name: str) -> None:
+        with self._lock:
+            self._nodes.pop(name, None)
+
+    def live_nodes(self) -> dict[str, str]:
+        with self._lock:
+            return dict(self._nodes)
+
+
+class DatabaseNodeRegistry:
+    """
+    Registry of streaming nodes kept in the `StreamingNode` table shared by
+    every node. Nodes refresh their row on every heartbeat and count as gone
+    once they have missed `STREAM_NODE_TTL` seconds of heartbeats.
+    """
+
+    def heartbeat(self, name: str, url: str) -> None:
+        # Imported here as capture workers load this module before setting Django up
+        from .models import StreamingNode
+
+        StreamingNode.objects.update_or_create(
+            name=name, defaults={"url": url, "heartbeat_at": timezone.now()}
+        )
+
+    def leave(self, name: str) -> None:
+        from .models import StreamingNode
+
+        StreamingNode.objects.filter(name=name).delete()
+
+    def live_nodes(self) -> dict[str, str]:
+        from .models import StreamingNode
+
+        since = timezone.now() - timedelta(seconds=settings.STREAM_NODE_TTL)
+        return dict(
+            StreamingNode.objects.filter(heartbeat_at__gte=since).values_list(
+                "name", "url"
+            )
+        )
+
+
+class NodeCluster:
+    """
+    This node's view of the streaming nodes and of which node owns each
+    camera.
+
+    Only the owner of a camera connects to it, other nodes relay its frames
+    from the owner, so every camera has a single capture however viewers
+    are spread by the load balancer. A background thread sends a heartbeat
+    to the `registry` every `STREAM_NODE_HEARTBEAT` seconds, started on the
+    first lookup, and rebuilds the `HashRing` whenever nodes joined or left,
+    calling every function in `changed` so running cameras move to their
+    new owner. Until the first heartbeat the node owns every camera.
+
+    Attributes:
+        name (str): The name of this node.
+        url (str): The WebSocket base URL other nodes reach this node at.
+        registry (LocalNodeRegistry | DatabaseNodeRegistry): Where nodes
+            announce themselves.
+        urls (dict[str, str]): The URL of every live node, by name.
+        changed (list[Callable[[], None]]): Called from the heartbeat thread
+            after the ring changed.
+    """
+
+    def __init__(self, name: str, url: str, registry):
+        self.name = name
+        self.url = url
+        self.registry = registry
+        self.urls = {name: url}
+        self.ring = HashRing([name])
+        self.changed: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._heartbeat: threading.Thread | None = None
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Builds the cluster of this node from the settings, or returns `None`
+        when `STREAM_NODE_NAME` is not set and the node streams every camera
+        itself.
+        """
+        if not settings.STREAM_NODE_NAME:
+            return None
+        if settings.STREAM_NODE_REGISTRY == "local":
+            registry = LocalNodeRegistry(settings.STREAM_NODES)
+        else:
+            registry = DatabaseNodeRegistry()
+        return cls(settings.STREAM_NODE_NAME, settings.STREAM_NODE_URL, registry)
+
+    def owner(self, cam_id: int) -> str:
+        """
+        Returns the name of the node owning a camera.
+        """
+        if self._heartbeat is None:
+            self.start()
+        return self.ring.owner(cam_id) or self.name
+
+    def is_local(self, cam_id: int) -> bool:
+        return self.owner(cam_id) == self.name
+
+    def start(self) -> None:
+        """
+        Starts the heartbeat thread, once.
+        """
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(
+                target=self.run, name="node-heartbeat", daemon=True
+            )
+            self._heartbeat.start()
+            atexit.register(self.leave)
+
+    def run(self) -> None:
+        while True:
+            if self.refresh():
+                for callback in self.changed:
+                    callback()
+            time.sleep(settings.STREAM_NODE_HEARTBEAT)
+
+    def refresh(self) -> bool:
+        """
+        Sends a heartbeat and rebuilds the ring if nodes joined or left.
+        Blocking.
+
+        Returns:
+            bool: Whether the ring changed.
+        """
+        close_old_connections()
+        try:
+            self.registry.heartbeat(self.name, self.url)
+            urls = self.registry.live_nodes()
+        except Exception as exc:
+            logger.warning("Failed to refresh the streaming nodes: %r", exc)
+            return False
+        finally:
+            close_old_connections()
+        urls[self.name] = self.url
+        if urls.keys() == self.urls.keys():
+            self.urls = urls
+            return False
+        logger.info("Streaming nodes changed: %s", ", ".join(sorted(urls)))
+        self.urls = urls
+        self.ring = HashRing(urls)
+        return True
+
+    def leave(self) -> None:
+        """
+        Removes this node from the registry, so others take its cameras over
+        without waiting for its heartbeats to expire.
+        """
+        close_old_connections()
+        try:
+            self.registry.leave(self.name)
+        except Exception as exc:
+            logger.warning("Failed to leave the streaming nodes: %r", exc)
+        finally:
+            close_old_connections()
+
+
+node_cluster = NodeCluster.from_settings()
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from pathlib import Path
+from typing import NamedTuple
+
+import cv2 as cv
+import numpy as np
+from django.conf import settings
+
+from .hub import find_hub
+from .renditions import encode_rendition, select_rendition
+from .synthetic import open_video
+
+
+class Snapshot(NamedTuple):
+    """
+    The latest JPEG of a camera.
+
+    Attributes:
+        data (bytes): The encoded image.
+        taken_at (float): When the image was captured, as a Unix timestamp.
+        etag (str): A strong validator of `data`, without quotes.
+    """
+
+    data: bytes
+    taken_at: float
+    etag: str
+
+    @classmethod
+    def of(cls, data: bytes, taken_at: float):
+        return cls(data, taken_at, hashlib.md5(data).hexdigest())
+
+
+def grab_frame(cam_url: str) -> np.ndarray | None:
+    """
+    Opens a camera just long enough to decode a single frame, giving up
+    after `STREAM_OPEN_TIMEOUT` and `STREAM_READ_TIMEOUT`.
+
+    Args:
+        cam_url (str): The stream URL of the camera.
+
+    Returns:
+        np.ndarray | None: The decoded frame, or `None` if the camera could
+        not be read.
+    """
+    camera = open_video(
+        cam_url,
+        [
+            cv.CAP_PROP_OPEN_TIMEOUT_MSEC,
+            int(settings.STREAM_OPEN_TIMEOUT * 1000),
+            cv.CAP_PROP_READ_TIMEOUT_MSEC,
+            int(settings.STREAM_READ_TIMEOUT * 1000),
+        ],
+    )
+    try:
+        success, frame = camera.read()
+    finally:
+        camera.release()
+    return frame if success else None
+
+
+class SnapshotCache:
+    """
+    Bounded, least-recently-used cache of the latest JPEG of each camera.
+
+    Snapshots are refreshed lazily, only when requested and at most once
+    every `STREAM_SNAPSHOT_MIN_INTERVAL` seconds per camera. A running
+    `CameraHub` is reused when someone is already watching the camera,
+    otherwise the camera is opened for a single frame on one of
+    `STREAM_SNAPSHOT_WORKERS` threads. Requests wait at most
+    `STREAM_SNAPSHOT_WAIT` seconds for it, so an unreachable camera does not
+    hold up the thread serving them. When `STREAM_SNAPSHOT_DIR` is set,
+    snapshots are also written to disk so they survive restarts and
+    evictions.
+    """
+
+    def __init__(self, max_entries: int | None = None, directory: str | None = None):
+        self.max_entries = max_entries or settings.STREAM_SNAPSHOT_CACHE_SIZE
+        directory = directory or settings.STREAM_SNAPSHOT_DIR
+        self.directory = Path(directory) if directory else None
+        self.rendition = select_rendition(settings.STREAM_SNAPSHOT_WIDTH, "medium")
+        self._entries: OrderedDict[int, Snapshot] = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing: dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(
+            settings.STREAM_SNAPSHOT_WORKERS, thread_name_prefix="snapshot"
+        )
+
+    def get(self, cam_id: int) -> Snapshot | None:
+        """
+        Returns the cached snapshot of a camera without refreshing it.
+        """
+        with self._lock:
+            snapshot = self._entries.get(cam_id)
+            if snapshot is not None:
+                self._entries.move_to_end(cam_id)
+                return snapshot
+        snapshot = self._read_file(cam_id)
+        if snapshot is not None:
+            self._store(cam_id, snapshot)
+        return snapshot
+
+    def put(self, cam_id: int, data: bytes, taken_at: float | None = None) -> Snapshot:
+        """
+        Stores a new snapshot of a camera.
+        """
+        snapshot = Snapshot.of(data, taken_at or time.time())
+        self._store(cam_id, snapshot)
+        self._write_file(cam_id, snapshot)
+        return snapshot
+
+    def latest(self, cam_id: int, cam_url: str) -> Snapshot | None:
+        """
+        Returns a snapshot of a camera, refreshing it if it is older than
+        `STREAM_SNAPSHOT_MIN_INTERVAL`.
+
+        Args:
+            cam_id (int): The ID of the camera.
+            cam_url (str): The stream URL of the camera.
+
+        Returns:
+            Snapshot | None: The snapshot, which is the previous one if the
+            refresh failed or is still running after `STREAM_SNAPSHOT_WAIT`,
+            or `None` if the camera has never been reachable.
+        """
+        snapshot = self.get(cam_id)
+        if (
+            snapshot is not None
+            and time.time() - snapshot.taken_at < settings.STREAM_SNAPSHOT_MIN_INTERVAL
+        ):
+            return snapshot
+        # Concurrent requests for the same camera wait for a single refresh
+        with self._lock:
+            refresh = self._refreshing.get(cam_id)
+            if refresh is None:
+                refresh = self._executor.submit(self._refresh, cam_id, cam_url)
+                self._refreshing[cam_id] = refresh
+        try:
+            return refresh.result(settings.STREAM_SNAPSHOT_WAIT) or snapshot
+        except FutureTimeoutError:
+            return snapshot
+
+    def _refresh(self, cam_id: int, cam_url: str) -> Snapshot | None:
+        """
+        Takes and stores a new snapshot of a camera. Blocking.
+        """
+        try:
+            data, taken_at = self._capture(cam_id, cam_url)
+            if data is None:
+                return None
+            return self.put(cam_id, data, taken_at)
+        finally:
+            with self._lock:
+                self._refreshing.pop(cam_id, None)
+
+    def _capture(self, cam_id: int, cam_url: str) -> tuple[bytes | None, float | None]:
+        """
+        Takes a new snapshot from the live hub of the camera if there is one,
+        otherwise straight from the camera.
+        """
+        hub = find_hub(cam_id)
+        latest = hub.latest if hub is not None else {}
+        if latest:
+            rendition = min(latest, key=lambda r: r.max_width or float("inf"))
+            if self.rendition.max_width is None or (
+                rendition.max_width and rendition.max_width <= self.rendition.max_width
+            ):
+                return bytes(latest[rendition]), hub.latest_at
+            frame = cv.imdecode(np.frombuffer(latest[rendition], np.uint8), cv.IMREAD_COLOR)
+            taken_at = hub.latest_at
+        else:
+            frame = grab_frame(cam_url)
+            taken_at = time.time()
+        if frame is None:
+            return None, None
+        return encode_rendition(frame, self.rendition), taken_at
+
+    def _store(self, cam_id: int, snapshot: Snapshot) -> None:
+        with self._lock:
+            self._entries[cam_id] = snapshot
+            self._entries.move_to_end(cam_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, cam_id: int) -> Path:
+        return self.directory / f"{cam_id}.jpg"
+
+    def _read_file(self, cam_id: int) -> Snapshot | None:
+        if self.directory is None:
+            return None
+        try:
+            path = self._path(cam_id)
+            return Snapshot.of(path.read_bytes(), path.stat().st_mtime)
+        except FileNotFoundError:
+            return None
+
+    def _write_file(self, cam_id: int, snapshot: Snapshot) -> None:
+        if self.directory is None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(cam_id)
+        temporary = path.with_suffix(".tmp")
+        temporary.write_bytes(snapshot.data)
+        os.utime(temporary, (snapshot.taken_at, snapshot.taken_at))
+        os.replace(temporary, path)
+
+
+snapshot_cache = SnapshotCache()
@@ -0,0 +1,190 @@
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import cv2 as cv
+import numpy as np
+from django.conf import settings
+
+SCHEME = "synthetic"
+PATTERNS = ("bars", "noise", "static")
+# SMPTE-style color bars, in BGR
+BAR_COLORS = (
+    (192, 192, 192),
+    (0, 192, 192),
+    (192, 192, 0),
+    (0, 192, 0),
+    (192, 0, 192),
+    (0, 0, 192),
+    (192, 0, 0),
+    (0, 0, 0),
+)
+
+
+class SyntheticCapture:
+    """
+    A stand-in for `cv.VideoCapture` producing frames without a camera, for
+    development and benchmarks.
+
+    The source is described by a `synthetic://` URL:
+
+    - `synthetic://1280x720?fps=30&pattern=bars` generates frames of the
+      given size with NumPy. `bars` scrolls color bars under a moving box
+      and the frame number, `noise` fills every frame with random pixels,
+      the worst case for JPEG, and `static` repeats the same frame, which
+      the motion gate drops.
+    - `synthetic:///path/to/video.mp4?fps=25` plays a local video file in a
+      loop, at the rate of the file unless `fps` is given.
+
+    Frames are paced like a live camera: `grab` blocks until the next frame
+    is due, and frames that fall behind are skipped rather than queued.
+    """
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        self.frame_index = 0
+        self.video = None
+        self.width = self.height = 0
+        self.fps = 0.0
+        self.pattern = query.get("pattern", ["bars"])[0]
+        try:
+            fps = float(query.get("fps", ["0"])[0])
+            if parts.netloc:
+                self.width, self.height = (int(n) for n in parts.netloc.split("x"))
+            elif parts.path:
+                self.video = cv.VideoCapture(parts.path)
+        except ValueError:
+            return
+        if self.video is not None:
+            fps = fps or self.video.get(cv.CAP_PROP_FPS)
+            self.width = int(self.video.get(cv.CAP_PROP_FRAME_WIDTH))
+            self.height = int(self.video.get(cv.CAP_PROP_FRAME_HEIGHT))
+        if not (0 < self.width <= 7680 and 0 < self.height <= 4320):
+            self.width = self.height = 0
+        self.fps = fps if fps > 0 else 30.0
+        self.interval = 1 / self.fps
+        self._due = time.monotonic()
+        self._strip = self._static = None
+        if self.video is None and self.isOpened():
+            self._prepare()
+
+    def _prepare(self) -> None:
+        """
+        Renders what the frames are drawn from once, so each frame is a copy
+        and a few small drawings.
+        """
+        bar_width = max(1, self.width // len(BAR_COLORS))
+        bars = np.empty((self.height, bar_width * len(BAR_COLORS), 3), np.uint8)
+        for index, color in enumerate(BAR_COLORS):
+            bars[:, index * bar_width : (index + 1) * bar_width] = color
+        # Twice as wide, so every scroll offset is a plain slice
+        self._strip = np.concatenate([bars, bars], axis=1)
+        self._static = np.ascontiguousarray(self._strip[:, : self.width])
+
+    def isOpened(self) -> bool:
+        if self.video is not None:
+            return self.video.isOpened()
+        return self.width > 0 and self.height > 0 and self.pattern in PATTERNS
+
+    def get(self, prop: int) -> float:
+        return {
+            cv.CAP_PROP_FPS: self.fps,
+            cv.CAP_PROP_FRAME_WIDTH: self.width,
+            cv.CAP_PROP_FRAME_HEIGHT: self.height,
+            cv.CAP_PROP_POS_FRAMES: self.frame_index,
+        }.get(prop, 0.0)
+
+    def set(self, prop: int, value: float) -> bool:
+        return False
+
+    def _wait(self) -> None:
+        delay = self._due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._due = max(self._due + self.interval, time.monotonic())
+
+    def grab(self) -> bool:
+        """
+        Waits for the next frame and advances to it.
+        """
+        if not self.isOpened():
+            return False
+        self._wait()
+        self.frame_index += 1
+        if self.video is None:
+            return True
+        if self.video.grab():
+            return True
+        # Start the file over once it has ended
+        self.video.set(cv.CAP_PROP_POS_FRAMES, 0)
+        return self.video.grab()
+
+    def retrieve(self, image: np.ndarray | None = None):
+        """
+        Returns the frame advanced to by `grab`, drawn into `image` when it
+        is given and has the right shape.
+        """
+        if self.video is not None:
+            return self.video.retrieve(image)
+        shape = (self.height, self.width, 3)
+        if image is None or image.shape != shape or image.dtype != np.uint8:
+            image = np.empty(shape, np.uint8)
+        if self.pattern == "static":
+            image[:] = self._static
+        elif self.pattern == "noise":
+            cv.randu(image, 0, 256)
+        else:
+            offset = (self.frame_index * 4) % (self._strip.shape[1] // 2)
+            image[:] = self._strip[:, offset : offset + self.width]
+            size = max(8, self.height // 6)
+            left = (self.frame_index * 8) % max(1, self.width - size)
+            top = (self.height - size) // 2
+            cv.rectangle(
+                image, (left, top), (left + size, top + size), (255, 255, 255), -1
+            )
+            cv.putText(
+                image,
+                str(self.frame_index),
+                (8, max(16, self.height // 12)),
+                cv.FONT_HERSHEY_SIMPLEX,
+                max(0.5, self.height / 480),
+                (255, 255, 255),
+                2,
+            )
+        return True, image
+
+    def read(self, image: np.ndarray | None = None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def release(self) -> None:
+        if self.video is not None:
+            self.video.release()
+        self.width = self.height = 0
+        self.video = None
+
+
+def is_synthetic(cam_url: str | None) -> bool:
+    return bool(cam_url) and urlsplit(cam_url).scheme == SCHEME
+
+
+def open_video(cam_url: str | None, params: list[int] | tuple = ()):
+    """
+    Opens the source of a camera: a `SyntheticCapture` for `synthetic://`
+    URLs when `STREAM_SYNTHETIC_CAMERAS` is on, the webcam when the URL is
+    empty, and a `cv.VideoCapture` of the URL otherwise.
+
+    Args:
+        cam_url (str | None): The stream URL of the camera.
+        params (list[int]): Properties passed to `cv.VideoCapture` when
+            opening, as alternating IDs and values.
+
+    Returns:
+        cv.VideoCapture | SyntheticCapture: The source, which may have
+        failed to open.
+    """
+    if settings.STREAM_SYNTHETIC_CAMERAS and is_synthetic(cam_url):
+        return SyntheticCapture(cam_url)
+    # Use 0 for webcam, replace with camera URL for IP camera
+    return cv.VideoCapture(cam_url if cam_url else 0, cv.CAP_ANY, list(params))
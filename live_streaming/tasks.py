@@ -0,0 +1,88 @@
+import asyncio
+from collections import Counter
+from typing import Coroutine
+
+from . import metrics
+from .hub import stop_all_hubs
+
+
+class StreamTaskRegistry:
+    """
+    Tracks the background streaming task of every connection of the process.
+
+    Consumers start their frame loop through `start` once the socket is
+    accepted, so `connect` returns and the consumer keeps processing client
+    messages and disconnects. `cancel` stops a task and waits for its cleanup
+    to run, and `shutdown` does so for every task when the server stops.
+    """
+
+    def __init__(self):
+        self.tasks: dict[asyncio.Task, str] = {}
+
+    def start(self, coroutine: Coroutine, kind: str) -> asyncio.Task:
+        """
+        Runs a streaming coroutine as a tracked task.
+
+        Args:
+            coroutine (Coroutine): The frame loop of a connection.
+            kind (str): The kind of stream, used to group the task counts.
+
+        Returns:
+            asyncio.Task: The running task.
+        """
+        task = asyncio.create_task(coroutine, name=f"stream-{kind}")
+        self.tasks[task] = kind
+        task.add_done_callback(self._forget)
+        return task
+
+    def _forget(self, task: asyncio.Task) -> None:
+        kind = self.tasks.pop(task, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Stream task {kind} failed: {task.exception()!r}")
+
+    async def cancel(self, task: asyncio.Task | None) -> None:
+        """
+        Cancels a task and waits until it has finished cleaning up.
+        """
+        if task is None or task is asyncio.current_task():
+            return
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    def counts(self) -> dict[str, int]:
+        """
+        Returns the number of running tasks of each kind.
+        """
+        return dict(Counter(list(self.tasks.values())))
+
+    async def shutdown(self) -> None:
+        """
+        Cancels every running task and stops every camera hub.
+        """
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        stop_all_hubs()
+
+
+stream_tasks = StreamTaskRegistry()
+
+metrics.stream_tasks.set_function(
+    lambda: {(kind,): count for kind, count in stream_tasks.counts().items()}
+)
+
+
+async def lifespan(scope, receive, send):
+    """
+    Handles the ASGI lifespan protocol, cleaning up the streams of the process
+    on shutdown for servers that implement it.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await stream_tasks.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
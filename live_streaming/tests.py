@@ -1,3 +1,1130 @@
-from django.test import TestCase
+import asyncio
+import queue
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from channels.testing import WebsocketCommunicator
+from rest_framework.test import APIRequestFactory, force_authenticate
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from camera_integration.models import Camera
+from camera_integration.views import CameraSnapshotView
+from user_authentication.models import Notification, User
+
+from .access import CameraAccess, CameraAccessCache, camera_access, camera_access_cache
+from .capture import SupervisedCapture
+from .consumers import MultiplexConsumer, StreamConsumer
+from .events import CameraEvent
+from .flow import FrameRateController, LatestFrame, StreamSession
+from .hub import find_hub, get_hub
+from .motion import MotionGate, motion_gate_for
+from .notifications import EventNotifier
+from .passthrough import (
+    NON_SYNC_SAMPLE,
+    Fragment,
+    FragmentMailbox,
+    codec_string,
+    find_box,
+    is_keyframe_fragment,
+    iter_boxes,
+    read_box,
+)
+from .protocol import (
+    FRAME_HEADER,
+    FrameInfo,
+    pack_frame,
+    pack_relay_frame,
+    unpack_frame,
+    unpack_relay_frame,
+)
+from .recording import read_range, retention_cutoff
+from .relay import RelayMailbox
+from .renditions import RENDITIONS
+from .scheduler import INITIAL_COST, CameraShare, FrameScheduler
+from .serializers import RecordingPolicySerializer
+from .snapshots import Snapshot
+from .sharding import HashRing, LocalNodeRegistry, NodeCluster
+from .tasks import stream_tasks
+from .views import generate_mjpeg, stream_metrics
+from .workers import FrameRing, report
+
+
+class FrameProtocolTests(SimpleTestCase):
+    def setUp(self):
+        self.info = FrameInfo(7, 42, 1700000000.25, 1700000000.5, 2)
+
+    def test_pack_frame_round_trip(self):
+        message = pack_frame(self.info, b"jpeg")
+
+        info, sent_at, frame_data = unpack_frame(message)
+
+        self.assertEqual(info, self.info)
+        self.assertGreaterEqual(sent_at, self.info.encoded_at)
+        self.assertEqual(bytes(frame_data), b"jpeg")
+
+    def test_pack_frame_accepts_memoryview(self):
+        message = pack_frame(self.info, memoryview(b"jpeg"))
+
+        self.assertEqual(message[FRAME_HEADER.size :], b"jpeg")
+
+    def test_unpack_frame_skips_header_size(self):
+        # Later versions may append fields the client does not know about
+        message = bytearray(pack_frame(self.info, b"jpeg"))
+        message[1] += 4
+        message[FRAME_HEADER.size : FRAME_HEADER.size] = b"\0" * 4
+
+        _, _, frame_data = unpack_frame(bytes(message))
+
+        self.assertEqual(bytes(frame_data), b"jpeg")
+
+    def test_unpack_frame_rejects_unsupported_frames(self):
+        with self.assertRaises(ValueError):
+            unpack_frame(b"\xff" * FRAME_HEADER.size)
+        with self.assertRaises(ValueError):
+            unpack_frame(pack_frame(self.info, b"")[:-1])
+
+    def test_sequence_number_wraps(self):
+        info, _, _ = unpack_frame(pack_frame(self.info._replace(seq=2**32 + 5), b""))
+
+        self.assertEqual(info.seq, 5)
+
+    def test_relay_frame_round_trip(self):
+        frames = [(self.info, b"small"), (self.info._replace(rendition_id=0), b"big")]
+
+        unpacked = unpack_relay_frame(pack_relay_frame(frames))
+
+        self.assertEqual(
+            [(info, bytes(frame_data)) for info, frame_data in unpacked], frames
+        )
+
+    def test_relay_frame_rejects_truncated_messages(self):
+        message = pack_relay_frame([(self.info, b"jpeg")])
+
+        with self.assertRaises(ValueError):
+            unpack_relay_frame(message[:-1])
+        with self.assertRaises(ValueError):
+            unpack_relay_frame(message[:2])
+
+
+@override_settings(STREAM_MIN_FPS=1, STREAM_MAX_FPS=30, STREAM_INITIAL_FPS=10)
+class FrameRateControllerTests(SimpleTestCase):
+    def test_starts_at_initial_rate(self):
+        self.assertEqual(FrameRateController().fps, 10)
+        self.assertEqual(FrameRateController(max_fps=4).fps, 4)
+
+    def test_acknowledgements_raise_rate_up_to_max(self):
+        rate = FrameRateController(max_fps=12)
+
+        for _ in range(3):
+            rate.acked(0.05)
+
+        self.assertEqual(rate.fps, 11.5)
+        rate.acked(0.05)
+        rate.acked(0.05)
+        self.assertEqual(rate.fps, 12)
+        self.assertGreater(rate.round_trip, 0)
+
+    def test_stalls_cut_rate_down_to_min(self):
+        rate = FrameRateController(min_fps=2)
+
+        rate.stalled()
+        self.assertEqual(rate.fps, 7.5)
+        for _ in range(10):
+            rate.stalled()
+        self.assertEqual(rate.fps, 2)
+
+    def test_limit_caps_rate(self):
+        rate = FrameRateController()
+
+        rate.limit(4)
+        rate.acked(0.01)
+
+        self.assertEqual(rate.fps, 4)
+        self.assertLessEqual(rate.min_fps, 4)
+
+
+@override_settings(
+    STREAM_MIN_FPS=1,
+    STREAM_MAX_FPS=1000,
+    STREAM_INITIAL_FPS=1000,
+    STREAM_ACK_WINDOW=2,
+    STREAM_ACK_TIMEOUT=0.2,
+)
+class StreamSessionTests(SimpleTestCase):
+    def send(self, session, seq=None):
+        session.frame_sent(10, 0.0, None, seq)
+
+    def test_rate_holds_without_acknowledgements(self):
+        session = StreamSession()
+
+        for seq in range(10):
+            asyncio.run(session.wait_turn())
+            self.send(session, seq)
+
+        self.assertEqual(session.rate.fps, 1000)
+        self.assertFalse(session.acking)
+
+    def test_acknowledging_a_frame_acknowledges_earlier_ones(self):
+        session = StreamSession()
+        for seq in range(3):
+            self.send(session, seq)
+
+        session.ack(1)
+
+        self.assertEqual([seq for seq, _ in session.in_flight], [2])
+        self.assertTrue(session.acking)
+
+    def test_unknown_acknowledgements_are_ignored(self):
+        session = StreamSession()
+        self.send(session, 5)
+
+        session.ack(4)
+
+        self.assertEqual(len(session.in_flight), 1)
+        self.assertFalse(session.acking)
+
+    def test_acknowledgement_without_seq_takes_oldest(self):
+        session = StreamSession()
+        self.send(session)
+        self.send(session)
+
+        session.ack()
+
+        self.assertEqual(len(session.in_flight), 1)
+
+    def test_full_window_waits_for_acknowledgement_and_cuts_rate(self):
+        async def scenario():
+            session = StreamSession()
+            self.send(session, 0)
+            session.ack(0)
+            fps = session.rate.fps
+            self.send(session, 1)
+            self.send(session, 2)
+            waiting = asyncio.create_task(session.wait_turn())
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+            session.ack(1)
+            await asyncio.wait_for(waiting, 1)
+            self.assertLess(session.rate.fps, fps)
+
+        asyncio.run(scenario())
+
+    def test_missing_acknowledgements_are_given_up(self):
+        async def scenario():
+            session = StreamSession()
+            self.send(session, 0)
+            session.ack(0)
+            self.send(session, 1)
+            self.send(session, 2)
+            await asyncio.wait_for(session.wait_turn(), 1)
+            self.assertEqual(len(session.in_flight), 0)
+            self.assertEqual(session.rate.fps, 1)
+
+        asyncio.run(scenario())
+
+
+class RecordingTests(SimpleTestCase):
+    def test_read_range_streams_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "segment.mjpeg"
+            data = bytes(range(256)) * 1024
+            path.write_bytes(data)
+
+            chunks = list(read_range(path, 10, len(data) - 5))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), data[10:-5])
+
+    @override_settings(STREAM_SEGMENT_SECONDS=60)
+    def test_retention_cutoff(self):
+        now = datetime(2024, 1, 2, tzinfo=dt_timezone.utc)
+
+        self.assertEqual(
+            retention_cutoff(now, 24), now - timedelta(hours=24, minutes=1)
+        )
+        # Segments still being written must never expire
+        self.assertEqual(
+            retention_cutoff(now, 0), now - timedelta(hours=1, minutes=1)
+        )
+
+    def test_policy_rejects_zero_retention(self):
+        serializer = RecordingPolicySerializer(data={"retention_hours": 0})
+
+        self.assertFalse(serializer.is_valid())
+        self.assertIn("retention_hours", serializer.errors)
+
+
+class FrameRingTests(SimpleTestCase):
+    def setUp(self):
+        self.ring = FrameRing.create(slots=4, slot_size=16)
+        self.addCleanup(self.ring.unlink)
+
+    def test_reads_every_rendition_of_newest_frame(self):
+        self.ring.write(1, 1.0, 1.5, 0, b"old")
+        self.ring.write(2, 2.0, 2.5, 0, b"big")
+        self.ring.write(2, 2.0, 2.5, 3, b"small")
+
+        seq, payloads, captured_at, encoded_at = self.ring.read_latest(0)
+
+        self.assertEqual(seq, 3)
+        self.assertEqual(payloads, {0: b"big", 3: b"small"})
+        self.assertEqual((captured_at, encoded_at), (2.0, 2.5))
+
+    def test_payloads_survive_slot_reuse(self):
+        self.ring.write(1, 1.0, 1.0, 0, b"jpeg")
+        _, payloads, _, _ = self.ring.read_latest(0)
+
+        # Lap the ring so that every slot is rewritten
+        for frame_seq in range(2, 6):
+            self.ring.write(frame_seq, 1.0, 1.0, 0, b"newer")
+
+        self.assertEqual(payloads[0], b"jpeg")
+
+    def test_nothing_new(self):
+        self.ring.write(1, 1.0, 1.0, 0, b"jpeg")
+
+        self.assertIsNone(self.ring.read_latest(1))
+
+    def test_oversized_payloads_are_skipped(self):
+        self.assertFalse(self.ring.write(1, 1.0, 1.0, 0, b"x" * 17))
+        self.assertIsNone(self.ring.read_latest(0))
+
+    def test_slot_being_rewritten_is_not_read(self):
+        self.ring.write(1, 1.0, 1.0, 0, b"jpeg")
+        # The writer has started the next lap of this slot
+        offset = self.ring._slot_offset(1)
+        struct.pack_into("<Q", self.ring.buffer, offset + 8, 5)
+
+        _, payloads, _, _ = self.ring.read_latest(0)
+
+        self.assertEqual(payloads, {})
+
+    def test_close_with_frames_still_referenced(self):
+        ring = FrameRing.create(slots=2, slot_size=16)
+        ring.write(1, 1.0, 1.0, 0, b"jpeg")
+        _, payloads, _, _ = ring.read_latest(0)
+
+        ring.unlink()
+
+        self.assertEqual(payloads[0], b"jpeg")
+
+
+class WorkerReportTests(SimpleTestCase):
+    def test_only_newest_report_is_kept(self):
+        reports = queue.Queue(maxsize=1)
+
+        for index in range(3):
+            report(reports, {"index": index})
+
+        self.assertEqual(reports.get_nowait(), {"index": 2})
+        self.assertTrue(reports.empty())
+
+
+class StreamMetricsTests(SimpleTestCase):
+    def get(self, user=None, **headers):
+        request = RequestFactory().get("/metrics/", headers=headers)
+        request.user = user or AnonymousUser()
+        return stream_metrics(request)
+
+    @override_settings(STREAM_METRICS_TOKEN=None)
+    def test_denied_by_default(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(User(email="a@b.c")).status_code, 401)
+
+    @override_settings(STREAM_METRICS_TOKEN=None)
+    def test_staff_users_are_allowed(self):
+        response = self.get(User(email="a@b.c", is_staff=True))
+
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(STREAM_METRICS_TOKEN="secret")
+    def test_bearer_token(self):
+        self.assertEqual(self.get(Authorization="Bearer secret").status_code, 200)
+        self.assertEqual(self.get(Authorization="Bearer wrong").status_code, 401)
+
+
+@override_settings(STREAM_HASH_REPLICAS=100)
+class HashRingTests(SimpleTestCase):
+    cameras = range(1, 5001)
+
+    def owners(self, nodes):
+        ring = HashRing(nodes)
+        return {cam_id: ring.owner(cam_id) for cam_id in self.cameras}
+
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing().owner(1))
+
+    def test_cameras_are_spread_evenly(self):
+        owners = list(self.owners(["a", "b", "c", "d"]).values())
+
+        for node in "abcd":
+            self.assertAlmostEqual(
+                owners.count(node) / len(owners), 1 / 4, delta=0.08
+            )
+
+    def test_join_only_moves_cameras_to_new_node(self):
+        before = self.owners(["a", "b", "c"])
+        after = self.owners(["a", "b", "c", "d"])
+
+        moved = [cam_id for cam_id in self.cameras if before[cam_id] != after[cam_id]]
+
+        self.assertTrue(all(after[cam_id] == "d" for cam_id in moved))
+        self.assertAlmostEqual(len(moved) / len(self.cameras), 1 / 4, delta=0.08)
+
+    def test_leave_only_moves_cameras_of_leaving_node(self):
+        before = self.owners(["a", "b", "c", "d"])
+        after = self.owners(["a", "b", "c"])
+
+        moved = [cam_id for cam_id in self.cameras if before[cam_id] != after[cam_id]]
+
+        self.assertTrue(all(before[cam_id] == "d" for cam_id in moved))
+        self.assertAlmostEqual(len(moved) / len(self.cameras), 1 / 4, delta=0.08)
+
+    def test_owner_is_the_same_on_every_node(self):
+        self.assertEqual(self.owners(["a", "b", "c"]), self.owners(["c", "a", "b"]))
+
+
+@override_settings(STREAM_HASH_REPLICAS=100)
+@mock.patch.object(NodeCluster, "start")
+class NodeClusterTests(SimpleTestCase):
+    def test_owns_every_camera_alone(self, start):
+        cluster = NodeCluster("a", "ws://a", LocalNodeRegistry())
+
+        self.assertTrue(all(cluster.is_local(cam_id) for cam_id in range(100)))
+
+    def test_refresh_rebuilds_ring_when_nodes_change(self, start):
+        registry = LocalNodeRegistry({"b": "ws://b"})
+        cluster = NodeCluster("a", "ws://a", registry)
+
+        self.assertTrue(cluster.refresh())
+        self.assertEqual(cluster.urls, {"a": "ws://a", "b": "ws://b"})
+        self.assertFalse(cluster.refresh())
+        self.assertEqual(
+            {cluster.owner(cam_id) for cam_id in range(100)}, {"a", "b"}
+        )
+
+        registry.leave("b")
+        self.assertTrue(cluster.refresh())
+        self.assertTrue(all(cluster.is_local(cam_id) for cam_id in range(100)))
+
+    def test_nodes_agree_on_owners(self, start):
+        registry = LocalNodeRegistry()
+        a = NodeCluster("a", "ws://a", registry)
+        b = NodeCluster("b", "ws://b", registry)
+        a.refresh()
+        b.refresh()
+        a.refresh()
+
+        for cam_id in range(100):
+            self.assertEqual(a.owner(cam_id), b.owner(cam_id))
+            self.assertNotEqual(a.is_local(cam_id), b.is_local(cam_id))
+
+
+class RelayMailboxTests(SimpleTestCase):
+    def setUp(self):
+        self.mailbox = RelayMailbox()
+        self.big, self.small = RENDITIONS[0], RENDITIONS[1]
+
+    def put(self, rendition, seq, data):
+        info = FrameInfo(1, seq, 0.0, 0.0, rendition.id)
+        self.mailbox.slot(rendition).put(data, info)
+
+    def test_collects_every_rendition_of_a_frame(self):
+        self.put(self.big, 1, b"big")
+        self.put(self.small, 1, b"small")
+
+        frames = asyncio.run(self.mailbox.get())
+
+        self.assertEqual(
+            sorted(bytes(data) for _, data in frames), [b"big", b"small"]
+        )
+
+    def test_drops_stale_frames(self):
+        self.put(self.big, 1, b"old big")
+        self.put(self.small, 1, b"old small")
+        self.put(self.big, 2, b"new big")
+
+        frames = asyncio.run(self.mailbox.get())
+
+        self.assertEqual([(info.seq, data) for info, data in frames], [(2, b"new big")])
+        self.assertEqual(self.mailbox.dropped, 1)
+
+    def test_ends_once_closed(self):
+        self.put(self.big, 1, b"big")
+        self.mailbox.slot(self.big).put(None)
+
+        self.assertIsNone(asyncio.run(self.mailbox.get()))
+
+    def test_slots_are_reused(self):
+        self.assertIs(self.mailbox.slot(self.big), self.mailbox.slot(self.big))
+
+
+class MotionGateTests(SimpleTestCase):
+    def setUp(self):
+        self.still = np.zeros((90, 160, 3), np.uint8)
+        self.moving = self.still.copy()
+        self.moving[:, :80] = 255
+
+    def test_first_frame_passes(self):
+        gate = MotionGate(threshold=0.01, keepalive=60)
+
+        self.assertTrue(gate.should_send(self.still))
+        self.assertFalse(gate.moved)
+
+    def test_unchanged_frames_are_skipped(self):
+        gate = MotionGate(threshold=0.01, keepalive=60)
+        gate.should_send(self.still)
+
+        self.assertFalse(gate.should_send(self.still.copy()))
+        self.assertEqual(gate.skipped, 1)
+        self.assertEqual(gate.score, 0)
+
+    def test_motion_passes(self):
+        gate = MotionGate(threshold=0.01, keepalive=60)
+        gate.should_send(self.still)
+
+        self.assertTrue(gate.should_send(self.moving))
+        self.assertTrue(gate.moved)
+        self.assertAlmostEqual(gate.score, 0.5, delta=0.05)
+
+    def test_keepalive_passes_unchanged_frames(self):
+        gate = MotionGate(threshold=0.01, keepalive=0)
+        gate.should_send(self.still)
+
+        self.assertTrue(gate.should_send(self.still))
+        self.assertFalse(gate.moved)
+
+    def test_reset_lets_next_frame_through(self):
+        gate = MotionGate(threshold=0.01, keepalive=60)
+        gate.should_send(self.still)
+
+        gate.reset()
+
+        self.assertTrue(gate.should_send(self.still))
+
+    def test_resolution_change_passes(self):
+        gate = MotionGate(threshold=0.01, keepalive=60)
+        gate.should_send(self.still)
+
+        self.assertTrue(gate.should_send(np.zeros((120, 120, 3), np.uint8)))
+
+    @override_settings(STREAM_MOTION_GATE_ENVIRONMENTS=["indoor"])
+    def test_gated_environments(self):
+        self.assertIsInstance(motion_gate_for("indoor"), MotionGate)
+        self.assertIsNone(motion_gate_for("outdoor"))
+        self.assertIsNone(motion_gate_for(None))
+
+
+class FrameSchedulerTests(SimpleTestCase):
+    def test_disabled_scheduler_grants_everything(self):
+        scheduler = FrameScheduler(capacity=0)
+        share = CameraShare(1, "basic", 1.0)
+
+        self.assertTrue(all(scheduler.acquire(share, 0) for _ in range(100)))
+
+    def test_grants_within_budget(self):
+        scheduler = FrameScheduler(capacity=1.0)
+        share = CameraShare(1, "basic", 1.0)
+
+        self.assertTrue(scheduler.acquire(share, 0.1))
+        scheduler.release(share, INITIAL_COST)
+
+    def test_refuses_once_budget_is_spent(self):
+        # A tenth of a CPU second per second, with frames costing a second
+        scheduler = FrameScheduler(capacity=0.1)
+        share = CameraShare(1, "basic", 1.0)
+        self.assertTrue(scheduler.acquire(share, 0.1))
+        scheduler.release(share, 1.0)
+
+        self.assertFalse(scheduler.acquire(share, 0.05))
+        # The refused request keeps its place in the queue
+        self.assertIsNotNone(share.start)
+
+    def test_release_tracks_average_cost(self):
+        scheduler = FrameScheduler(capacity=10.0)
+        share = CameraShare(1, "basic", 1.0)
+
+        for _ in range(50):
+            scheduler.acquire(share, 0.1)
+            scheduler.release(share, 0.05)
+
+        self.assertAlmostEqual(share.cost, 0.05, places=3)
+        self.assertEqual(scheduler.costs(), {})
+
+    def test_budget_is_shared_by_weight(self):
+        scheduler = FrameScheduler(capacity=0.2)
+        shares = [CameraShare(1, "basic", 1.0), CameraShare(2, "premium", 3.0)]
+        granted = {share.cam_id: 0 for share in shares}
+        until = time.monotonic() + 1.0
+
+        def capture(share):
+            while time.monotonic() < until:
+                if scheduler.acquire(share, 0.05):
+                    granted[share.cam_id] += 1
+                    scheduler.release(share, 0.01)
+
+        threads = [threading.Thread(target=capture, args=(share,)) for share in shares]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertGreater(granted[2], 2 * granted[1])
+
+
+@mock.patch("live_streaming.consumers.get_hub")
+@mock.patch(
+    "live_streaming.consumers.get_user_cameras",
+    new_callable=mock.AsyncMock,
+    return_value={1: ("rtsp://camera", "Outdoor")},
+)
+class MultiplexConsumerTests(SimpleTestCase):
+    async def connect(self):
+        communicator = WebsocketCommunicator(
+            MultiplexConsumer.as_asgi(), "/ws/cameras/"
+        )
+        communicator.scope["user"] = User(id=1)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def stats(self, communicator):
+        await communicator.send_json_to({"type": "stats"})
+        return (await communicator.receive_json_from())["cameras"]
+
+    async def test_connections_have_their_own_subscriptions(self, *mocks):
+        first, second = await self.connect(), await self.connect()
+        await first.send_json_to({"type": "subscribe", "cams": [1]})
+        self.assertEqual(
+            await first.receive_json_from(), {"type": "subscribed", "cams": [1]}
+        )
+
+        self.assertEqual(await self.stats(second), {})
+        await second.send_json_to({"type": "unsubscribe", "cams": [1]})
+        self.assertEqual(
+            await second.receive_json_from(), {"type": "unsubscribed", "cams": []}
+        )
+        self.assertEqual(list(await self.stats(first)), ["1"])
+
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_invalid_acknowledgements_are_ignored(self, *mocks):
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "subscribe", "cams": [1]})
+        await communicator.receive_json_from()
+
+        for cam_id in ([1], {"id": 1}, None, "x"):
+            await communicator.send_json_to({"type": "ack", "cam_id": cam_id})
+
+        self.assertEqual(list(await self.stats(communicator)), ["1"])
+        await communicator.disconnect()
+
+
+class FakeReader:
+    """
+    Frame source of a hub under test, fed through `CameraHub.hand_over`.
+    """
+
+    def __init__(self):
+        self.renditions = frozenset()
+        self.fps = None
+        self.started = self.stopped = False
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stopped = True
+
+    def refresh(self):
+        pass
+
+
+@mock.patch("live_streaming.hub.CameraHub.open_source", side_effect=FakeReader)
+class CameraHubTests(SimpleTestCase):
+    async def start_hub(self, *renditions):
+        hub = get_hub(1, "rtsp://camera")
+        self.addCleanup(hub.stop)
+        mailboxes = [LatestFrame() for _ in renditions]
+        for mailbox, rendition in zip(mailboxes, renditions):
+            hub.subscribe(mailbox, rendition)
+        # Let the broadcast task open its source
+        await asyncio.sleep(0)
+        return hub, mailboxes
+
+    @override_settings(STREAM_WARM_GRACE_SECONDS=0)
+    async def test_stops_with_last_subscriber(self, open_source):
+        hub, mailboxes = await self.start_hub(RENDITIONS[0], RENDITIONS[0])
+        reader = hub._reader
+
+        hub.unsubscribe(mailboxes[0])
+        await asyncio.sleep(0)
+        self.assertIs(find_hub(1), hub)
+        self.assertFalse(reader.stopped)
+
+        hub.unsubscribe(mailboxes[1])
+        await asyncio.sleep(0)
+        self.assertIsNone(find_hub(1))
+        self.assertTrue(reader.stopped)
+        open_source.assert_called_once()
+
+    @override_settings(STREAM_WARM_GRACE_SECONDS=0.05)
+    async def test_warm_standby(self, open_source):
+        hub, (mailbox,) = await self.start_hub(RENDITIONS[0])
+
+        hub.unsubscribe(mailbox)
+        await asyncio.sleep(0)
+        self.assertEqual(hub.status, "idle")
+        self.assertIs(find_hub(1), hub)
+
+        # Coming back within the grace period reuses the running capture
+        hub.subscribe(mailbox, RENDITIONS[0])
+        await asyncio.sleep(0.1)
+        self.assertIs(find_hub(1), hub)
+        open_source.assert_called_once()
+
+        hub.unsubscribe(mailbox)
+        await asyncio.sleep(0.1)
+        self.assertIsNone(find_hub(1))
+        self.assertIsNone(hub._task)
+
+    async def test_broadcast_to_every_subscriber(self, open_source):
+        hub, mailboxes = await self.start_hub(
+            RENDITIONS[0], RENDITIONS[0], RENDITIONS[1]
+        )
+        self.assertEqual(hub._reader.renditions, {RENDITIONS[0], RENDITIONS[1]})
+
+        hub.broadcast({RENDITIONS[0]: b"big", RENDITIONS[1]: b"small"}, 1.0, 2.0)
+
+        self.assertEqual(
+            [mailbox.take() for mailbox in mailboxes], [b"big", b"big", b"small"]
+        )
+        info = mailboxes[2].info
+        self.assertEqual((info.cam_id, info.seq, info.rendition_id), (1, 1, 1))
+        self.assertEqual((info.captured_at, info.encoded_at), (1.0, 2.0))
+
+    async def test_hand_over_from_capture_thread(self, open_source):
+        hub, (mailbox,) = await self.start_hub(RENDITIONS[0])
+
+        thread = threading.Thread(
+            target=hub.hand_over, args=({RENDITIONS[0]: b"jpeg"}, 1.0, 1.5)
+        )
+        thread.start()
+        thread.join()
+        self.assertEqual(await asyncio.wait_for(mailbox.get(), 1), b"jpeg")
+
+        # The end of the stream reaches viewers and forgets the hub
+        threading.Thread(target=hub.hand_over, args=(None,)).start()
+        self.assertIsNone(await asyncio.wait_for(mailbox.get(), 1))
+        self.assertIsNone(find_hub(1))
+
+
+class CameraAccessCacheTests(SimpleTestCase):
+    access = CameraAccess(1, "rtsp://camera", "Outdoor")
+
+    def test_entries_expire_after_ttl(self):
+        cache = CameraAccessCache(ttl=10)
+        with mock.patch("live_streaming.access.time.monotonic", return_value=100):
+            cache.put(1, self.access)
+        with mock.patch("live_streaming.access.time.monotonic", return_value=109):
+            self.assertEqual(cache.get(1), self.access)
+        with mock.patch("live_streaming.access.time.monotonic", return_value=110):
+            self.assertIsNone(cache.get(1))
+
+    def test_zero_ttl_disables_cache(self):
+        cache = CameraAccessCache(ttl=0)
+        cache.put(1, self.access)
+
+        self.assertIsNone(cache.get(1))
+
+    def test_saving_or_deleting_camera_invalidates(self):
+        camera = Camera(id=1)
+        for signal in (post_save, post_delete):
+            camera_access_cache.put(1, self.access)
+            self.addCleanup(camera_access_cache.invalidate, 1)
+
+            signal.send(sender=Camera, instance=camera, created=False)
+
+            self.assertIsNone(camera_access_cache.get(1))
+
+    def test_camera_without_url_uses_webcam(self):
+        camera = Camera(id=1, user_id=2, environment="Indoor", encrypted_url=None)
+
+        self.assertEqual(camera_access(camera), CameraAccess(2, "", "Indoor"))
+
+
+def mp4_box(kind: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def mp4_full_box(kind: bytes, flags: int, payload: bytes = b"") -> bytes:
+    return mp4_box(kind, flags.to_bytes(4, "big") + payload)
+
+
+def moof(tfhd_flags=None, trun_flags=None) -> bytes:
+    """
+    Builds a `moof` box with one track fragment. `tfhd_flags` and
+    `trun_flags` are the sample flags of its header and its first sample.
+    """
+    boxes = b""
+    if tfhd_flags is not None:
+        # Default sample flags present, after the track ID
+        boxes += mp4_full_box(b"tfhd", 0x20, struct.pack(">II", 1, tfhd_flags))
+    if trun_flags is None:
+        boxes += mp4_full_box(b"trun", 0, struct.pack(">I", 1))
+    else:
+        # Data offset and first sample flags present, after the sample count
+        boxes += mp4_full_box(b"trun", 0x5, struct.pack(">IiI", 1, 0, trun_flags))
+    return mp4_box(b"moof", mp4_box(b"traf", boxes))
+
+
+class Mp4BoxTests(SimpleTestCase):
+    def test_iter_boxes(self):
+        data = mp4_box(b"ftyp", b"isom") + mp4_box(b"moov")
+
+        self.assertEqual(list(iter_boxes(data)), [(b"ftyp", 8, 12), (b"moov", 20, 20)])
+
+    def test_iter_boxes_with_64_bit_size(self):
+        data = struct.pack(">I4sQ", 1, b"mdat", 20) + b"data"
+
+        self.assertEqual(list(iter_boxes(data)), [(b"mdat", 16, 20)])
+
+    def test_iter_boxes_stops_at_truncated_box(self):
+        data = mp4_box(b"ftyp") + mp4_box(b"moov", b"payload")[:-1]
+
+        self.assertEqual([kind for kind, _, _ in iter_boxes(data)], [b"ftyp"])
+
+    def test_find_nested_box(self):
+        fragment = moof()
+        traf = find_box(fragment, b"traf", *find_box(fragment, b"moof"))
+
+        self.assertIsNotNone(find_box(fragment, b"trun", *traf))
+        self.assertIsNone(find_box(fragment, b"tfhd", *traf))
+
+    def test_codec_string(self):
+        init = mp4_box(b"moov", mp4_box(b"avcC", bytes([1, 0x64, 0x00, 0x1F])))
+
+        self.assertEqual(codec_string(init), "avc1.64001f")
+        self.assertIsNone(codec_string(mp4_box(b"moov", mp4_box(b"hvcC"))))
+
+    def test_keyframe_from_first_sample_flags(self):
+        self.assertTrue(is_keyframe_fragment(moof(trun_flags=0)))
+        self.assertFalse(is_keyframe_fragment(moof(trun_flags=NON_SYNC_SAMPLE)))
+
+    def test_keyframe_from_default_sample_flags(self):
+        self.assertFalse(is_keyframe_fragment(moof(tfhd_flags=NON_SYNC_SAMPLE)))
+        # The flags of the first sample override the defaults
+        self.assertTrue(
+            is_keyframe_fragment(moof(tfhd_flags=NON_SYNC_SAMPLE, trun_flags=0))
+        )
+
+    def test_fragments_without_flags_are_keyframes(self):
+        self.assertTrue(is_keyframe_fragment(moof()))
+        self.assertTrue(is_keyframe_fragment(mp4_box(b"mdat")))
+
+    async def read(self, data):
+        stream = asyncio.StreamReader()
+        stream.feed_data(data)
+        stream.feed_eof()
+        return await read_box(stream)
+
+    async def test_read_box(self):
+        box = mp4_box(b"ftyp", b"isom")
+
+        self.assertEqual(await self.read(box + b"next"), (b"ftyp", box))
+        self.assertIsNone(await self.read(box[:-1]))
+
+    async def test_read_box_rejects_malformed_sizes(self):
+        with self.assertRaises(ValueError):
+            await self.read(struct.pack(">I4s", 4, b"mdat"))
+        with self.assertRaises(ValueError):
+            await self.read(struct.pack(">I4sQ", 1, b"mdat", 2**40))
+
+
+class FragmentMailboxTests(SimpleTestCase):
+    init = Fragment(b"init", True, init=True)
+    key = Fragment(b"key", True)
+    delta = Fragment(b"delta", False)
+
+    def setUp(self):
+        self.mailbox = FragmentMailbox(max_fragments=3)
+
+    def test_starts_at_keyframe(self):
+        for fragment in (self.init, self.delta, self.key, self.delta):
+            self.mailbox.put(fragment)
+
+        self.assertEqual(
+            list(self.mailbox.fragments), [self.init, self.key, self.delta]
+        )
+        self.assertEqual(self.mailbox.dropped, 1)
+
+    def test_backlog_is_dropped_until_next_keyframe(self):
+        for fragment in (self.init, self.key, self.delta, self.delta, self.delta):
+            self.mailbox.put(fragment)
+        self.assertEqual(list(self.mailbox.fragments), [self.init])
+
+        self.mailbox.put(self.key)
+        self.assertEqual(list(self.mailbox.fragments), [self.init, self.key])
+        self.assertEqual(self.mailbox.dropped, 4)
+
+    def test_init_segment_restarts_stream(self):
+        for fragment in (self.init, self.key, self.delta, self.init, self.delta):
+            self.mailbox.put(fragment)
+
+        self.assertEqual(list(self.mailbox.fragments), [self.init])
+
+    async def test_get_drains_before_ending(self):
+        self.mailbox.put(self.key)
+        self.mailbox.put(None)
+
+        self.assertEqual(await self.mailbox.get(), self.key)
+        self.assertIsNone(await self.mailbox.get())
+
+
+class EventNotifierTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="owner@example.com")
+        cls.camera = Camera.objects.create(
+            user=cls.user,
+            name="Front door",
+            camera_type="ip",
+            industry_type="retail",
+            environment="Outdoor",
+            resolution="1080p",
+            brand="others",
+            ip_address="10.0.0.2",
+            port=554,
+            address_line_1="1 Main Street",
+            city="Springfield",
+            zip_code="12345",
+            state_province="State",
+            country="Country",
+        )
+
+    def setUp(self):
+        self.notifier = EventNotifier(["motion"], window=60, flush_interval=3600)
+        # Keep the flusher thread from starting
+        self.notifier._flusher = mock.Mock()
+
+    def event(self, occurred_at, kind="motion"):
+        return CameraEvent(self.camera.id, kind, 1700000000 + occurred_at, {})
+
+    def test_one_notification_per_window(self):
+        for occurred_at in (0, 10, 59, 60, 90):
+            self.notifier(self.event(occurred_at))
+        self.notifier(self.event(5, kind="detection"))
+
+        with mock.patch.object(
+            Notification.objects, "bulk_create", wraps=Notification.objects.bulk_create
+        ) as bulk_create:
+            self.assertEqual(self.notifier.flush(), 2)
+
+        bulk_create.assert_called_once()
+        self.assertEqual(
+            [n.title for n in Notification.objects.order_by("created_at")],
+            ["Motion detected", "Motion detected"],
+        )
+
+    def test_window_is_shared_with_other_processes(self):
+        # Another process notified the same burst first
+        other = EventNotifier(["motion"], window=60, flush_interval=3600)
+        other._flusher = mock.Mock()
+        other(self.event(0))
+        other.flush()
+
+        self.notifier(self.event(30))
+        self.notifier(self.event(100))
+
+        self.assertEqual(self.notifier.flush(), 1)
+        self.assertEqual(Notification.objects.count(), 2)
+
+
+@mock.patch(
+    "camera_integration.views.snapshot_cache.latest",
+    return_value=Snapshot(b"jpeg", 1700000000.0, "abc"),
+)
+@mock.patch(
+    "camera_integration.views.camera_access_cache.load",
+    return_value=CameraAccess(1, "rtsp://camera", "Outdoor"),
+)
+class CameraSnapshotViewTests(SimpleTestCase):
+    def get(self, **headers):
+        request = APIRequestFactory().get("/cameras/1/snapshot/", **headers)
+        force_authenticate(request, user=User(id=1))
+        return CameraSnapshotView.as_view()(request, id=1)
+
+    def test_serves_latest_snapshot(self, *mocks):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"jpeg")
+        self.assertEqual(response["ETag"], '"abc"')
+
+    def test_matching_etag_is_not_modified(self, *mocks):
+        response = self.get(HTTP_IF_NONE_MATCH='"abc"')
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_changed_etag_is_served_again(self, *mocks):
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"old"').status_code, 200)
+
+
+@mock.patch("live_streaming.views.get_hub")
+class GenerateMjpegTests(SimpleTestCase):
+    async def part_gap(self, get_hub, frame_data):
+        """
+        Returns the first part of the stream and how long the second one
+        took to follow it, with a frame always waiting for the viewer.
+        """
+        stream = generate_mjpeg(1, "rtsp://camera", "Outdoor", RENDITIONS[0])
+        first = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        mailbox = get_hub.return_value.subscribe.call_args.args[0]
+        mailbox.put(frame_data)
+        part = await first
+        mailbox.put(frame_data)
+        started = time.monotonic()
+        await anext(stream)
+        gap = time.monotonic() - started
+        await stream.aclose()
+        get_hub.return_value.unsubscribe.assert_called_once_with(mailbox)
+        return part, gap
+
+    @override_settings(STREAM_MJPEG_FPS=10, STREAM_MJPEG_MAX_KBPS=100000)
+    async def test_parts_are_capped(self, get_hub):
+        part, gap = await self.part_gap(get_hub, b"jpeg")
+
+        self.assertTrue(part.endswith(b"\r\n\r\njpeg\r\n"))
+        self.assertGreaterEqual(gap, 0.09)
+
+    @override_settings(STREAM_MJPEG_FPS=50, STREAM_MJPEG_MAX_KBPS=8)
+    async def test_bytes_are_capped(self, get_hub):
+        # 8 kbps let 1000 bytes through per second
+        part, gap = await self.part_gap(get_hub, b"x" * 400)
+
+        self.assertGreaterEqual(gap, len(part) / 1000 - 0.01)
+
+
+class FakeVideo:
+    """
+    Capture opened by `open_video`, reading the given results in turn.
+    """
+
+    def __init__(self, opened=True, reads=()):
+        self.opened = opened
+        self.reads = list(reads)
+        self.released = False
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, *args):
+        pass
+
+    def read(self, image=None):
+        return self.reads.pop(0) if self.reads else (True, "frame")
+
+    def release(self):
+        self.released = True
+
+
+@override_settings(STREAM_RECONNECT_BASE_DELAY=1, STREAM_RECONNECT_MAX_DELAY=5)
+@mock.patch("live_streaming.capture.random.uniform", side_effect=lambda low, high: high)
+class SupervisedCaptureTests(SimpleTestCase):
+    def setUp(self):
+        self.stopped = mock.Mock()
+        self.stopped.wait.return_value = False
+
+    def test_reconnects_with_exponential_backoff(self, uniform):
+        videos = [FakeVideo(opened=False) for _ in range(4)] + [FakeVideo()]
+        with mock.patch("live_streaming.capture.open_video", side_effect=videos):
+            capture = SupervisedCapture("rtsp://camera", self.stopped)
+
+            self.assertEqual(capture.read(), (True, "frame"))
+
+        delays = [call.args[0] for call in self.stopped.wait.call_args_list]
+        self.assertEqual(delays, [2, 4, 5, 5])
+        self.assertEqual(capture.reconnects, 4)
+        self.assertEqual(capture.attempts, 0)
+
+    def test_failed_read_reopens_capture(self, uniform):
+        broken = FakeVideo(reads=[(False, None)])
+        videos = [broken, FakeVideo()]
+        with mock.patch("live_streaming.capture.open_video", side_effect=videos):
+            capture = SupervisedCapture("rtsp://camera", self.stopped)
+
+            self.assertEqual(capture.read(), (True, "frame"))
+
+        self.assertTrue(broken.released)
+        self.assertEqual(capture.reconnects, 1)
+
+    def test_stop_interrupts_backoff(self, uniform):
+        self.stopped.wait.return_value = True
+        with mock.patch(
+            "live_streaming.capture.open_video", return_value=FakeVideo(opened=False)
+        ) as open_video:
+            capture = SupervisedCapture("rtsp://camera", self.stopped)
+
+            self.assertEqual(capture.read(), (False, None))
+
+        open_video.assert_called_once()
+
+    def test_local_sources_are_not_reconnected(self, uniform):
+        with mock.patch(
+            "live_streaming.capture.open_video", return_value=FakeVideo(opened=False)
+        ) as open_video:
+            capture = SupervisedCapture("video.mp4", self.stopped)
+
+            self.assertEqual(capture.read(), (False, None))
+
+        open_video.assert_called_once()
+        self.stopped.wait.assert_not_called()
+
+
+class IdleStreamConsumer(StreamConsumer):
+    """
+    Consumer streaming nothing until its task is cancelled.
+    """
+
+    stream_kind = "idle"
+    cancelled = left = False
+
+    async def connect(self):
+        await self.accept()
+        self.start_streaming()
+
+    async def stream(self):
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            IdleStreamConsumer.cancelled = True
+            raise
+
+    def leave(self):
+        IdleStreamConsumer.left = True
+
+
+class StreamTaskTests(SimpleTestCase):
+    async def test_disconnect_cancels_stream_task(self):
+        communicator = WebsocketCommunicator(IdleStreamConsumer.as_asgi(), "/ws/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(stream_tasks.counts().get("idle"), 1)
+
+        await communicator.disconnect()
+
+        self.assertTrue(IdleStreamConsumer.cancelled)
+        self.assertTrue(IdleStreamConsumer.left)
+        self.assertNotIn("idle", stream_tasks.counts())
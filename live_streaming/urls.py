@@ -1,8 +1,10 @@
 from django.urls import path
 
-from .views import index
+from .views import index, mjpeg_stream, stream_metrics
 
 
 urlpatterns = [
     path("<int:cam_id>/", index, name="index"),
+    path("<int:cam_id>/mjpeg/", mjpeg_stream, name="mjpeg-stream"),
+    path("metrics/", stream_metrics, name="stream-metrics"),
 ]
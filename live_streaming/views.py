@@ -1,6 +1,141 @@
+import asyncio
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+from knox.auth import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+from camera_integration.models import Camera
+
+from .consumers import get_camera_access
+from .flow import FrameRateController, StreamSession
+from .metrics import REGISTRY
+from .hub import get_hub
+from .renditions import rendition_from_query
+
+MJPEG_BOUNDARY = "frame"
 
 
 def index(request, cam_id):
     """Video streaming home page."""
     return render(request, "live_stream.html", context={"cam_id": cam_id})
+
+
+@database_sync_to_async
+def get_token_user(request):
+    """
+    Authenticates a request through a Knox token in its Authorization header,
+    for clients such as NVRs that cannot hold a session.
+
+    Returns:
+        User | None: The authenticated user, or `None`.
+    """
+    try:
+        result = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+async def mjpeg_stream(request, cam_id):
+    """
+    Streams a camera as `multipart/x-mixed-replace` MJPEG over plain HTTP.
+
+    Frames come from the same shared `CameraHub` as the WebSocket stream.
+    The server cannot tell when a part has reached the client, as writing it
+    only queues it in the transport, so parts are capped at
+    `STREAM_MJPEG_FPS` and `STREAM_MJPEG_MAX_KBPS` and frames produced in
+    between are dropped. Accepts the same `max_width` and `quality` query
+    parameters as the WebSocket endpoint.
+    """
+    user = await request.auser()
+    if user.is_anonymous:
+        user = await get_token_user(request)
+    if user is None:
+        return HttpResponse("Unauthorized", status=401)
+    try:
+        access = await get_camera_access(cam_id)
+    except Camera.DoesNotExist:
+        raise Http404("Camera not found")
+    if user.id != access.user_id:
+        return HttpResponseForbidden("This user does not have access to this camera")
+
+    rendition = rendition_from_query(request.META.get("QUERY_STRING", ""))
+    response = StreamingHttpResponse(
+        generate_mjpeg(cam_id, access.stream_url, access.environment, rendition),
+        content_type=f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}",
+    )
+    response["Cache-Control"] = "no-cache, private"
+    return response
+
+
+async def generate_mjpeg(cam_id, cam_url, environment, rendition):
+    """
+    Yields the parts of an MJPEG stream, one JPEG per part, no faster than
+    `STREAM_MJPEG_FPS` parts and `STREAM_MJPEG_MAX_KBPS` per second.
+    """
+    session = StreamSession(str(cam_id), "mjpeg")
+    session.rate = FrameRateController(
+        settings.STREAM_MJPEG_FPS, settings.STREAM_MJPEG_FPS
+    )
+    bytes_per_second = settings.STREAM_MJPEG_MAX_KBPS * 1000 / 8
+    hub = get_hub(cam_id, cam_url, environment)
+    hub.subscribe(session.mailbox, rendition, session.rate)
+    try:
+        while True:
+            frame_data = await session.next_frame()
+            if frame_data is None:
+                break
+            started = time.monotonic()
+            part = b"".join(
+                (
+                    f"--{MJPEG_BOUNDARY}\r\n".encode(),
+                    b"Content-Type: image/jpeg\r\n",
+                    f"Content-Length: {len(frame_data)}\r\n\r\n".encode(),
+                    frame_data,
+                    b"\r\n",
+                )
+            )
+            # Resumed as soon as the part is queued, not once it is sent
+            yield part
+            info = session.mailbox.info
+            session.frame_sent(
+                len(part),
+                time.monotonic() - started,
+                info.captured_at if info else None,
+            )
+            # Large parts wait longer before the next one, so clients with at
+            # least that bandwidth never have parts queued for them
+            delay = len(part) / bytes_per_second - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+    finally:
+        hub.unsubscribe(session.mailbox)
+
+
+def stream_metrics(request):
+    """
+    Exposes the streaming pipeline metrics in the Prometheus text format.
+
+    The metrics are labelled with the camera IDs of every user, so they are
+    only shown to scrapers sending `STREAM_METRICS_TOKEN` as a bearer token
+    in the Authorization header, and to staff users.
+    """
+    token = settings.STREAM_METRICS_TOKEN
+    authorized = bool(token) and constant_time_compare(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    )
+    if not authorized and not request.user.is_staff:
+        return HttpResponse("Unauthorized", status=401)
+    return HttpResponse(
+        REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
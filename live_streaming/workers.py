@@ -0,0 +1,507 @@
+import atexit
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Callable
+
+from django.conf import settings
+
+from . import metrics
+from .capture import CaptureReader
+from .events import CameraEvent, event_bus
+from .motion import motion_gate_for
+from .renditions import RENDITIONS, Rendition
+from .scheduler import frame_scheduler
+
+# Seconds between two metrics reports of a capture worker
+REPORT_INTERVAL = 5
+
+
+class FrameRing:
+    """
+    Ring of encoded frames stored in a `multiprocessing.shared_memory` block.
+
+    A capture worker writes every rendition of a frame into its own slot and
+    the ASGI process reads the newest frame back without any pickling, pipe
+    transfer or copy. Each slot is guarded by a sequence lock: the writer
+    stamps the slot sequence before and after writing the payload, so a
+    reader can tell when a slot was being overwritten as it read it.
+
+    Layout: a ring header followed by `slots` fixed-size slots, each made of
+    a slot header and up to `slot_size` bytes of JPEG payload.
+    """
+
+    # Sequence of the newest committed slot, closed flag
+    HEADER = struct.Struct("<QB7x")
+    # Committed sequence, started sequence, frame sequence, capture time,
+    # encode time, rendition ID, payload length
+    SLOT_HEADER = struct.Struct("<QQQddHI2x")
+
+    def __init__(self, memory: shared_memory.SharedMemory, slots: int, slot_size: int):
+        self.memory = memory
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = memory.buf
+        self.seq = self.HEADER.unpack_from(self.buffer, 0)[0]
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @classmethod
+    def size_for(cls, slots: int, slot_size: int) -> int:
+        return cls.HEADER.size + slots * (cls.SLOT_HEADER.size + slot_size)
+
+    @classmethod
+    def create(cls, slots: int | None = None, slot_size: int | None = None):
+        """
+        Allocates a new, empty ring.
+
+        Args:
+            slots (int | None): The number of slots, `STREAM_RING_SLOTS` by default.
+            slot_size (int | None): The maximum payload size of a slot,
+                `STREAM_RING_SLOT_BYTES` by default.
+
+        Returns:
+            FrameRing: The ring, owned by the calling process.
+        """
+        slots = slots or settings.STREAM_RING_SLOTS
+        slot_size = slot_size or settings.STREAM_RING_SLOT_BYTES
+        memory = shared_memory.SharedMemory(
+            create=True, size=cls.size_for(slots, slot_size)
+        )
+        memory.buf[: cls.HEADER.size] = bytes(cls.HEADER.size)
+        return cls(memory, slots, slot_size)
+
+    @classmethod
+    def attach(cls, name: str, slots: int, slot_size: int):
+        """
+        Maps a ring created by another process.
+
+        Args:
+            name (str): The name of the shared memory block.
+            slots (int): The number of slots of the ring.
+            slot_size (int): The maximum payload size of a slot.
+
+        Returns:
+            FrameRing: The ring, still owned by the process that created it.
+        """
+        # Spawned workers share the resource tracker of the ASGI process, so
+        # the block is only destroyed when its creator unlinks it
+        memory = shared_memory.SharedMemory(name=name)
+        return cls(memory, slots, slot_size)
+
+    def _slot_offset(self, seq: int) -> int:
+        return self.HEADER.size + (seq % self.slots) * (
+            self.SLOT_HEADER.size + self.slot_size
+        )
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.HEADER.unpack_from(self.buffer, 0)[1])
+
+    def write(
+        self,
+        frame_seq: int,
+        captured_at: float,
+        encoded_at: float,
+        rendition_id: int,
+        data: bytes | memoryview,
+    ) -> bool:
+        """
+        Writes one rendition of a frame into the next slot.
+
+        Returns:
+            bool: False if the payload does not fit in a slot and was skipped.
+        """
+        if len(data) > self.slot_size:
+            return False
+        seq = self.seq + 1
+        offset = self._slot_offset(seq)
+        start = offset + self.SLOT_HEADER.size
+        # Mark the slot as being written before touching the payload
+        struct.pack_into("<QQ", self.buffer, offset, 0, seq)
+        self.buffer[start : start + len(data)] = data
+        self.SLOT_HEADER.pack_into(
+            self.buffer,
+            offset,
+            seq,
+            seq,
+            frame_seq,
+            captured_at,
+            encoded_at,
+            rendition_id,
+            len(data),
+        )
+        self.HEADER.pack_into(self.buffer, 0, seq, 0)
+        self.seq = seq
+        return True
+
+    def mark_closed(self) -> None:
+        """
+        Tells readers that the source has ended.
+        """
+        self.HEADER.pack_into(self.buffer, 0, self.seq, 1)
+
+    def read_latest(
+        self, after: int
+    ) -> tuple[int, dict[int, bytes], float, float] | None:
+        """
+        Reads every rendition of the newest frame committed after a sequence.
+
+        The payloads are copied out of the ring: the writer reuses a slot
+        `slots` writes later, while a frame can stay referenced by slow
+        viewers, snapshots or the relay for much longer than that.
+
+        Args:
+            after (int): The newest slot sequence the caller has already seen.
+
+        Returns:
+            tuple[int, dict[int, bytes], float, float] | None: The newest
+            slot sequence, the payloads of the newest frame keyed by rendition
+            ID and the capture and encode times of the frame, or `None` if
+            nothing new was written.
+        """
+        latest = self.HEADER.unpack_from(self.buffer, 0)[0]
+        if latest <= after:
+            return None
+        payloads = {}
+        frame = None
+        captured_at = encoded_at = 0.0
+        for seq in range(latest, max(after, latest - self.slots), -1):
+            offset = self._slot_offset(seq)
+            (
+                committed,
+                _,
+                frame_seq,
+                slot_captured_at,
+                slot_encoded_at,
+                rendition_id,
+                length,
+            ) = self.SLOT_HEADER.unpack_from(self.buffer, offset)
+            if committed != seq or (frame is not None and frame_seq != frame):
+                break
+            start = offset + self.SLOT_HEADER.size
+            data = bytes(self.buffer[start : start + length])
+            # The writer may have lapped us while copying
+            if struct.unpack_from("<Q", self.buffer, offset + 8)[0] != seq:
+                break
+            frame = frame_seq
+            captured_at, encoded_at = slot_captured_at, slot_encoded_at
+            payloads.setdefault(rendition_id, data)
+        return latest, payloads, captured_at, encoded_at
+
+    def close(self) -> None:
+        self.buffer = None
+        self.memory.close()
+
+    def unlink(self) -> None:
+        self.close()
+        self.memory.unlink()
+
+
+class RingWriter:
+    """
+    Frame callback of a `CaptureReader` running in a worker process, writing
+    every encoded rendition to the camera's ring.
+    """
+
+    def __init__(self, ring: FrameRing):
+        self.ring = ring
+        self.frame_seq = 0
+
+    def __call__(
+        self,
+        encoded: dict[Rendition, bytes | memoryview] | None,
+        captured_at: float = 0.0,
+        encoded_at: float = 0.0,
+    ) -> None:
+        if encoded is None:
+            self.ring.mark_closed()
+            self.ring.close()
+            return
+        self.frame_seq += 1
+        for rendition, frame_data in encoded.items():
+            self.ring.write(
+                self.frame_seq, captured_at, encoded_at, rendition.id, frame_data
+            )
+
+
+def run_worker(
+    commands: multiprocessing.Queue,
+    reports: multiprocessing.Queue,
+    events: multiprocessing.Queue,
+) -> None:
+    """
+    Entry point of a capture worker process. Runs one `CaptureReader` thread
+    per camera assigned to the worker until it receives `("exit",)`, sends a
+    snapshot of its metrics every `REPORT_INTERVAL` seconds and forwards the
+    camera events of its readers.
+
+    Args:
+        commands (multiprocessing.Queue): The commands sent by the pool.
+        reports (multiprocessing.Queue): The metrics snapshots sent back,
+            holding only the newest one.
+        events (multiprocessing.Queue): The camera events sent back.
+    """
+    import django
+
+    django.setup()
+    event_bus.subscribe(lambda event: events.put(tuple(event)))
+    # The frame budget of the node is split evenly between the workers
+    frame_scheduler.set_capacity(
+        frame_scheduler.capacity / settings.STREAM_CAPTURE_WORKERS
+    )
+
+    readers = {}
+    reported_at = time.monotonic()
+    while True:
+        if time.monotonic() - reported_at >= REPORT_INTERVAL:
+            report(reports, metrics.REGISTRY.snapshot())
+            reported_at = time.monotonic()
+        try:
+            command, *args = commands.get(timeout=REPORT_INTERVAL)
+        except queue.Empty:
+            continue
+        if command == "exit":
+            break
+        cam_id = args[0]
+        if command == "start":
+            _, cam_url, environment, ring_name, slots, slot_size = args
+            try:
+                ring = FrameRing.attach(ring_name, slots, slot_size)
+            except FileNotFoundError:
+                # The viewers left before the worker got to the camera
+                continue
+            readers[cam_id] = CaptureReader(
+                cam_id,
+                cam_url,
+                RingWriter(ring),
+                motion_gate=motion_gate_for(environment),
+            )
+            readers[cam_id].start()
+        elif cam_id not in readers:
+            continue
+        elif command == "renditions":
+            readers[cam_id].renditions = frozenset(RENDITIONS[id] for id in args[1])
+        elif command == "fps":
+            readers[cam_id].fps = args[1]
+        elif command == "refresh":
+            readers[cam_id].refresh()
+        elif command == "stop":
+            readers.pop(cam_id).stop()
+
+    for reader in readers.values():
+        reader.stop()
+
+
+def report(reports: multiprocessing.Queue, snapshot: dict) -> None:
+    """
+    Replaces the metrics snapshot waiting in `reports`, if any, with a newer
+    one, so the queue never grows while nobody scrapes the metrics.
+    """
+    try:
+        reports.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        reports.put_nowait(snapshot)
+    except queue.Full:
+        # The previous snapshot is still being flushed, the next report
+        # replaces it
+        pass
+
+
+class CaptureWorker:
+    """
+    Handle on a capture worker process and the cameras assigned to it.
+    """
+
+    def __init__(self, context):
+        self.commands = context.Queue()
+        self.reports = context.Queue(maxsize=1)
+        self.events = context.Queue()
+        self.process = context.Process(
+            target=run_worker,
+            args=(self.commands, self.reports, self.events),
+            daemon=True,
+        )
+        self.cameras: set[int] = set()
+        self.last_report: dict = {}
+
+    def send(self, *command) -> None:
+        self.commands.put(command)
+
+    def relay_events(self) -> None:
+        """
+        Publishes the camera events of the worker on the `event_bus` of this
+        process until `None` is received. Runs on a dedicated thread.
+        """
+        try:
+            while (event := self.events.get()) is not None:
+                event_bus.publish(CameraEvent(*event))
+        except (EOFError, OSError):
+            # The worker went away with the process
+            pass
+
+    def latest_report(self) -> dict:
+        """
+        Returns the newest metrics snapshot sent by the worker.
+        """
+        try:
+            while True:
+                self.last_report = self.reports.get_nowait()
+        except queue.Empty:
+            pass
+        return self.last_report
+
+
+class RingReader(threading.Thread):
+    """
+    Reads the frames a capture worker writes to a camera's ring and passes
+    them to `on_frame`, the same way a `CaptureReader` thread does.
+    """
+
+    def __init__(
+        self,
+        cam_id: int,
+        ring: FrameRing,
+        worker: CaptureWorker,
+        on_frame: Callable[..., None],
+    ):
+        super().__init__(name=f"ring-{cam_id}", daemon=True)
+        self.cam_id = cam_id
+        self.ring = ring
+        self.worker = worker
+        self.on_frame = on_frame
+        self._renditions: frozenset[Rendition] = frozenset()
+        self._fps = settings.STREAM_MAX_FPS
+        self._stopped = threading.Event()
+
+    @property
+    def renditions(self) -> frozenset[Rendition]:
+        return self._renditions
+
+    @renditions.setter
+    def renditions(self, renditions: frozenset[Rendition]) -> None:
+        self._renditions = renditions
+        self.worker.send("renditions", self.cam_id, [r.id for r in renditions])
+
+    @property
+    def fps(self) -> float:
+        return self._fps
+
+    @fps.setter
+    def fps(self, fps: float) -> None:
+        self._fps = fps
+        self.worker.send("fps", self.cam_id, fps)
+
+    def refresh(self) -> None:
+        self.worker.send("refresh", self.cam_id)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def run(self):
+        # Poll twice per frame interval of the fastest viewer
+        interval = 1 / (2 * settings.STREAM_MAX_FPS)
+        seq = 0
+        try:
+            while not self._stopped.wait(interval):
+                latest = self.ring.read_latest(seq)
+                if latest is not None:
+                    seq, payloads, captured_at, encoded_at = latest
+                    encoded = {
+                        RENDITIONS[id]: data
+                        for id, data in payloads.items()
+                        if RENDITIONS[id] in self._renditions
+                    }
+                    if encoded:
+                        self.on_frame(encoded, captured_at, encoded_at)
+                elif self.ring.closed:
+                    break
+        finally:
+            self.worker.send("stop", self.cam_id)
+            self.worker.cameras.discard(self.cam_id)
+            self.ring.unlink()
+            self.on_frame(None)
+
+
+class CaptureWorkerPool:
+    """
+    Pool of capture worker processes spreading camera decoding across cores.
+
+    Cameras are assigned to the worker currently capturing the fewest cameras.
+    """
+
+    def __init__(self, size: int):
+        context = multiprocessing.get_context("spawn")
+        self.workers = [CaptureWorker(context) for _ in range(size)]
+        for worker in self.workers:
+            worker.process.start()
+            threading.Thread(
+                target=worker.relay_events, name="worker-events", daemon=True
+            ).start()
+        metrics.REGISTRY.add_collector(self.collect_metrics)
+        atexit.register(self.shutdown)
+
+    def collect_metrics(self) -> list[dict]:
+        """
+        Returns the latest metrics snapshot of every worker.
+        """
+        return [worker.latest_report() for worker in self.workers]
+
+    def open(
+        self,
+        cam_id: int,
+        cam_url: str,
+        environment: str | None,
+        on_frame: Callable[..., None],
+    ) -> RingReader:
+        """
+        Starts capturing a camera on the least loaded worker.
+
+        Args:
+            cam_id (int): The ID of the camera.
+            cam_url (str): The stream URL of the camera.
+            environment (str | None): The environment of the camera.
+            on_frame (Callable): Called from the reader thread with each frame.
+
+        Returns:
+            RingReader: The reader to start, mirroring a `CaptureReader`.
+        """
+        worker = min(self.workers, key=lambda worker: len(worker.cameras))
+        worker.cameras.add(cam_id)
+        ring = FrameRing.create()
+        worker.send(
+            "start", cam_id, cam_url, environment, ring.name, ring.slots, ring.slot_size
+        )
+        return RingReader(cam_id, ring, worker, on_frame)
+
+    def shutdown(self) -> None:
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.send("exit")
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            worker.events.put(None)
+
+
+_pool: CaptureWorkerPool | None = None
+
+
+def get_worker_pool() -> CaptureWorkerPool | None:
+    """
+    Returns the capture worker pool of this process, starting it on first use.
+
+    Returns:
+        CaptureWorkerPool | None: The pool, or `None` when
+        `STREAM_CAPTURE_WORKERS` is 0 and cameras are captured in-process.
+    """
+    global _pool
+    if _pool is None and settings.STREAM_CAPTURE_WORKERS > 0:
+        _pool = CaptureWorkerPool(settings.STREAM_CAPTURE_WORKERS)
+    return _pool